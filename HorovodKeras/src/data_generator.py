@@ -1,6 +1,12 @@
 import numpy as np
 import keras
 import logging
+from io import BytesIO
+from keras import backend as K
+from image_cache import ImageCache
+from PIL import Image
+from shards import ShardReader
+from shared_array import SharedArray
 
 
 def _get_logger():
@@ -18,8 +24,35 @@ def _create_labels(batch_size, num_batches, n_classes):
     return np.random.choice(n_classes, batch_size * num_batches)
 
 
+def _create_data_low_memory(batch_size, num_batches, dim, channels, dtype, seed=42, out=None):
+    """ Fills a pool of the given dtype one batch at a time so that the whole pool is
+    never materialised as float64 or float32
+    """
+    random_state = np.random.RandomState(seed)
+    shape = (batch_size * num_batches, dim[0], dim[1], channels)
+    data = np.empty(shape, dtype=dtype) if out is None else out
+    for i in range(num_batches):
+        batch = random_state.rand(batch_size, dim[0], dim[1], channels)
+        if np.issubdtype(dtype, np.integer):
+            batch *= np.iinfo(dtype).max
+        data[i * batch_size:(i + 1) * batch_size] = batch
+    return data
+
+
 
 class FakeDataGenerator(keras.preprocessing.image.Iterator):
+    """ Synthetic data
+
+    By default every batch is a random selection of images from a float32 pool of
+    batch_size*num_batches images. With low_memory the pool is kept as dtype (float16
+    unless given) and every batch is a contiguous slice of it, a view rather than a
+    copy. The pool is never written to after it is created, so processes forked by
+    fit_generator share its pages instead of copying them.
+
+    With shared_memory the pool, labels and translation index are placed in named
+    shared memory. Worker processes attach to it read-only, so host memory does not
+    grow with the number of workers.
+    """
 
     def __init__(self,
                  batch_size=32,
@@ -29,7 +62,10 @@ class FakeDataGenerator(keras.preprocessing.image.Iterator):
                  n_classes=10,
                  length=1000,
                  shuffle=True,
-                 seed=42):
+                 seed=42,
+                 low_memory=False,
+                 dtype=None,
+                 shared_memory=False):
 
         'Initialization'
         super(FakeDataGenerator, self).__init__(length,
@@ -40,14 +76,162 @@ class FakeDataGenerator(keras.preprocessing.image.Iterator):
         self.n_channels = n_channels
         self.n_classes = n_classes
         self.num_batches = num_batches
-        self._data = _create_data(self.batch_size, self.num_batches, self.dim, self.n_channels)
+        self.low_memory = low_memory
+        self.shared_memory = shared_memory
+        if low_memory or shared_memory:
+            dtype = dtype or (np.float16 if low_memory else np.float32)
+            shape = (self.batch_size * self.num_batches, self.dim[0], self.dim[1], self.n_channels)
+            out = SharedArray.create(shape, dtype, prefix='fake-data') if shared_memory else None
+            self._data = _create_data_low_memory(self.batch_size,
+                                                 self.num_batches,
+                                                 self.dim,
+                                                 self.n_channels,
+                                                 dtype,
+                                                 seed=seed,
+                                                 out=None if out is None else out.array)
+        else:
+            self._data = _create_data(self.batch_size, self.num_batches, self.dim, self.n_channels)
         self._labels = _create_labels(self.batch_size, self.num_batches, self.n_classes)
+        self._one_hot = keras.utils.to_categorical(self._labels, num_classes=self.n_classes)
         self.translation_index = np.random.choice(len(self._labels), length)
+        if shared_memory:
+            self._shared = {
+                'data': out,
+                'one_hot': SharedArray.from_array(self._one_hot, prefix='fake-labels'),
+                'translation_index': SharedArray.from_array(self.translation_index,
+                                                            prefix='fake-index'),
+            }
+            self._data = self._one_hot = self.translation_index = None
+        else:
+            self._data.flags.writeable = False
+            self._one_hot.flags.writeable = False
+
+    def _pool(self):
+        """ Returns the image pool, one hot labels and translation index
+        """
+        if self.shared_memory:
+            return (self._shared['data'].array,
+                    self._shared['one_hot'].array,
+                    self._shared['translation_index'].array)
+        return self._data, self._one_hot, self.translation_index
+
+
+    def _get_batches_of_transformed_samples(self, index_array):
+        data, one_hot, translation_index = self._pool()
+        if self.low_memory:
+            # Pick a batch of the pool from the first index, which is random when shuffling
+            start = (index_array[0] // self.batch_size % self.num_batches) * self.batch_size
+            end = start + len(index_array)
+            return data[start:end], one_hot[start:end]
+        tr_index_array = translation_index[index_array]
+        return data[tr_index_array], one_hot[tr_index_array]
+
+
+class ShardDataGenerator(keras.preprocessing.image.Iterator):
+    """ Reads images from shards written by shards.py rather than from a directory
+
+    Images are augmented with image_data_generator in the same way as
+    ImageDataGenerator.flow_from_directory does.
+    """
+
+    def __init__(self,
+                 data_dir,
+                 name,
+                 image_data_generator,
+                 target_size=(224, 224),
+                 batch_size=32,
+                 shuffle=True,
+                 seed=None):
+        self._reader = ShardReader(data_dir, name)
+        self.image_data_generator = image_data_generator
+        self.target_size = tuple(target_size)
+        self.num_classes = len(self._reader.classes)
+        self.classes = self._reader.labels
+        super(ShardDataGenerator, self).__init__(len(self._reader),
+                                                 batch_size,
+                                                 shuffle,
+                                                 seed)
+
+    def _load_image(self, idx):
+        data, _ = self._reader.read(idx)
+        img = Image.open(BytesIO(data)).convert('RGB')
+        # PIL takes (width, height)
+        img = img.resize((self.target_size[1], self.target_size[0]), Image.NEAREST)
+        return np.asarray(img, dtype=K.floatx())
 
+    def _get_batches_of_transformed_samples(self, index_array):
+        batch_x = np.zeros((len(index_array),) + self.target_size + (3,), dtype=K.floatx())
+        for i, j in enumerate(index_array):
+            x = self.image_data_generator.random_transform(self._load_image(j))
+            batch_x[i] = self.image_data_generator.standardize(x)
+        batch_y = keras.utils.to_categorical(self.classes[index_array], num_classes=self.num_classes)
+        return batch_x, batch_y
+
+
+class CacheDataGenerator(keras.preprocessing.image.Iterator):
+    """ Reads decoded and resized images from a cache written by image_cache.py
+
+    When training each image is randomly cropped and flipped, otherwise the centre
+    crop is taken. preprocessing_function is applied to the whole batch.
+    """
+
+    def __init__(self,
+                 data_dir,
+                 name,
+                 preprocessing_function=None,
+                 target_size=224,
+                 batch_size=32,
+                 train=True,
+                 shuffle=True,
+                 seed=None):
+        self._cache = ImageCache(data_dir, name)
+        self.preprocessing_function = preprocessing_function
+        self.target_size = target_size
+        self.train = train
+        self.num_classes = len(self._cache.classes)
+        self.classes = self._cache.labels
+        super(CacheDataGenerator, self).__init__(len(self._cache),
+                                                 batch_size,
+                                                 shuffle,
+                                                 seed)
 
     def _get_batches_of_transformed_samples(self, index_array):
-        logger = _get_logger()
-        logger.debug('Retrieving samples')
-        logger.debug(str(index_array))
-        tr_index_array = self.translation_index[index_array]
-        return self._data[tr_index_array], keras.utils.to_categorical(self._labels[tr_index_array], num_classes=self.n_classes)
\ No newline at end of file
+        size = self.target_size
+        batch_x = np.empty((len(index_array), size, size, 3), dtype=K.floatx())
+        for i, j in enumerate(index_array):
+            if self.train:
+                batch_x[i] = self._cache.random_crop(j, size)
+            else:
+                batch_x[i] = self._cache.centre_crop(j, size)
+        if self.preprocessing_function is not None:
+            batch_x = self.preprocessing_function(batch_x)
+        batch_y = keras.utils.to_categorical(self.classes[index_array], num_classes=self.num_classes)
+        return batch_x, batch_y
+
+
+class ShardedSequence(keras.utils.Sequence):
+    """ Gives each rank every num_replicas-th batch of a Sequence, starting at its rank
+
+    Every batch goes to exactly one rank, so results summed across the ranks cover
+    the whole sequence once. The sequence must not be shuffled, otherwise the ranks
+    would disagree on what each batch holds.
+    """
+
+    def __init__(self, sequence, num_replicas=1, rank=0):
+        self.sequence = sequence
+        self._batches = range(rank, len(sequence), num_replicas)
+
+    def __len__(self):
+        return len(self._batches)
+
+    def __getitem__(self, index):
+        return self.sequence[self._batches[index]]
+
+    @property
+    def samples(self):
+        """ Number of samples in this rank's batches of a keras Iterator """
+        n, batch_size = self.sequence.n, self.sequence.batch_size
+        return sum(min(batch_size, n - i * batch_size) for i in self._batches)
+
+    def on_epoch_end(self):
+        self.sequence.on_epoch_end()
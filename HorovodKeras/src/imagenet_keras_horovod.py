@@ -7,17 +7,25 @@ AZ_BATCHAI_INPUT_TEST
 AZ_BATCHAI_OUTPUT_MODEL
 AZ_BATCHAI_JOB_TEMP_DIR
 """
-import logging
 import os
-import sys
+from checkpoint import AsyncCheckpointWriter, latest_checkpoint
 from functools import lru_cache
+from rank_logging import get_logger, set_rank
 from timer import Timer
 
 import keras
+import numpy as np
 import tensorflow as tf
-from data_generator import FakeDataGenerator
+from data_generator import (
+    CacheDataGenerator,
+    FakeDataGenerator,
+    ShardDataGenerator,
+    ShardedSequence,
+)
 from keras import backend as K
 from keras.preprocessing import image
+from step_metrics import StepMetrics
+from straggler import StragglerMonitor
 
 
 def _str_to_bool(in_str):
@@ -31,7 +39,7 @@ _WIDTH = 224
 _HEIGHT = 224
 _CHANNELS = 3
 _LR = 0.001
-_EPOCHS = os.getenv("EPOCHS", 1)
+_EPOCHS = int(os.getenv("EPOCHS", 1))
 _BATCHSIZE = 64
 _R_MEAN = 123.68
 _G_MEAN = 116.78
@@ -49,11 +57,26 @@ _FAKE = _str_to_bool(os.getenv("FAKE", "False"))
 _DATA_LENGTH = int(
     os.getenv("FAKE_DATA_LENGTH", 1281167)
 )  # How much fake data to simulate, default to size of imagenet dataset
+_FAKE_LOW_MEMORY = _str_to_bool(os.getenv("FAKE_LOW_MEMORY", "False"))
 _VALIDATION = _str_to_bool(os.getenv("VALIDATION", "False"))
+_DATA_FORMAT = os.getenv("DATA_FORMAT", "images")  # images, shards or cache
+_KEEP_CHECKPOINTS = int(os.getenv("KEEP_CHECKPOINTS", 5))
+# Steps between the checks for ranks that are slower than the others, 0 to disable
+_STRAGGLER_STEPS = int(os.getenv("STRAGGLER_STEPS", 100))
+_COMPRESSION = os.getenv("COMPRESSION", "none")  # none, fp16 or topk
+_TOPK_RATIO = float(os.getenv("TOPK_RATIO", 0.01))
+# Number of batches whose gradients are summed locally before each allreduce and update
+_ACCUMULATION_STEPS = int(os.getenv("ACCUMULATION_STEPS", 1))
+# Train in float16 with float32 master weights, on the GPU only since TensorFlow has
+# no half precision convolutions on the CPU
+_MIXED_PRECISION = _str_to_bool(os.getenv("MIXED_PRECISION", "False"))
+# Directory for the rank-<rank>.jsonl logs, only rank 0 prints to stdout if set
+_LOG_DIR = os.getenv("LOG_DIR")
 
 
 if _DISTRIBUTED:
     import horovod.keras as hvd
+    import horovod.tensorflow as hvd_tf
 
 
 def _get_rank():
@@ -66,37 +89,65 @@ def _get_rank():
         return 0
 
 
-class HorovodAdapter(logging.LoggerAdapter):
-    def __init__(self, logger):
-        self._str_epoch = ""
-        self._gpu_rank = 0
-        super(HorovodAdapter, self).__init__(logger, {})
+@lru_cache()
+def _get_logger():
+    return get_logger(__name__)
 
-    def set_epoch(self, epoch):
-        self._str_epoch = "[Epoch {}]".format(epoch)
 
-    def process(self, msg, kwargs):
-        kwargs["extra"] = {"gpurank": _get_rank(), "epoch": self._str_epoch}
-        return msg, kwargs
+def _compute_dtype():
+    if _MIXED_PRECISION and tf.test.is_built_with_cuda():
+        return "float16"
+    return "float32"
 
 
-@lru_cache()
-def _get_logger():
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
-    ch = logging.StreamHandler(stream=sys.stdout)
-    formatter = logging.Formatter(
-        "%(levelname)s:%(name)s:%(gpurank)d: %(epoch)s %(message)s"
-    )
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
-    adapter = HorovodAdapter(logger)
-    return adapter
+class Float32L2(keras.regularizers.L1L2):
+    """ L2 regularization of half precision weights computed in float32 """
+
+    def __call__(self, x):
+        return super(Float32L2, self).__call__(K.cast(x, "float32"))
 
 
-def _create_model():
+class Float32BatchNormalization(keras.layers.BatchNormalization):
+    """ Batch normalization of half precision inputs with float32 weights """
+
+    def build(self, input_shape):
+        floatx = K.floatx()
+        K.set_floatx("float32")
+        try:
+            super(Float32BatchNormalization, self).build(input_shape)
+        finally:
+            K.set_floatx(floatx)
+
+    def call(self, inputs, training=None):
+        outputs = super(Float32BatchNormalization, self).call(
+            K.cast(inputs, "float32"), training=training
+        )
+        return K.cast(outputs, K.dtype(inputs))
+
+
+def _create_model(dtype=None):
+    """ Creates ResNet-50 computing in dtype, by default _compute_dtype()
+
+    In float16 the weights other than the batch norm ones are float16 too and the
+    optimizer keeps float32 copies of them, see _mixed_precision_optimizer.
+    """
     logger = _get_logger()
     logger.info("Creating model")
+    dtype = _compute_dtype() if dtype is None else dtype
+    floatx = K.floatx()
+    K.set_floatx(dtype)
+    try:
+        model = _create_resnet50(mixed_precision=dtype != floatx)
+    finally:
+        K.set_floatx(floatx)
+    if dtype != floatx:
+        # Compute the loss and the metrics in float32
+        outputs = keras.layers.Lambda(lambda x: K.cast(x, floatx))(model.output)
+        model = keras.models.Model(model.input, outputs)
+    return model
+
+
+def _create_resnet50(mixed_precision=False):
     # Set up standard ResNet-50 model.
     model = keras.applications.resnet50.ResNet50(weights=None)
     # ResNet-50 model that is included with Keras is optimized for inference.
@@ -106,33 +157,78 @@ def _create_model():
         if hasattr(layer, "kernel_regularizer"):
             regularizer = keras.regularizers.l2(_WEIGHT_DECAY)
             layer_config["config"]["kernel_regularizer"] = {
-                "class_name": regularizer.__class__.__name__,
+                "class_name": (
+                    "Float32L2" if mixed_precision else regularizer.__class__.__name__
+                ),
                 "config": regularizer.get_config(),
             }
         if type(layer) == keras.layers.BatchNormalization:
             layer_config["config"]["momentum"] = 0.9
             layer_config["config"]["epsilon"] = 1e-5
-    model = keras.models.Model.from_config(model_config)
-    return model
+    if mixed_precision:
+        custom_objects = {
+            "Float32L2": Float32L2,
+            "BatchNormalization": Float32BatchNormalization,
+        }
+    else:
+        custom_objects = None
+    return keras.models.Model.from_config(model_config, custom_objects=custom_objects)
+
+
+def _directory_iterator_from(
+    data_dir, name, image_gen, shuffle=True, data_format=_DATA_FORMAT
+):
+    if data_format == "shards":
+        return ShardDataGenerator(
+            data_dir,
+            name,
+            image_gen,
+            target_size=(224, 224),
+            batch_size=_BATCHSIZE,
+            shuffle=shuffle,
+        )
+    else:
+        return image_gen.flow_from_directory(
+            data_dir, batch_size=_BATCHSIZE, target_size=(224, 224), shuffle=shuffle
+        )
+
+
+def _cache_iterator_from(data_dir, name, train):
+    return CacheDataGenerator(
+        data_dir,
+        name,
+        preprocessing_function=keras.applications.resnet50.preprocess_input,
+        target_size=224,
+        batch_size=_BATCHSIZE,
+        train=train,
+        shuffle=train,
+    )
 
 
 def _validation_data_iterator_from():
     # Validation data iterator.
+    if _DATA_FORMAT == "cache":
+        return _cache_iterator_from(
+            os.getenv("AZ_BATCHAI_INPUT_TEST"), "validation", train=False
+        )
 
     test_gen = image.ImageDataGenerator(
         zoom_range=(0.875, 0.875),
         preprocessing_function=keras.applications.resnet50.preprocess_input,
     )
-    test_iter = test_gen.flow_from_directory(
-        os.getenv("AZ_BATCHAI_INPUT_TEST"),
-        batch_size=_BATCHSIZE,
-        target_size=(224, 224),
+    # Not shuffled so that every rank agrees on which images are in each batch
+    test_iter = _directory_iterator_from(
+        os.getenv("AZ_BATCHAI_INPUT_TEST"), "validation", test_gen, shuffle=False
     )
     return test_iter
 
 
 def _training_data_iterator_from():
     # Training data iterator.
+    if _DATA_FORMAT == "cache":
+        return _cache_iterator_from(
+            os.getenv("AZ_BATCHAI_INPUT_TRAIN"), "train", train=True
+        )
     train_gen = image.ImageDataGenerator(
         width_shift_range=0.33,
         height_shift_range=0.33,
@@ -140,30 +236,345 @@ def _training_data_iterator_from():
         horizontal_flip=True,
         preprocessing_function=keras.applications.resnet50.preprocess_input,
     )
-    train_iter = train_gen.flow_from_directory(
-        os.getenv("AZ_BATCHAI_INPUT_TRAIN"),
-        batch_size=_BATCHSIZE,
-        target_size=(224, 224),
+    train_iter = _directory_iterator_from(
+        os.getenv("AZ_BATCHAI_INPUT_TRAIN"), "train", train_gen
     )
     return train_iter
 
 
 def _fake_data_iterator_from(length=_DATA_LENGTH):
-    return FakeDataGenerator(batch_size=_BATCHSIZE, n_classes=1000, length=length)
+    return FakeDataGenerator(
+        batch_size=_BATCHSIZE,
+        n_classes=1000,
+        length=length,
+        low_memory=_FAKE_LOW_MEMORY,
+        # Share the pool between the fit_generator worker processes
+        shared_memory=_MULTIPROCESSING,
+    )
 
 
-def _get_optimizer(params, is_distributed=_DISTRIBUTED):
-    if is_distributed:
-        # Horovod: adjust learning rate based on number of GPUs.
-        opt = keras.optimizers.SGD(
-            lr=params["learning_rate"] * hvd.size(), momentum=params["momentum"]
+def _topk_compress(tensor, residual, ratio=_TOPK_RATIO):
+    """ Selects the largest ratio of the elements of tensor plus residual by magnitude
+
+    The elements that are not sent are kept in residual and added to the next
+    gradient (error feedback), so every update is applied eventually.
+
+    Returns:
+        the values and the indices of the selected elements in the flattened tensor,
+        both depend on the update of residual
+    """
+    accumulated = tf.reshape(tensor, [-1]) + residual
+    k = max(1, int(accumulated.shape.num_elements() * ratio))
+    _, indices = tf.nn.top_k(tf.abs(accumulated), k=k, sorted=False)
+    values = tf.gather(accumulated, indices)
+    sent = tf.scatter_nd(tf.expand_dims(indices, 1), values, tf.shape(accumulated))
+    with tf.control_dependencies([tf.assign(residual, accumulated - sent)]):
+        return tf.identity(values), tf.identity(indices)
+
+
+def _topk_decompress(values, indices, shape):
+    """ Sums values into a zero tensor of the given shape at the flattened indices """
+    dense = tf.unsorted_segment_sum(values, indices, num_segments=shape.num_elements())
+    return tf.reshape(dense, shape)
+
+
+def _topk_allreduce(gradient, param, ratio=_TOPK_RATIO):
+    """ Averages gradient across the ranks sending only its top-k elements
+
+    Horovod's allreduce can only sum dense tensors, so every rank allgathers the
+    values and indices of its top-k elements and sums them into the dense gradient.
+    """
+    # The initial value is a callable since with ACCUMULATION_STEPS the allreduce is
+    # built inside a tf.cond
+    residual = tf.Variable(
+        lambda: tf.zeros((K.count_params(param),), dtype=K.dtype(param)),
+        trainable=False,
+        name="topk_residual",
+    )
+    values, indices = _topk_compress(gradient, residual, ratio=ratio)
+    values, indices = hvd_tf.allgather(values), hvd_tf.allgather(indices)
+    return _topk_decompress(values, indices, gradient.shape) / hvd.size()
+
+
+class _TopKDistributedOptimizer(keras.optimizers.Optimizer):
+    """ Mixed into the class of the wrapped optimizer by _topk_distributed_optimizer
+    """
+
+    def get_gradients(self, loss, params):
+        gradients = super(self.__class__, self).get_gradients(loss, params)
+        return [
+            _topk_allreduce(gradient, param, self._topk_ratio)
+            for gradient, param in zip(gradients, params)
+        ]
+
+
+def _topk_distributed_optimizer(optimizer, ratio=_TOPK_RATIO):
+    """ Wraps optimizer like hvd.DistributedOptimizer, averaging the gradients with
+    _topk_allreduce
+    """
+    cls = type(
+        optimizer.__class__.__name__,
+        (optimizer.__class__,),
+        dict(_TopKDistributedOptimizer.__dict__),
+    )
+    distributed = cls(**optimizer.get_config())
+    distributed._topk_ratio = ratio
+    return distributed
+
+
+def _get_compression(compression=_COMPRESSION):
+    """ Horovod compression for the allreduce of the gradients, topk is done by
+    _topk_distributed_optimizer instead
+    """
+    if compression not in ("none", "fp16", "topk"):
+        raise ValueError("Unknown COMPRESSION {}".format(compression))
+    return hvd.Compression.fp16 if compression == "fp16" else hvd.Compression.none
+
+
+def _get_allreduce(compression=_COMPRESSION):
+    """ Returns allreduce(gradient, param), which averages gradient across the ranks
+    """
+    if compression == "topk":
+        return _topk_allreduce
+    hvd_compression = _get_compression(compression)
+    return lambda gradient, param: hvd_tf.allreduce(
+        gradient, compression=hvd_compression
+    )
+
+
+def _gated_updates(updates, apply):
+    """ Rebuilds the updates of a Keras optimizer so that they only change their
+    variables when apply is true
+
+    The optimizer has to build its updates outside of a tf.cond, since the variables
+    it creates, such as the momentum, can not be initialized from inside one, and
+    assign ops that have already been built can not be moved under a tf.cond. So each
+    K.update, K.update_add and K.update_sub is rebuilt to assign tf.where(apply, new
+    value, old value) and the original ops are never run.
+    """
+    gated = []
+    for update in updates:
+        op = update if isinstance(update, tf.Operation) else update.op
+        variable, value = op.inputs[0], op.inputs[1]
+        if op.type == "Assign":
+            new_value = value
+        elif op.type == "AssignAdd":
+            new_value = variable + value
+        elif op.type == "AssignSub":
+            new_value = variable - value
+        else:
+            raise ValueError("Can not gate the {} update {}".format(op.type, op.name))
+        gated.append(tf.assign(variable, tf.where(apply, new_value, variable)))
+    return gated
+
+
+class _AccumulatingOptimizer(keras.optimizers.Optimizer):
+    """ Mixed into the class of the wrapped optimizer by _accumulating_optimizer
+    """
+
+    def get_gradients(self, loss, params):
+        if self._accumulated is not None:
+            return self._accumulated
+        return super(self.__class__, self).get_gradients(loss, params)
+
+    def get_updates(self, loss, params):
+        gradients = self.get_gradients(loss, params)
+        accumulators = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        count = K.variable(0, dtype="int64", name="accumulation_count")
+        accumulate = [tf.assign_add(a, g) for a, g in zip(accumulators, gradients)]
+        with tf.control_dependencies(accumulate):
+            count = tf.assign_add(count, 1)
+        apply = tf.equal(count % self._accumulation_steps, 0)
+
+        def _mean():
+            mean = [a / self._accumulation_steps for a in accumulators]
+            if self._accumulation_allreduce is not None:
+                mean = [
+                    self._accumulation_allreduce(g, p) for g, p in zip(mean, params)
+                ]
+            return mean
+
+        # Only the allreduce is under the tf.cond, so it runs every steps-th batch
+        self._accumulated = tf.cond(
+            apply, _mean, lambda: [tf.zeros_like(a) for a in accumulators]
         )
-        # Horovod: add Horovod Distributed Optimizer.
-        return hvd.DistributedOptimizer(opt)
-    else:
-        return keras.optimizers.SGD(
-            lr=params["learning_rate"], momentum=params["momentum"]
+        if not isinstance(self._accumulated, (list, tuple)):
+            self._accumulated = [self._accumulated]
+        # The wrapped optimizer builds its updates from the mean of the accumulated
+        # gradients returned by get_gradients
+        updates = _gated_updates(
+            super(self.__class__, self).get_updates(loss, params), apply
+        )
+        self._accumulated = None
+        with tf.control_dependencies(updates):
+            reset = [
+                tf.assign(a, tf.where(apply, tf.zeros_like(a), a)) for a in accumulators
+            ]
+        return [tf.group(*reset)]
+
+
+def _accumulating_optimizer(optimizer, steps=_ACCUMULATION_STEPS, allreduce=None):
+    """ Wraps optimizer so that it sums the gradients of steps batches and applies
+    their mean every steps-th batch
+
+    allreduce(gradient, param) averages the mean across the ranks before it is
+    applied, so there is one allreduce per steps batches.
+    """
+    cls = type(
+        optimizer.__class__.__name__,
+        (optimizer.__class__,),
+        dict(_AccumulatingOptimizer.__dict__),
+    )
+    accumulating = cls(**optimizer.get_config())
+    accumulating._accumulation_steps = steps
+    accumulating._accumulation_allreduce = allreduce
+    accumulating._accumulated = None
+    return accumulating
+
+
+class _MixedPrecisionOptimizer(keras.optimizers.Optimizer):
+    """ Mixed into the class of the wrapped optimizer by _mixed_precision_optimizer
+    """
+
+    def get_gradients(self, loss, params):
+        if self._master_gradients is not None:
+            return self._master_gradients
+        return super(self.__class__, self).get_gradients(loss, params)
+
+    def get_updates(self, loss, params):
+        scale = K.variable(self._init_scale, dtype="float32", name="loss_scale")
+        good_steps = K.variable(0, dtype="int64", name="good_steps")
+        master_params = [
+            tf.Variable(tf.cast(p.initialized_value(), tf.float32), trainable=False)
+            for p in params
+        ]
+        gradients = [
+            tf.cast(g, tf.float32) / scale
+            for g in super(self.__class__, self).get_gradients(loss * scale, params)
+        ]
+        if self._mixed_precision_allreduce is not None:
+            gradients = [
+                self._mixed_precision_allreduce(g, p)
+                for g, p in zip(gradients, master_params)
+            ]
+        # The gradients are the same on every rank after the allreduce, so every rank
+        # skips the same steps
+        finite = tf.reduce_all([tf.reduce_all(tf.is_finite(g)) for g in gradients])
+
+        # The wrapped optimizer updates the master weights with the unscaled
+        # gradients returned by get_gradients, a step that overflowed leaves them as
+        # they are
+        self._master_gradients = gradients
+        master_updates = _gated_updates(
+            super(self.__class__, self).get_updates(loss, master_params), finite
         )
+        self._master_gradients = None
+        with tf.control_dependencies(master_updates):
+            update = tf.group(
+                *[
+                    tf.assign(p, tf.cast(m, p.dtype))
+                    for p, m in zip(params, master_params)
+                ]
+            )
+        with tf.control_dependencies([update]):
+            good = tf.where(finite, good_steps + 1, tf.zeros_like(good_steps))
+            grow = tf.equal(good, self._scale_window)
+            new_scale = tf.where(
+                finite,
+                tf.where(grow, scale * self._scale_factor, scale),
+                tf.maximum(scale / self._scale_factor, 1.0),
+            )
+            update_scale = tf.group(
+                tf.assign(scale, new_scale),
+                tf.assign(good_steps, tf.where(grow, tf.zeros_like(good), good)),
+            )
+        # Checkpoint the loss scale and the master weights with the optimizer state
+        self.weights = self.weights + [scale, good_steps] + master_params
+        return [update_scale]
+
+
+def _mixed_precision_optimizer(
+    optimizer, allreduce=None, init_scale=2.0 ** 15, scale_factor=2.0, scale_window=2000
+):
+    """ Wraps optimizer so that it updates float32 copies of the half precision
+    weights and scales the loss so that small gradients do not flush to zero
+
+    The gradients are divided by the scale again before they are applied. A step
+    whose gradients overflow is skipped and halves the scale, which doubles again
+    after scale_window steps without an overflow. allreduce(gradient, param)
+    averages the gradients across the ranks.
+    """
+    cls = type(
+        optimizer.__class__.__name__,
+        (optimizer.__class__,),
+        dict(_MixedPrecisionOptimizer.__dict__),
+    )
+    mixed = cls(**optimizer.get_config())
+    mixed._mixed_precision_allreduce = allreduce
+    mixed._init_scale = init_scale
+    mixed._scale_factor = scale_factor
+    mixed._scale_window = scale_window
+    mixed._master_gradients = None
+    return mixed
+
+
+def _get_optimizer(params, is_distributed=_DISTRIBUTED):
+    num_gpus = hvd.size() if is_distributed else 1
+    # Horovod: adjust learning rate based on number of GPUs and the accumulated
+    # batches.
+    opt = keras.optimizers.SGD(
+        lr=params["learning_rate"] * num_gpus * _ACCUMULATION_STEPS,
+        momentum=params["momentum"],
+    )
+    allreduce = _get_allreduce() if is_distributed else None
+    if _compute_dtype() == "float16":
+        if _ACCUMULATION_STEPS > 1:
+            raise ValueError(
+                "MIXED_PRECISION and ACCUMULATION_STEPS can not be combined in Keras"
+            )
+        return _mixed_precision_optimizer(opt, allreduce=allreduce)
+    if _ACCUMULATION_STEPS > 1:
+        return _accumulating_optimizer(opt, allreduce=allreduce)
+    if not is_distributed:
+        return opt
+    compression = _get_compression()
+    if _COMPRESSION == "topk":
+        return _topk_distributed_optimizer(opt)
+    # Horovod: add Horovod Distributed Optimizer.
+    return hvd.DistributedOptimizer(opt, compression=compression)
+
+
+def _snapshot(model):
+    """ Copies the model and optimizer weights to host memory """
+    snapshot = {}
+    for prefix, weights in (
+        ("model", model.get_weights()),
+        ("optimizer", model.optimizer.get_weights()),
+    ):
+        for i, w in enumerate(weights):
+            snapshot["{}_{}".format(prefix, i)] = w
+    return snapshot
+
+
+def _save_snapshot(snapshot, f):
+    np.savez(f, **snapshot)
+
+
+def _arrays_from(npz, prefix):
+    count = sum(1 for key in npz.files if key.startswith(prefix + "_"))
+    return [npz["{}_{}".format(prefix, i)] for i in range(count)]
+
+
+def _load_snapshot(model, filename):
+    """ Restores the model and optimizer weights saved by AsyncModelCheckpoint
+
+    The model has to be compiled with the same optimizer as when it was saved.
+    """
+    with np.load(filename) as npz:
+        model.set_weights(_arrays_from(npz, "model"))
+        # The optimizer only creates its weights when the training function is built
+        model._make_train_function()
+        model.optimizer.set_weights(_arrays_from(npz, "optimizer"))
 
 
 def _get_runconfig(is_distributed=_DISTRIBUTED):
@@ -244,6 +655,92 @@ class LoggerCallback(keras.callbacks.Callback):
         _log_summary(self._data_length, duration)
 
 
+class AsyncModelCheckpoint(keras.callbacks.Callback):
+    """ Saves the model and optimizer weights at the end of every epoch
+
+    Unlike ModelCheckpoint, which serializes HDF5 to storage while the other ranks wait
+    at the next allreduce, only the copy of the weights happens on the training thread
+    and AsyncCheckpointWriter writes them in the background.
+    """
+
+    def __init__(self, checkpoint_format, keep=_KEEP_CHECKPOINTS):
+        super(AsyncModelCheckpoint, self).__init__()
+        self._writer = AsyncCheckpointWriter(
+            checkpoint_format, _save_snapshot, keep=keep
+        )
+
+    def on_epoch_end(self, epoch, logs=None):
+        self._writer.write(epoch + 1, _snapshot(self.model))
+
+    def on_train_end(self, logs=None):
+        self._writer.close()
+
+
+def _create_straggler_monitor(
+    logger, every=_STRAGGLER_STEPS, is_distributed=_DISTRIBUTED
+):
+    """ Returns a StragglerMonitor or None if there is a single rank
+
+    The ranks wait for each other in the compute phase, which includes the allreduce,
+    so only the time waiting for data is compared and only input bound stragglers
+    are found.
+    """
+    if not is_distributed or every <= 0:
+        return None
+    # The allgather op is created once, hvd.allgather would add one to the graph for
+    # every check
+    values = tf.placeholder(tf.float64, shape=(1, None))
+    gathered = hvd_tf.allgather(values)
+
+    def allgather(array):
+        return K.get_session().run(gathered, feed_dict={values: array[None]})
+
+    return StragglerMonitor(
+        allgather,
+        every=every,
+        input_phases=("data",),
+        wait_phases=("compute",),
+        rank=hvd.rank(),
+        logger=logger,
+    )
+
+
+class StepMetricsCallback(keras.callbacks.Callback):
+    """ Records the time each batch waits for data and spends in train_on_batch
+
+    The compute phase covers the forward and backward passes, the allreduce and the
+    optimizer update since Keras runs them all in a single session call.
+    """
+
+    def __init__(self, logger, batch_size, log_every=100):
+        super(StepMetricsCallback, self).__init__()
+        self._logger = logger
+        self._batch_size = batch_size
+        self._log_every = log_every
+        self._metrics = None
+        self._straggler_monitor = _create_straggler_monitor(logger)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._metrics = StepMetrics(
+            self._batch_size, phases=("data", "compute"), rank=_get_rank()
+        )
+        self._metrics.start()
+
+    def on_batch_begin(self, batch, logs=None):
+        self._metrics.mark("data")
+
+    def on_batch_end(self, batch, logs=None):
+        self._metrics.mark("compute")
+        self._metrics.end_step((logs or {}).get("size"))
+        if self._straggler_monitor is not None:
+            self._straggler_monitor.update(self._metrics)
+        if batch % self._log_every == 0:
+            self._logger.info(self._metrics.format())
+        # The straggler check waits for the other ranks, neither it nor the logging
+        # is part of a step
+        self._metrics.skip()
+
+
 def _is_master(is_distributed=_DISTRIBUTED):
     if is_distributed:
         if hvd.rank() == 0:
@@ -254,6 +751,37 @@ def _is_master(is_distributed=_DISTRIBUTED):
         return True
 
 
+def _evaluate(model, test_iter, is_distributed=_DISTRIBUTED):
+    """ Evaluates this rank's shard of test_iter and returns the loss, top-1 and
+    top-5 accuracy over the whole validation set
+    """
+    logger = _get_logger()
+    if is_distributed:
+        shard = ShardedSequence(test_iter, num_replicas=hvd.size(), rank=hvd.rank())
+    else:
+        shard = ShardedSequence(test_iter)
+    if len(shard):
+        score = model.evaluate_generator(
+            shard,
+            len(shard),
+            workers=_NUM_WORKERS,
+            use_multiprocessing=_MULTIPROCESSING,
+        )
+    else:
+        score = [0.0, 0.0, 0.0]
+    # evaluate_generator averages over the samples, turn them back into sums
+    totals = np.append(np.asarray(score, dtype=np.float64), 1.0) * shard.samples
+    if is_distributed:
+        totals = hvd.allreduce(totals, average=False, name="validation_totals")
+    loss, top1, top5 = totals[:3] / max(totals[3], 1)
+    logger.info(
+        "Validation loss: {:.4f} top-1: {:.4f} top-5: {:.4f} images: {}".format(
+            loss, top1, top5, int(totals[3])
+        )
+    )
+    return loss, top1, top5
+
+
 def _log_summary(data_length, duration):
     logger = _get_logger()
     images_per_second = data_length / duration
@@ -265,6 +793,8 @@ def _log_summary(data_length, duration):
             _BATCHSIZE, hvd.size() * _BATCHSIZE if _DISTRIBUTED else _BATCHSIZE
         )
     )
+    logger.info("Accumulation:     {}".format(_ACCUMULATION_STEPS))
+    logger.info("Precision:        {}".format(_compute_dtype()))
     logger.info("Distributed:      {}".format("True" if _DISTRIBUTED else "False"))
     logger.info("Num GPUs:         {:.3f}".format(hvd.size() if _DISTRIBUTED else 1))
     logger.info("Dataset:          {}".format("Synthetic" if _FAKE else "Imagenet"))
@@ -276,15 +806,24 @@ def main():
     if _DISTRIBUTED:
         # Horovod: initialize Horovod.
         hvd.init()
+        set_rank(_get_rank(), log_dir=_LOG_DIR)
         logger.info("Runnin Distributed")
         verbose = 1 if hvd.rank() == 0 else 0
+    else:
+        set_rank(_get_rank(), log_dir=_LOG_DIR)
 
     logger.info("Tensorflow version {}".format(tf.__version__))
+    logger.info("Keras version {}".format(keras.__version__))
     K.set_session(tf.Session(config=_get_runconfig()))
 
+    model_dir = _get_model_dir()
+    checkpoint_format = os.path.join(model_dir, "checkpoint-{epoch}.npz")
+
     # Horovod: broadcast resume_from_epoch from rank 0 (which will have
     # checkpoints) to other ranks.
     resume_from_epoch = 0
+    if _is_master():
+        resume_from_epoch, _ = latest_checkpoint(checkpoint_format)
     if _DISTRIBUTED:
         resume_from_epoch = hvd.broadcast(
             resume_from_epoch, 0, name="resume_from_epoch"
@@ -307,27 +846,27 @@ def main():
         metrics=["accuracy", "top_k_categorical_accuracy"],
     )
 
-    model_dir = _get_model_dir()
-    checkpoint_format = os.path.join(model_dir, "checkpoint-{epoch}.h5")
+    # Restore from a previous checkpoint, if initial_epoch is specified.
+    # Horovod: restore on the first worker which will broadcast the weights and the
+    # optimizer state to the other workers in BroadcastGlobalVariablesCallback.
+    if resume_from_epoch > 0 and _is_master():
+        filename = checkpoint_format.format(epoch=resume_from_epoch)
+        logger.info("Resuming from {}".format(filename))
+        _load_snapshot(model, filename)
 
     callbacks = _get_hooks()
     callbacks.append(LoggerCallback(logger, len(train_iter) * _BATCHSIZE))
+    callbacks.append(StepMetricsCallback(logger, _BATCHSIZE))
 
     # Horovod: save checkpoints only on the first worker to prevent other workers from corrupting them.
     if _is_master():
-        callbacks.append(keras.callbacks.ModelCheckpoint(checkpoint_format))
+        callbacks.append(AsyncModelCheckpoint(checkpoint_format))
         # callbacks.append(keras.callbacks.TensorBoard(log_dir))
 
-    # Restore from a previous checkpoint, if initial_epoch is specified.
-    # Horovod: restore on the first worker which will broadcast weights to other workers.
-    if resume_from_epoch > 0 and _is_master():
-        model.load_weights(checkpoint_format.format(epoch=resume_from_epoch))
-
     logger.info("Training...")
-    # Train the model. The training will randomly sample 1 / N batches of training data and
-    # 3 / N batches of validation data on every worker, where N is the number of workers.
-    # Over-sampling of validation data helps to increase probability that every validation
-    # example will be evaluated.
+    # Train the model. The training will randomly sample 1 / N batches of training data
+    # on every worker, where N is the number of workers. Validation is split between
+    # the workers afterwards, see _evaluate.
     num_workers = hvd.size() if _DISTRIBUTED else 1
     model.fit_generator(
         train_iter,
@@ -342,15 +881,10 @@ def main():
     )
 
     if _FAKE is False and _VALIDATION:
-        # Evaluate the model on the full data set.
+        # Evaluate the model on the full data set, split between the ranks.
         with Timer(output=logger.info, prefix="Testing"):
             logger.info("Testing...")
-            score = hvd.allreduce(
-                model.evaluate_generator(test_iter, len(test_iter), workers=10)
-            )
-            if verbose:
-                print("Test loss:", score[0])
-            print("Test accuracy:", score[1])
+            _evaluate(model, test_iter)
 
 
 if __name__ == "__main__":
@@ -7,20 +7,26 @@ AZ_BATCHAI_INPUT_TEST
 AZ_BATCHAI_OUTPUT_MODEL
 AZ_BATCHAI_JOB_TEMP_DIR
 """
-import logging
 import os
-import sys
+from checkpoint import AsyncCheckpointWriter, latest_checkpoint
 from functools import lru_cache
+from image_cache import ImageCache
+from rank_logging import get_logger, set_rank
 from os import path
+from shards import MappedShardReader
+from step_metrics import StepMetrics
+from straggler import StragglerMonitor
 from timer import Timer
 
 import numpy as np
 import pandas as pd
 import torch.backends.cudnn as cudnn
+import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import torch.utils.data.distributed
 import torchvision.models as models
+from PIL import Image
 from torch.utils.data import Dataset
 from torchvision import transforms, datasets
 
@@ -36,7 +42,7 @@ _WIDTH = 224
 _HEIGHT = 224
 _CHANNELS = 3
 _LR = 0.001
-_EPOCHS = os.getenv("EPOCHS", 1)
+_EPOCHS = int(os.getenv("EPOCHS", 1))
 _BATCHSIZE = 64
 _RGB_MEAN = [0.485, 0.456, 0.406]
 _RGB_SD = [0.229, 0.224, 0.225]
@@ -51,8 +57,29 @@ _DATA_LENGTH = int(
     os.getenv("FAKE_DATA_LENGTH", 1281167)
 )  # How much fake data to simulate, default to size of imagenet dataset
 _DISTRIBUTED = _str_to_bool(os.getenv("DISTRIBUTED", "False"))
-
-if _DISTRIBUTED:
+# Run the ranks as CPU processes on this machine with local_horovod.py
+_LOCAL_HOROVOD = _str_to_bool(os.getenv("LOCAL_HOROVOD", "False"))
+# A torchvision model, or tiny for a small network that trains quickly on the CPU
+_MODEL = os.getenv("MODEL", "resnet50")
+_DATA_FORMAT = os.getenv("DATA_FORMAT", "images")  # images, shards or cache
+_BATCH_AUGMENT = _str_to_bool(os.getenv("BATCH_AUGMENT", "False"))
+# Synchronize the GPU at every phase boundary so that the step metrics are exact
+_STEP_METRICS_SYNC = _str_to_bool(os.getenv("STEP_METRICS_SYNC", "False"))
+# Steps between the checks for ranks that are slower than the others, 0 to disable
+_STRAGGLER_STEPS = int(os.getenv("STRAGGLER_STEPS", 100))
+_KEEP_CHECKPOINTS = int(os.getenv("KEEP_CHECKPOINTS", 5))
+_COMPRESSION = os.getenv("COMPRESSION", "none")  # none, fp16 or topk
+_TOPK_RATIO = float(os.getenv("TOPK_RATIO", 0.01))
+# Number of batches whose gradients are summed locally before each allreduce and update
+_ACCUMULATION_STEPS = int(os.getenv("ACCUMULATION_STEPS", 1))
+# Train in float16 on the GPU, bfloat16 on the CPU, with float32 master weights
+_MIXED_PRECISION = _str_to_bool(os.getenv("MIXED_PRECISION", "False"))
+# Directory for the rank-<rank>.jsonl logs, only rank 0 prints to stdout if set
+_LOG_DIR = os.getenv("LOG_DIR")
+
+if _DISTRIBUTED and _LOCAL_HOROVOD:
+    import local_horovod as hvd
+elif _DISTRIBUTED:
     import horovod.torch as hvd
 
 
@@ -67,32 +94,9 @@ def _get_rank():
 
 
 
-class HorovodAdapter(logging.LoggerAdapter):
-    def __init__(self, logger):
-        self._str_epoch = ""
-        self._gpu_rank = 0
-        super(HorovodAdapter, self).__init__(logger, {})
-
-    def set_epoch(self, epoch):
-        self._str_epoch = "[Epoch {}]".format(epoch)
-
-    def process(self, msg, kwargs):
-        kwargs["extra"] = {"gpurank": _get_rank(), "epoch": self._str_epoch}
-        return msg, kwargs
-
-
 @lru_cache()
 def _get_logger():
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
-    ch = logging.StreamHandler(stream=sys.stdout)
-    formatter = logging.Formatter(
-        "%(levelname)s:%(name)s:%(gpurank)d: %(epoch)s %(message)s"
-    )
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
-    adapter = HorovodAdapter(logger)
-    return adapter
+    return get_logger(__name__)
 
 
 def _append_path_to(data_path, data_series):
@@ -143,52 +147,266 @@ def _create_labels(batch_size, num_batches, n_classes):
     return np.random.choice(n_classes, batch_size * num_batches)
 
 
-class FakeData(Dataset):
+class FakeBatches(object):
+    """ Synthetic data that yields ready made batches
+
+    A pool of num_batches batches is created up front, pinned if there is a GPU, and
+    cycled through. There is no per sample work, no collate and no worker processes,
+    so the images/sec measured with it is an upper bound for the real data.
+    """
+
     def __init__(
         self,
-        batch_size=32,
+        batch_size=_BATCHSIZE,
         num_batches=20,
         dim=(224, 224),
         n_channels=3,
-        n_classes=10,
+        n_classes=1000,
         length=_DATA_LENGTH,
-        seed=42,
-        data_transform=None,
+        seed=_SEED,
     ):
-        self.dim = dim
-        self.n_channels = n_channels
-        self.n_classes = n_classes
-        self.num_batches = num_batches
-        self._data = _create_data(
-            batch_size, self.num_batches, self.dim, self.n_channels
+        data = torch.from_numpy(
+            _create_data(batch_size, num_batches, dim, n_channels, seed=seed)
         )
-        self._labels = _create_labels(batch_size, self.num_batches, self.n_classes)
-        self.translation_index = np.random.choice(len(self._labels), length)
+        labels = torch.from_numpy(_create_labels(batch_size, num_batches, n_classes))
+        self._batches = []
+        for i in range(num_batches):
+            batch = (
+                data[i * batch_size : (i + 1) * batch_size],
+                labels[i * batch_size : (i + 1) * batch_size],
+            )
+            if torch.cuda.is_available():
+                batch = tuple(tensor.pin_memory() for tensor in batch)
+            self._batches.append(batch)
+        self.batch_size = batch_size
         self._length = length
 
-        self._data_transform = data_transform
         logger = _get_logger()
         logger.info(
-            "Creating fake data {} labels and {} images".format(
-                n_classes, len(self._data)
+            "Creating fake data {} labels and {} batches of {} images".format(
+                n_classes, num_batches, batch_size
             )
         )
 
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._batches[i % len(self._batches)]
+
+    def __len__(self):
+        """ Number of batches, the same as len() of a DataLoader """
+        return self._length // self.batch_size
+
+
+class ShardDataset(Dataset):
+    """ Reads images from shards written by shards.py rather than from an image folder
+
+    The shards are memory mapped and shared through the page cache by all the
+    DataLoader workers. Samples are decoded straight from the map, the encoded bytes
+    are only copied in the chunks PIL reads.
+    """
+
+    def __init__(self, data_dir, name, transform=None):
+        self._reader = MappedShardReader(data_dir, name)
+        self.classes = self._reader.classes
+        self._transform = transform
+
     def __getitem__(self, idx):
-        logger = _get_logger()
-        logger.debug("Retrieving samples")
-        logger.debug(str(idx))
-        tr_index_array = self.translation_index[idx]
+        f, label = self._reader.open(idx)
+        img = Image.open(f).convert("RGB")
+        if self._transform is not None:
+            img = self._transform(img)
+        return img, label
 
-        if self._data_transform is not None:
-            data = self._data_transform(self._data[tr_index_array])
-        else:
-            data = self._data[tr_index_array]
+    def __len__(self):
+        return len(self._reader)
+
+
+class CacheDataset(Dataset):
+    """ Reads decoded and resized images from a cache written by image_cache.py
+
+    Only the crop, and the flip when training, are left to do for each sample. The
+    cropped images are uint8 HWC arrays which are handed to transform.
+    """
+
+    def __init__(self, data_dir, name, size=_WIDTH, train=True, transform=None):
+        self._cache = ImageCache(data_dir, name)
+        self.classes = self._cache.classes
+        self._size = size or self._cache.size
+        self._train = train
+        self._transform = transform
+        self._random_state = None
+        self._pid = None
 
-        return data, self._labels[tr_index_array]
+    def _get_random_state(self):
+        # numpy's global state is copied into every DataLoader worker so seed a
+        # separate one in each worker from torch's per-worker seed
+        if self._pid != os.getpid():
+            self._random_state = np.random.RandomState(torch.initial_seed() % 2 ** 32)
+            self._pid = os.getpid()
+        return self._random_state
+
+    def __getitem__(self, idx):
+        if self._train:
+            img = self._cache.random_crop(
+                idx, self._size, random_state=self._get_random_state()
+            )
+        else:
+            img = self._cache.centre_crop(idx, self._size)
+        img = np.ascontiguousarray(img)
+        if self._transform is not None:
+            img = self._transform(img)
+        return img, int(self._cache.labels[idx])
 
     def __len__(self):
-        return self._length
+        return len(self._cache)
+
+
+def _image_dataset(data_dir, name, transform, data_format=_DATA_FORMAT):
+    if data_format == "shards":
+        return ShardDataset(data_dir, name, transform=transform)
+    else:
+        return datasets.ImageFolder(data_dir, transform)
+
+
+def _to_uint8_tensor(img):
+    return torch.from_numpy(np.asarray(img, dtype=np.uint8))
+
+
+def _uint8_dataset(data_dir, name, size=256, data_format=_DATA_FORMAT):
+    """ Creates a dataset of size x size uint8 HWC image tensors for BatchAugmentation
+    """
+    if data_format == "cache":
+        return CacheDataset(
+            data_dir, name, size=None, train=False, transform=_to_uint8_tensor
+        )
+    else:
+        return _image_dataset(
+            data_dir,
+            name,
+            transforms.Compose(
+                [transforms.Resize(size), transforms.CenterCrop(size), _to_uint8_tensor]
+            ),
+            data_format=data_format,
+        )
+
+
+class BatchAugmentation(object):
+    """ Crops, flips and normalizes a whole uint8 NHWC batch at once
+
+    Doing this after collation, ideally once the batch is on the GPU, replaces the
+    per sample transforms in the DataLoader workers with a handful of tensor ops.
+    When training each image gets its own random crop and flip, otherwise the centre
+    crop is taken. Returns a normalized float NCHW batch.
+    """
+
+    def __init__(self, size=_WIDTH, mean=_RGB_MEAN, sd=_RGB_SD, train=True):
+        self._size = size
+        self._mean = torch.tensor(mean).view(1, -1, 1, 1) * 255
+        self._sd = torch.tensor(sd).view(1, -1, 1, 1) * 255
+        self._train = train
+
+    def _crop(self, batch):
+        n, height, width, _ = batch.shape
+        size = self._size
+        device = batch.device
+        if not self._train:
+            top, left = (height - size) // 2, (width - size) // 2
+            return batch[:, top : top + size, left : left + size]
+
+        top = torch.randint(0, height - size + 1, (n,), dtype=torch.long, device=device)
+        left = torch.randint(0, width - size + 1, (n,), dtype=torch.long, device=device)
+        flip = torch.randint(0, 2, (n,), dtype=torch.long, device=device)
+        offsets = torch.arange(size, dtype=torch.long, device=device)
+        rows = top.view(-1, 1) + offsets
+        # Flipped images read their columns from right to left
+        cols = left.view(-1, 1) + offsets + flip.view(-1, 1) * (size - 1 - 2 * offsets)
+        images = torch.arange(n, dtype=torch.long, device=device).view(-1, 1, 1)
+        return batch[images, rows.view(n, size, 1), cols.view(n, 1, size)]
+
+    def __call__(self, batch):
+        if self._mean.device != batch.device:
+            self._mean = self._mean.to(batch.device)
+            self._sd = self._sd.to(batch.device)
+        images = self._crop(batch).permute(0, 3, 1, 2).float()
+        return images.sub_(self._mean).div_(self._sd)
+
+
+def _training_dataset(data_dir):
+    if _BATCH_AUGMENT:
+        return _uint8_dataset(data_dir, "train")
+    elif _DATA_FORMAT == "cache":
+        to_tensor = transforms.Compose(
+            [transforms.ToTensor(), transforms.Normalize(_RGB_MEAN, _RGB_SD)]
+        )
+        return CacheDataset(data_dir, "train", transform=to_tensor)
+    else:
+        return _image_dataset(
+            data_dir,
+            "train",
+            transforms.Compose(
+                [
+                    transforms.RandomResizedCrop(_WIDTH),
+                    transforms.RandomHorizontalFlip(),
+                    transforms.ToTensor(),
+                    transforms.Normalize(_RGB_MEAN, _RGB_SD),
+                ]
+            ),
+        )
+
+
+def _validation_dataset(data_dir):
+    if _BATCH_AUGMENT:
+        return _uint8_dataset(data_dir, "validation")
+    elif _DATA_FORMAT == "cache":
+        to_tensor = transforms.Compose(
+            [transforms.ToTensor(), transforms.Normalize(_RGB_MEAN, _RGB_SD)]
+        )
+        return CacheDataset(data_dir, "validation", train=False, transform=to_tensor)
+    else:
+        return _image_dataset(
+            data_dir,
+            "validation",
+            transforms.Compose(
+                [
+                    transforms.Resize(256),
+                    transforms.CenterCrop(224),
+                    transforms.ToTensor(),
+                    transforms.Normalize(_RGB_MEAN, _RGB_SD),
+                ]
+            ),
+        )
+
+
+def _device():
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+class TinyNet(nn.Module):
+    """ Two convolutions and a linear layer, for distributed runs on the CPU where
+    the model only needs to produce gradients to allreduce
+    """
+
+    def __init__(self, num_classes=1000):
+        super(TinyNet, self).__init__()
+        self.features = nn.Sequential(
+            nn.Conv2d(_CHANNELS, 16, kernel_size=7, stride=4, padding=3),
+            nn.BatchNorm2d(16),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(16, 32, kernel_size=3, stride=2, padding=1),
+            nn.BatchNorm2d(32),
+            nn.ReLU(inplace=True),
+            nn.AdaptiveAvgPool2d(1),
+        )
+        self.fc = nn.Linear(32, num_classes)
+
+    def forward(self, x):
+        return self.fc(self.features(x).view(x.size(0), -1))
+
+
+def _create_model(name=_MODEL):
+    if name == "tiny":
+        return TinyNet()
+    return models.__dict__[name](pretrained=False)
 
 
 def _is_master(is_distributed=_DISTRIBUTED):
@@ -201,42 +419,423 @@ def _is_master(is_distributed=_DISTRIBUTED):
         return True
 
 
-def train(train_loader, model, criterion, optimizer, epoch):
+def _step_metrics():
+    # With Horovod the allreduce runs during the backward pass and is waited on in
+    # optimizer.step(), so communication time shows up under optimizer
+    return StepMetrics(
+        _BATCHSIZE,
+        phases=("data", "forward", "backward", "optimizer"),
+        rank=_get_rank(),
+        sync=torch.cuda.synchronize if _STEP_METRICS_SYNC else None,
+    )
+
+
+def _allgather_array(array):
+    return hvd.allgather(torch.from_numpy(array).view(1, -1), name="straggler").numpy()
+
+
+def _create_straggler_monitor(is_distributed=_DISTRIBUTED):
+    """ Returns a StragglerMonitor or None if there is a single rank
+
+    The ranks wait for each other in the optimizer phase, see _step_metrics. Without
+    STEP_METRICS_SYNC the GPU work still running when the optimizer waits for the
+    allreduce counts as waiting, so compute bound stragglers are only found with it.
+    """
+    if not is_distributed or _STRAGGLER_STEPS <= 0:
+        return None
+    return StragglerMonitor(
+        _allgather_array,
+        every=_STRAGGLER_STEPS,
+        input_phases=("data",),
+        wait_phases=("optimizer",),
+        rank=hvd.rank(),
+        logger=_get_logger(),
+    )
+
+
+def _topk_compress(tensor, residual, ratio=_TOPK_RATIO):
+    """ Selects the largest ratio of the elements of tensor plus residual by magnitude
+
+    The elements that are not sent are kept in residual and added to the next
+    gradient (error feedback), so every update is applied eventually.
+
+    Returns:
+        the values and the indices of the selected elements in the flattened tensor
+    """
+    accumulated = tensor.view(-1) + residual
+    k = max(1, int(accumulated.numel() * ratio))
+    _, indices = accumulated.abs().topk(k, sorted=False)
+    values = accumulated[indices]
+    residual.copy_(accumulated)
+    residual[indices] = 0
+    return values, indices
+
+
+def _topk_decompress(values, indices, shape):
+    """ Sums values into a zero tensor of the given shape at the flattened indices """
+    dense = values.new_zeros(shape).view(-1)
+    dense.index_add_(0, indices, values)
+    return dense.view(shape)
+
+
+class TopKAllreduce(object):
+    """ Averages the gradients across the ranks sending only the top-k of each
+
+    Horovod's allreduce can only sum dense tensors, so every rank allgathers the
+    values and indices of its top-k elements and sums them into the dense gradient.
+    Call it after loss.backward() and before optimizer.step().
+    """
+
+    def __init__(self, named_parameters, ratio=_TOPK_RATIO):
+        self._parameters = [
+            (name, p) for name, p in named_parameters if p.requires_grad
+        ]
+        self._ratio = ratio
+        self._residuals = {}
+
+    def __call__(self):
+        handles = []
+        for name, p in self._parameters:
+            if p.grad is None:
+                continue
+            if name not in self._residuals:
+                self._residuals[name] = p.grad.data.new_zeros(p.grad.numel())
+            values, indices = _topk_compress(
+                p.grad.data, self._residuals[name], ratio=self._ratio
+            )
+            handles.append(
+                (
+                    p,
+                    hvd.allgather_async(values, name="topk.values." + name),
+                    hvd.allgather_async(indices, name="topk.indices." + name),
+                )
+            )
+        for p, values_handle, indices_handle in handles:
+            values = hvd.synchronize(values_handle)
+            indices = hvd.synchronize(indices_handle)
+            dense = _topk_decompress(values, indices, p.grad.size())
+            p.grad.data.copy_(dense.div_(hvd.size()))
+
+
+class GradientAllreduce(object):
+    """ Averages the gradients across the ranks with one allreduce per parameter
+
+    MixedPrecision copies the gradients into its master weights by hand, so the
+    backward hooks with which hvd.DistributedOptimizer starts its allreduces never
+    fire for them. Call it after the gradients are in place and before
+    optimizer.step().
+    """
+
+    def __init__(self, named_parameters, compression=None):
+        self._parameters = [
+            (name, p) for name, p in named_parameters if p.requires_grad
+        ]
+        self._compression = compression or hvd.Compression.none
+
+    def __call__(self):
+        handles = []
+        for name, p in self._parameters:
+            if p.grad is None:
+                continue
+            compressed, ctx = self._compression.compress(p.grad.data)
+            handles.append(
+                (p, ctx, hvd.allreduce_async(compressed, average=True, name=name))
+            )
+        for p, ctx, handle in handles:
+            p.grad.data.copy_(
+                self._compression.decompress(hvd.synchronize(handle), ctx)
+            )
+
+
+def _half_dtype():
+    """ float16 on the GPU, bfloat16 on the CPU where the PyTorch version has it """
+    if torch.cuda.is_available() or not hasattr(torch, "bfloat16"):
+        return torch.float16
+    return torch.bfloat16
+
+
+class MixedPrecision(object):
+    """ Trains a half precision copy of the model with float32 master weights
+
+    The batch norm layers stay in float32. The optimizer updates the master weights,
+    which are copied back into the model after every step. The loss is multiplied by
+    a scale before the backward pass so that small float16 gradients do not flush to
+    zero, and the gradients are divided by it again when they are copied to the
+    master weights. A step whose gradients overflow on any rank is skipped by every
+    rank and halves the scale, which doubles again after scale_window steps without
+    an overflow. bfloat16 has the range of float32 so it is not scaled.
+
+    parameters(), named_parameters(), state_dict() and load_state_dict() refer to the
+    master weights, so the optimizer and the checkpoints use float32.
+    """
+
+    def __init__(
+        self,
+        model,
+        dtype=None,
+        init_scale=2.0 ** 15,
+        scale_factor=2.0,
+        scale_window=2000,
+        is_distributed=_DISTRIBUTED,
+    ):
+        self.dtype = _half_dtype() if dtype is None else dtype
+        self.model = model
+        self._names = [name for name, _ in model.named_parameters()]
+        self._master_params = [
+            p.detach().clone().float().requires_grad_() for p in model.parameters()
+        ]
+        model.to(self.dtype)
+        for module in model.modules():
+            if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
+                module.float()
+        self.scale = init_scale if self.dtype == torch.float16 else 1.0
+        self._scale_factor = scale_factor
+        self._scale_window = scale_window
+        self._good_steps = 0
+        self._is_distributed = is_distributed
+
+    def parameters(self):
+        return iter(self._master_params)
+
+    def named_parameters(self):
+        return zip(self._names, self._master_params)
+
+    def state_dict(self):
+        state = self.model.state_dict()
+        state.update(zip(self._names, (p.data for p in self._master_params)))
+        return state
+
+    def load_state_dict(self, state):
+        for name, master in zip(self._names, self._master_params):
+            master.data.copy_(state[name])
+        self.model.load_state_dict(state)
+
+    def update_model(self):
+        """ Copies the master weights into the model """
+        for p, master in zip(self.model.parameters(), self._master_params):
+            p.data.copy_(master.data)
+
+    def cast(self, data):
+        return data.to(self.dtype)
+
+    def zero_grad(self):
+        self.model.zero_grad()
+
+    def backward(self, loss):
+        (loss.float() * self.scale).backward()
+
+    def _overflow(self):
+        # A single sum is inf or nan if any of the gradients is
+        total = sum(
+            p.grad.data.float().sum()
+            for p in self.model.parameters()
+            if p.grad is not None
+        )
+        overflow = not np.isfinite(float(total))
+        if self._is_distributed:
+            overflows = hvd.allreduce(
+                torch.tensor([float(overflow)]), average=False, name="overflow"
+            )
+            overflow = overflows.item() > 0
+        return overflow
+
+    def step(self, optimizer, allreduce_gradients=None):
+        """ Unscales the gradients into the master weights and steps the optimizer
+
+        Returns:
+            False if the gradients overflowed and the step was skipped
+        """
+        if self._overflow():
+            self.scale = max(self.scale / self._scale_factor, 1.0)
+            self._good_steps = 0
+            _get_logger().info("Gradient overflow, loss scale {}".format(self.scale))
+            return False
+        for p, master in zip(self.model.parameters(), self._master_params):
+            if p.grad is None:
+                continue
+            if master.grad is None:
+                master.grad = torch.zeros_like(master.data)
+            master.grad.data.copy_(p.grad.data).div_(self.scale)
+        if allreduce_gradients is not None:
+            allreduce_gradients()
+        optimizer.step()
+        self.update_model()
+        self._good_steps += 1
+        if self.dtype == torch.float16 and self._good_steps == self._scale_window:
+            self.scale *= self._scale_factor
+            self._good_steps = 0
+        return True
+
+
+def _get_compression(compression=_COMPRESSION):
+    """ Horovod compression for the allreduce of the gradients, topk is done by
+    TopKAllreduce instead
+    """
+    if compression not in ("none", "fp16", "topk"):
+        raise ValueError("Unknown COMPRESSION {}".format(compression))
+    return hvd.Compression.fp16 if compression == "fp16" else hvd.Compression.none
+
+
+def _get_optimizer(model, is_distributed=_DISTRIBUTED):
+    """ Returns the optimizer and the function that averages the gradients across
+    the ranks before each step, which is None when the optimizer does it
+
+    model is the MixedPrecision of the model when training in mixed precision, so that
+    the optimizer updates the master weights.
+    """
+    num_gpus = hvd.size() if is_distributed else 1
+    # Horovod: scale learning rate by the number of GPUs and the accumulated batches.
+    optimizer = optim.SGD(
+        model.parameters(), lr=_LR * num_gpus * _ACCUMULATION_STEPS, momentum=0.9
+    )
+    if not is_distributed:
+        return optimizer, None
+    compression = _get_compression()
+    if _COMPRESSION == "topk":
+        return optimizer, TopKAllreduce(model.named_parameters())
+    if isinstance(model, MixedPrecision):
+        # MixedPrecision.step allreduces the master gradients once they are copied
+        return optimizer, GradientAllreduce(
+            model.named_parameters(), compression=compression
+        )
+    # Horovod: wrap optimizer with DistributedOptimizer, which allreduces the gradients
+    # once every backward_passes_per_step backward passes.
+    optimizer = hvd.DistributedOptimizer(
+        optimizer,
+        named_parameters=model.named_parameters(),
+        compression=compression,
+        backward_passes_per_step=_ACCUMULATION_STEPS,
+    )
+    return optimizer, None
+
+
+def train(
+    train_loader,
+    model,
+    criterion,
+    optimizer,
+    epoch,
+    augment=None,
+    allreduce_gradients=None,
+    accumulation_steps=_ACCUMULATION_STEPS,
+    precision=None,
+    straggler_monitor=None,
+):
+    """ Trains for one epoch, updating the model every accumulation_steps batches with
+    the mean of their gradients
+
+    precision is the MixedPrecision of the model or None to train in float32.
+    straggler_monitor is a StragglerMonitor updated after every step, or None.
+    """
     logger = _get_logger()
     msg = " duration({})  loss:{} total-samples: {}"
     t = Timer()
     t.start()
     logger.set_epoch(epoch)
+    metrics = _step_metrics()
+    metrics.start()
+    num_batches = len(train_loader)
     for i, (data, target) in enumerate(train_loader):
-        data, target = data.cuda(non_blocking=True), target.cuda(non_blocking=True)
-        optimizer.zero_grad()
+        data = data.to(_device(), non_blocking=True)
+        target = target.to(_device(), non_blocking=True)
+        if augment is not None:
+            data = augment(data)
+        if precision is not None:
+            data = precision.cast(data)
+        metrics.mark("data")
+        if i % accumulation_steps == 0:
+            optimizer.zero_grad()
+            if precision is not None:
+                precision.zero_grad()
         # compute output
         output = model(data)
-        loss = criterion(output, target)
-        # compute gradient and do SGD step
-        loss.backward()
-        optimizer.step()
+        loss = criterion(output.float(), target)
+        metrics.mark("forward")
+        # compute gradient, the gradients of the accumulated batches add up to their
+        # mean, the last group of the epoch can be smaller
+        group_start = i - i % accumulation_steps
+        group_size = min(accumulation_steps, num_batches - group_start)
+        if precision is not None:
+            precision.backward(loss / group_size)
+        else:
+            (loss / group_size).backward()
+        metrics.mark("backward")
+        if (i + 1) % accumulation_steps == 0 or i + 1 == num_batches:
+            # do SGD step
+            if precision is not None:
+                precision.step(optimizer, allreduce_gradients=allreduce_gradients)
+            else:
+                if allreduce_gradients is not None:
+                    allreduce_gradients()
+                optimizer.step()
+        metrics.mark("optimizer")
+        metrics.end_step(len(data))
+        if straggler_monitor is not None:
+            straggler_monitor.update(metrics)
         if i % 100 == 0:
             logger.info(msg.format(t.elapsed, loss.item(), i * len(data)))
+            logger.info(metrics.format())
             t.start()
-
-
-def validate(train_loader, model, criterion):
+        # The straggler check waits for the other ranks, neither it nor the logging
+        # is part of a step
+        metrics.skip()
+    return metrics
+
+
+def _topk_correct(output, target, topk=(1, 5)):
+    """ Returns the number of samples with the target in the top k predictions for
+    each k
+    """
+    _, pred = output.topk(min(max(topk), output.size(1)), dim=1)
+    correct = pred.eq(target.view(-1, 1))
+    return [correct[:, :k].sum().item() for k in topk]
+
+
+def validate(
+    val_loader,
+    model,
+    criterion,
+    augment=None,
+    precision=None,
+    is_distributed=_DISTRIBUTED,
+):
+    """ Evaluates this rank's shard of the validation data and returns the loss,
+    top-1 and top-5 accuracy over the whole validation set
+    """
     logger = _get_logger()
     msg = "validation duration({})  loss:{} total-samples: {}"
     t = Timer()
     t.start()
     model.eval()
+    # loss, top-1, top-5 and number of samples
+    totals = torch.zeros(4, dtype=torch.float64)
     with torch.no_grad():
-        for i, (data, target) in enumerate(train_loader):
-            data, target = data.cuda(non_blocking=True), target.cuda(non_blocking=True)
+        for i, (data, target) in enumerate(val_loader):
+            data = data.to(_device(), non_blocking=True)
+            target = target.to(_device(), non_blocking=True)
+            if augment is not None:
+                data = augment(data)
+            if precision is not None:
+                data = precision.cast(data)
             # compute output
-            output = model(data)
+            output = model(data).float()
             loss = criterion(output, target)
-            # compute gradient and do SGD step
+            top1, top5 = _topk_correct(output, target)
+            totals += torch.tensor(
+                [loss.item() * len(data), top1, top5, len(data)], dtype=torch.float64
+            )
             if i % 100 == 0:
                 logger.info(msg.format(t.elapsed, loss.item(), i * len(data)))
                 t.start()
+    if is_distributed:
+        totals = hvd.allreduce(totals, average=False, name="validation_totals")
+    loss, top1, top5 = (totals[:3] / totals[3].clamp(min=1)).tolist()
+    logger.info(
+        "Validation loss: {:.4f} top-1: {:.4f} top-5: {:.4f} images: {}".format(
+            loss, top1, top5, int(totals[3])
+        )
+    )
+    return loss, top1, top5
 
 
 def _log_summary(data_length, duration):
@@ -250,11 +849,115 @@ def _log_summary(data_length, duration):
             _BATCHSIZE, hvd.size() * _BATCHSIZE if _DISTRIBUTED else _BATCHSIZE
         )
     )
+    logger.info("Accumulation:     {}".format(_ACCUMULATION_STEPS))
+    logger.info(
+        "Precision:        {}".format(
+            str(_half_dtype()).replace("torch.", "") if _MIXED_PRECISION else "float32"
+        )
+    )
     logger.info("Distributed:      {}".format("True" if _DISTRIBUTED else "False"))
     logger.info("Num GPUs:         {:.3f}".format(hvd.size() if _DISTRIBUTED else 1))
     logger.info("Dataset:          {}".format("Synthetic" if _FAKE else "Imagenet"))
 
 
+class ShardSampler(torch.utils.data.sampler.Sampler):
+    """ Gives each rank every num_replicas-th sample, starting at its rank, in order
+
+    Unlike DistributedSampler no samples are repeated to even out the ranks, so
+    every sample is counted exactly once when the results are summed.
+    """
+
+    def __init__(self, data_source, num_replicas=1, rank=0):
+        self._indices = range(rank, len(data_source), num_replicas)
+
+    def __iter__(self):
+        return iter(self._indices)
+
+    def __len__(self):
+        return len(self._indices)
+
+
+def _get_validation_sampler(dataset, is_distributed=_DISTRIBUTED):
+    if is_distributed:
+        return ShardSampler(dataset, num_replicas=hvd.size(), rank=hvd.rank())
+    else:
+        return ShardSampler(dataset)
+
+
+def _checkpoint_format():
+    model_dir = os.getenv("AZ_BATCHAI_OUTPUT_MODEL")
+    if model_dir is None:
+        return None
+    return os.path.join(model_dir, "checkpoint-{epoch}.pth.tar")
+
+
+def _create_checkpoint_writer():
+    """ Returns the writer for the checkpoints on rank 0 and None on the other ranks """
+    checkpoint_format = _checkpoint_format()
+    if checkpoint_format is None or not _is_master():
+        return None
+    return AsyncCheckpointWriter(checkpoint_format, torch.save, keep=_KEEP_CHECKPOINTS)
+
+
+def _to_host(state):
+    """ Copies the tensors in a state dict to host memory
+
+    The copy decouples the snapshot from the training, which carries on updating the
+    parameters in place while the checkpoint is written.
+    """
+    if torch.is_tensor(state):
+        return state.cpu() if state.is_cuda else state.clone()
+    if isinstance(state, dict):
+        return type(state)((k, _to_host(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(_to_host(v) for v in state)
+    return state
+
+
+def _save_checkpoint(writer, model, optimizer, epoch):
+    """ Queues the state after epoch to be written, epoch counts the completed epochs
+
+    Only the copy to host memory happens here, the writer saves it in the background.
+    """
+    if writer is None:
+        return
+    state = {
+        "epoch": epoch,
+        "model": _to_host(model.state_dict()),
+        "optimizer": _to_host(optimizer.state_dict()),
+    }
+    writer.write(epoch, state)
+
+
+def _resume(model, optimizer, is_distributed=_DISTRIBUTED):
+    """ Loads the latest checkpoint on rank 0 and broadcasts it to the other ranks
+
+    Returns:
+        the epoch to resume from, 0 if there is no checkpoint
+    """
+    logger = _get_logger()
+    resume_from_epoch = 0
+    checkpoint_format = _checkpoint_format()
+    if checkpoint_format is not None and _is_master():
+        resume_from_epoch, filename = latest_checkpoint(checkpoint_format)
+        if filename is not None:
+            logger.info("Resuming from {}".format(filename))
+            state = torch.load(filename, map_location="cpu")
+            model.load_state_dict(state["model"])
+            optimizer.load_state_dict(state["optimizer"])
+
+    if is_distributed:
+        # Horovod: broadcast the epoch, parameters and optimizer state from rank 0
+        resume_from_epoch = int(
+            hvd.broadcast(
+                torch.tensor(resume_from_epoch), root_rank=0, name="resume_from_epoch"
+            )
+        )
+        hvd.broadcast_parameters(model.state_dict(), root_rank=0)
+        hvd.broadcast_optimizer_state(optimizer, root_rank=0)
+    return resume_from_epoch
+
+
 def _get_sampler(dataset, is_distributed=_DISTRIBUTED):
     if is_distributed:
         return torch.utils.data.distributed.DistributedSampler(
@@ -270,93 +973,101 @@ def main():
         # Horovod: initialize Horovod.
 
         hvd.init()
+        set_rank(_get_rank(), log_dir=_LOG_DIR)
         logger.info("Runnin Distributed")
         torch.manual_seed(_SEED)
         # Horovod: pin GPU to local rank.
-        torch.cuda.set_device(hvd.local_rank())
+        if torch.cuda.is_available():
+            torch.cuda.set_device(hvd.local_rank())
         torch.cuda.manual_seed(_SEED)
+    else:
+        set_rank(_get_rank(), log_dir=_LOG_DIR)
 
     logger.info("PyTorch version {}".format(torch.__version__))
 
     if _FAKE:
         logger.info("Setting up fake loaders")
-        train_dataset = FakeData(n_classes=1000, data_transform=torch.FloatTensor)
+        num_ranks = hvd.size() if _DISTRIBUTED else 1
+        train_loader = FakeBatches(length=_DATA_LENGTH // num_ranks)
+        train_length = _DATA_LENGTH
     else:
-        normalize = transforms.Normalize(_RGB_MEAN, _RGB_SD)
         logger.info("Setting up loaders")
-        train_dataset = datasets.ImageFolder(
-            os.getenv("AZ_BATCHAI_INPUT_TRAIN"),
-            transforms.Compose(
-                [
-                    transforms.RandomResizedCrop(_WIDTH),
-                    transforms.RandomHorizontalFlip(),
-                    transforms.ToTensor(),
-                    normalize,
-                ]
-            ),
-        )
-
-        validation_dataset = datasets.ImageFolder(
-            os.getenv("AZ_BATCHAI_INPUT_TRAIN"),
-            transforms.Compose(
-                [
-                    transforms.Resize(256),
-                    transforms.CenterCrop(224),
-                    transforms.ToTensor(),
-                    normalize,
-                ]
-            ),
-        )
-
-    train_sampler = _get_sampler(train_dataset)
+        train_dataset = _training_dataset(os.getenv("AZ_BATCHAI_INPUT_TRAIN"))
+        validation_dataset = _validation_dataset(os.getenv("AZ_BATCHAI_INPUT_TEST"))
 
     kwargs = {"num_workers": 5, "pin_memory": True}
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=_BATCHSIZE, sampler=train_sampler, **kwargs
-    )
+    if not _FAKE:
+        train_sampler = _get_sampler(train_dataset)
+        train_loader = torch.utils.data.DataLoader(
+            train_dataset, batch_size=_BATCHSIZE, sampler=train_sampler, **kwargs
+        )
+        train_length = len(train_dataset)
 
     # Autotune
     cudnn.benchmark = True
 
     logger.info("Loading model")
-    # Load symbol
-    model = models.__dict__["resnet50"](pretrained=False)
-
-    model.cuda()
+    model = _create_model()
+    model.to(_device())
 
-    if _DISTRIBUTED:
-        # Horovod: broadcast parameters.
-        hvd.broadcast_parameters(model.state_dict(), root_rank=0)
+    precision = MixedPrecision(model) if _MIXED_PRECISION else None
+    optimizer, allreduce_gradients = _get_optimizer(precision or model)
 
-    num_gpus = hvd.size() if _DISTRIBUTED else 1
-    # Horovod: scale learning rate by the number of GPUs.
-    optimizer = optim.SGD(model.parameters(), lr=_LR * num_gpus, momentum=0.9)
-    if _DISTRIBUTED:
-        # Horovod: wrap optimizer with DistributedOptimizer.
-        optimizer = hvd.DistributedOptimizer(
-            optimizer, named_parameters=model.named_parameters()
-        )
+    resume_from_epoch = _resume(precision or model, optimizer)
+    if precision is not None:
+        precision.update_model()
+    checkpoint_writer = _create_checkpoint_writer()
+    straggler_monitor = _create_straggler_monitor()
 
     criterion = F.cross_entropy
 
+    if _BATCH_AUGMENT and not _FAKE:
+        train_augment = BatchAugmentation(train=True)
+        validation_augment = BatchAugmentation(train=False)
+    else:
+        train_augment, validation_augment = None, None
+
     if not _FAKE:
-        val_sampler = _get_sampler(validation_dataset)
+        val_sampler = _get_validation_sampler(validation_dataset)
         val_loader = torch.utils.data.DataLoader(
             validation_dataset, batch_size=_BATCHSIZE, sampler=val_sampler, **kwargs
         )
 
     # Main training-loop
     logger.info("Training ...")
-    for epoch in range(_EPOCHS):
+    for epoch in range(resume_from_epoch, _EPOCHS):
         with Timer(output=logger.info, prefix="Training") as t:
             model.train()
-            if _DISTRIBUTED:
+            if _DISTRIBUTED and not _FAKE:
                 train_sampler.set_epoch(epoch)
-            train(train_loader, model, criterion, optimizer, epoch)
-        _log_summary(len(train_dataset), t.elapsed)
+            metrics = train(
+                train_loader,
+                model,
+                criterion,
+                optimizer,
+                epoch,
+                augment=train_augment,
+                allreduce_gradients=allreduce_gradients,
+                precision=precision,
+                straggler_monitor=straggler_monitor,
+            )
+        _log_summary(train_length, t.elapsed)
+        # The step percentiles of the epoch, benchmarks/training.py reads them from
+        # the JSON log
+        logger.info(metrics.format(), extra={"step_metrics": metrics.summary()})
+        _save_checkpoint(checkpoint_writer, precision or model, optimizer, epoch + 1)
+
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
 
     if not _FAKE:
-        validate(val_loader, model, criterion)
+        validate(
+            val_loader,
+            model,
+            criterion,
+            augment=validation_augment,
+            precision=precision,
+        )
 
 
 if __name__ == "__main__":
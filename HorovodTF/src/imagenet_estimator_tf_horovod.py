@@ -7,13 +7,17 @@ AZ_BATCHAI_INPUT_TEST
 AZ_BATCHAI_OUTPUT_MODEL
 AZ_BATCHAI_JOB_TEMP_DIR
 """
-import glob
+import itertools
 import logging
 import os
-import sys
+from checkpoint import AsyncCheckpointWriter
+from file_index import FileIndex
 from functools import lru_cache
-from os import path
-from pathlib import Path
+from image_cache import ImageCache
+from rank_logging import get_logger, route, set_rank
+from shards import ShardReader
+from step_metrics import StepMetrics
+from straggler import StragglerMonitor
 from timer import Timer
 
 import numpy as np
@@ -25,12 +29,13 @@ _WIDTH = 224
 _HEIGHT = 224
 _CHANNELS = 3
 _LR = 0.001
-_EPOCHS = os.getenv("EPOCHS", 1)
+_EPOCHS = int(os.getenv("EPOCHS", 1))
 _BATCHSIZE = 64
 _R_MEAN = 123.68
 _G_MEAN = 116.78
 _B_MEAN = 103.94
 _BUFFER = 256
+_SEED = 42
 
 
 def _str_to_bool(in_str):
@@ -46,6 +51,25 @@ _DATA_LENGTH = int(
     os.getenv("FAKE_DATA_LENGTH", 1281167)
 )  # How much fake data to simulate, default to size of imagenet dataset
 _VALIDATION = _str_to_bool(os.getenv("VALIDATION", "False"))
+_DATA_FORMAT = os.getenv("DATA_FORMAT", "images")  # images, shards or cache
+_NUM_WORKERS = int(os.getenv("NUM_WORKERS", 5))
+_CHECKPOINT_STEPS = int(os.getenv("CHECKPOINT_STEPS", 5000))
+_KEEP_CHECKPOINTS = int(os.getenv("KEEP_CHECKPOINTS", 5))
+# Steps between the checks for ranks that are slower than the others, 0 to disable
+_STRAGGLER_STEPS = int(os.getenv("STRAGGLER_STEPS", 100))
+_PIPELINE = os.getenv("PIPELINE", "interleave")  # interleave or map
+_COMPRESSION = os.getenv("COMPRESSION", "none")  # none, fp16 or topk
+_TOPK_RATIO = float(os.getenv("TOPK_RATIO", 0.01))
+# Number of batches whose gradients are summed locally before each allreduce and update
+_ACCUMULATION_STEPS = int(os.getenv("ACCUMULATION_STEPS", 1))
+# Train in float16 with float32 master weights, on the GPU only since TensorFlow has
+# no half precision convolutions on the CPU
+_MIXED_PRECISION = _str_to_bool(os.getenv("MIXED_PRECISION", "False"))
+# Directory for the rank-<rank>.jsonl logs, only rank 0 prints to stdout if set
+_LOG_DIR = os.getenv("LOG_DIR")
+_PREFETCH_TO_DEVICE = _str_to_bool(
+    os.getenv("PREFETCH_TO_DEVICE", str(tf.test.is_built_with_cuda()))
+)
 
 if _DISTRIBUTED:
     import horovod.tensorflow as hvd
@@ -53,8 +77,7 @@ if _DISTRIBUTED:
 
 tf_logger = logging.getLogger("tensorflow")
 tf_logger.setLevel(logging.INFO)
-stout = logging.StreamHandler(stream=sys.stdout)
-tf_logger.addHandler(stout)
+route(tf_logger)
 
 
 def _get_rank():
@@ -67,38 +90,19 @@ def _get_rank():
         return 0
 
 
-class HorovodAdapter(logging.LoggerAdapter):
-    def __init__(self, logger):
-        self._str_epoch = ""
-        self._gpu_rank = 0
-        super(HorovodAdapter, self).__init__(logger, {})
-
-    def set_epoch(self, epoch):
-        self._str_epoch = "[Epoch {}]".format(epoch)
-
-    def process(self, msg, kwargs):
-        kwargs["extra"] = {"gpurank": _get_rank(), "epoch": self._str_epoch}
-        return msg, kwargs
-
-
 @lru_cache()
 def _get_logger():
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
-    ch = logging.StreamHandler(stream=sys.stdout)
-    formatter = logging.Formatter(
-        "%(levelname)s:%(name)s:%(gpurank)d: %(epoch)s %(message)s"
-    )
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
-    adapter = HorovodAdapter(logger)
-    return adapter
+    return get_logger(__name__)
 
 
 def _load_image(filename, channels=_CHANNELS):
     return tf.to_float(tf.image.decode_png(tf.read_file(filename), channels=channels))
 
 
+def _decode_image(data, channels=_CHANNELS):
+    return tf.to_float(tf.image.decode_jpeg(data, channels=channels))
+
+
 def _resize(img, width=_WIDTH, height=_HEIGHT):
     return tf.image.resize_images(img, [height, width])
 
@@ -115,10 +119,36 @@ def _random_horizontal_flip(img):
     return tf.image.random_flip_left_right(img)
 
 
+def _decode_and_random_crop(data, width=_WIDTH, height=_HEIGHT, channels=_CHANNELS):
+    """ Decodes only a random crop of a JPEG and resizes it to height x width
+
+    The crop covers 8% to 100% of the image with an aspect ratio between 3/4 and 4/3,
+    the same as RandomResizedCrop in the PyTorch trainer.
+    """
+    begin, size, _ = tf.image.sample_distorted_bounding_box(
+        tf.image.extract_jpeg_shape(data),
+        bounding_boxes=tf.constant([0.0, 0.0, 1.0, 1.0], shape=[1, 1, 4]),
+        min_object_covered=0.08,
+        aspect_ratio_range=(3 / 4, 4 / 3),
+        area_range=(0.08, 1.0),
+        max_attempts=10,
+        use_image_if_no_bounding_boxes=True,
+    )
+    offset_y, offset_x, _ = tf.unstack(begin)
+    crop_height, crop_width, _ = tf.unstack(size)
+    crop_window = tf.stack([offset_y, offset_x, crop_height, crop_width])
+    img = tf.image.decode_and_crop_jpeg(data, crop_window, channels=channels)
+    return _resize(tf.to_float(img), width=width, height=height)
+
+
 def _preprocess_images(filename):
     return pipe(filename, _load_image, _resize, _centre)
 
 
+def _preprocess_encoded_images(data):
+    return pipe(data, _decode_image, _resize, _centre)
+
+
 def _preprocess_labels(label):
     return tf.cast(label, dtype=tf.int32)
 
@@ -146,25 +176,391 @@ def _parse_function_eval(filename, label):
     )
 
 
-def _get_optimizer(params, is_distributed=_DISTRIBUTED):
-    if is_distributed:
-        # Horovod: add Horovod Distributed Optimizer.
-        return hvd.DistributedOptimizer(
-            tf.train.MomentumOptimizer(
-                learning_rate=params["learning_rate"] * hvd.size(), momentum=0.9
+def _parse_file_train(filename, label):
+    img = pipe(
+        tf.read_file(filename),
+        _decode_and_random_crop,
+        _random_horizontal_flip,
+        _centre,
+        _transform_to_NCHW,
+    )
+    return img, _preprocess_labels(label)
+
+
+def _parse_encoded_train(data, label):
+    return _parse_function_train(
+        _preprocess_encoded_images(data), _preprocess_labels(label)
+    )
+
+
+def _parse_encoded_eval(data, label):
+    return (
+        pipe(data, _preprocess_encoded_images, _transform_to_NCHW),
+        _preprocess_labels(label),
+    )
+
+
+def _parse_cached_train(img, label):
+    return _parse_function_train(pipe(img, tf.to_float, _centre), label)
+
+
+def _parse_cached_eval(img, label, width=_WIDTH, height=_HEIGHT):
+    img = tf.image.resize_image_with_crop_or_pad(img, height, width)
+    return pipe(img, tf.to_float, _centre, _transform_to_NCHW), label
+
+
+def _topk_compress(tensor, residual, ratio=_TOPK_RATIO):
+    """ Selects the largest ratio of the elements of tensor plus residual by magnitude
+
+    The elements that are not sent are kept in residual and added to the next
+    gradient (error feedback), so every update is applied eventually.
+
+    Returns:
+        the values and the indices of the selected elements in the flattened tensor,
+        both depend on the update of residual
+    """
+    accumulated = tf.reshape(tensor, [-1]) + residual
+    k = max(1, int(accumulated.shape.num_elements() * ratio))
+    _, indices = tf.nn.top_k(tf.abs(accumulated), k=k, sorted=False)
+    values = tf.gather(accumulated, indices)
+    sent = tf.scatter_nd(tf.expand_dims(indices, 1), values, tf.shape(accumulated))
+    with tf.control_dependencies([tf.assign(residual, accumulated - sent)]):
+        return tf.identity(values), tf.identity(indices)
+
+
+def _topk_decompress(values, indices, shape):
+    """ Sums values into a zero tensor of the given shape at the flattened indices """
+    dense = tf.unsorted_segment_sum(values, indices, num_segments=shape.num_elements())
+    return tf.reshape(dense, shape)
+
+
+def _topk_allreduce(gradient, variable, ratio=_TOPK_RATIO):
+    """ Averages gradient across the ranks sending only its top-k elements
+
+    Horovod's allreduce can only sum dense tensors, so every rank allgathers the
+    values and indices of its top-k elements and sums them into the dense gradient.
+    """
+    with tf.variable_scope("TopKAllreduce/" + variable.op.name):
+        residual = tf.get_variable(
+            "residual",
+            shape=[gradient.shape.num_elements()],
+            dtype=gradient.dtype,
+            initializer=tf.zeros_initializer(),
+            trainable=False,
+            collections=[tf.GraphKeys.LOCAL_VARIABLES],
+        )
+    values, indices = _topk_compress(gradient, residual, ratio=ratio)
+    values, indices = hvd.allgather(values), hvd.allgather(indices)
+    return _topk_decompress(values, indices, gradient.shape) / hvd.size()
+
+
+class TopKDistributedOptimizer(tf.train.Optimizer):
+    """ Wraps an optimizer like hvd.DistributedOptimizer, averaging the gradients with
+    _topk_allreduce
+    """
+
+    def __init__(self, optimizer, ratio=_TOPK_RATIO, name="TopKDistributedOptimizer"):
+        super(TopKDistributedOptimizer, self).__init__(name=name, use_locking=False)
+        self._optimizer = optimizer
+        self._ratio = ratio
+
+    def compute_gradients(self, *args, **kwargs):
+        gradients = self._optimizer.compute_gradients(*args, **kwargs)
+        return [
+            (None if grad is None else _topk_allreduce(grad, var, self._ratio), var)
+            for grad, var in gradients
+        ]
+
+    def apply_gradients(self, *args, **kwargs):
+        return self._optimizer.apply_gradients(*args, **kwargs)
+
+    def get_slot(self, *args, **kwargs):
+        return self._optimizer.get_slot(*args, **kwargs)
+
+    def get_slot_names(self, *args, **kwargs):
+        return self._optimizer.get_slot_names(*args, **kwargs)
+
+    def variables(self, *args, **kwargs):
+        return self._optimizer.variables(*args, **kwargs)
+
+
+def _get_compression(compression=_COMPRESSION):
+    """ Horovod compression for the allreduce of the gradients, topk is done by
+    TopKDistributedOptimizer instead
+    """
+    if compression not in ("none", "fp16", "topk"):
+        raise ValueError("Unknown COMPRESSION {}".format(compression))
+    return hvd.Compression.fp16 if compression == "fp16" else hvd.Compression.none
+
+
+def _get_allreduce(compression=_COMPRESSION):
+    """ Returns allreduce(gradient, variable), which averages gradient across the ranks
+    """
+    if compression == "topk":
+        return _topk_allreduce
+    hvd_compression = _get_compression(compression)
+    return lambda gradient, variable: hvd.allreduce(
+        gradient, compression=hvd_compression
+    )
+
+
+class AccumulatingOptimizer(tf.train.Optimizer):
+    """ Sums the gradients of steps batches in local variables and applies their mean
+    every steps-th batch
+
+    The gradients are averaged across the ranks with allreduce only when they are
+    applied, so there is one allreduce per steps batches. The global step still
+    counts batches.
+    """
+
+    def __init__(
+        self,
+        optimizer,
+        steps=_ACCUMULATION_STEPS,
+        allreduce=None,
+        name="AccumulatingOptimizer",
+    ):
+        super(AccumulatingOptimizer, self).__init__(name=name, use_locking=False)
+        self._optimizer = optimizer
+        self._steps = steps
+        self._allreduce = allreduce
+
+    def compute_gradients(self, *args, **kwargs):
+        return self._optimizer.compute_gradients(*args, **kwargs)
+
+    def _local_variable(self, name, shape, dtype):
+        return tf.get_variable(
+            name,
+            shape=shape,
+            dtype=dtype,
+            initializer=tf.zeros_initializer(),
+            trainable=False,
+            collections=[tf.GraphKeys.LOCAL_VARIABLES],
+        )
+
+    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+        grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+        variables = [v for _, v in grads_and_vars]
+        with tf.variable_scope(self.get_name()):
+            accumulators = [
+                self._local_variable(v.op.name, v.shape, v.dtype.base_dtype)
+                for v in variables
+            ]
+            count = self._local_variable("count", [], tf.int64)
+        accumulate = [
+            tf.assign_add(a, g) for a, (g, _) in zip(accumulators, grads_and_vars)
+        ]
+        with tf.control_dependencies(accumulate):
+            count = tf.assign_add(count, 1)
+
+        def _apply():
+            gradients = [a / self._steps for a in accumulators]
+            if self._allreduce is not None:
+                gradients = [
+                    self._allreduce(g, v) for g, v in zip(gradients, variables)
+                ]
+            apply_op = self._optimizer.apply_gradients(zip(gradients, variables))
+            with tf.control_dependencies([apply_op]):
+                return tf.group(*[tf.assign(a, tf.zeros_like(a)) for a in accumulators])
+
+        update = tf.cond(tf.equal(count % self._steps, 0), _apply, tf.no_op)
+        if global_step is None:
+            return update
+        with tf.control_dependencies([update]):
+            return tf.assign_add(global_step, 1, name=name)
+
+    def get_slot(self, *args, **kwargs):
+        return self._optimizer.get_slot(*args, **kwargs)
+
+    def get_slot_names(self, *args, **kwargs):
+        return self._optimizer.get_slot_names(*args, **kwargs)
+
+    def variables(self, *args, **kwargs):
+        return self._optimizer.variables(*args, **kwargs)
+
+
+class LossScalingOptimizer(tf.train.Optimizer):
+    """ Scales the loss so that small float16 gradients do not flush to zero
+
+    The gradients are divided by the scale again before they are applied. A step whose
+    gradients overflow on any rank is skipped by every rank and halves the scale,
+    which doubles again after window steps without an overflow. The global step still
+    counts batches.
+    """
+
+    def __init__(
+        self,
+        optimizer,
+        init_scale=2.0 ** 15,
+        factor=2.0,
+        window=2000,
+        is_distributed=_DISTRIBUTED,
+        name="LossScalingOptimizer",
+    ):
+        super(LossScalingOptimizer, self).__init__(name=name, use_locking=False)
+        self._optimizer = optimizer
+        self._init_scale = init_scale
+        self._factor = factor
+        self._window = window
+        self._is_distributed = is_distributed
+
+    def _loss_scale_variables(self):
+        with tf.variable_scope(self.get_name(), reuse=tf.AUTO_REUSE):
+            # The dtypes are given since a reused variable is looked up as float32
+            scale = tf.get_variable(
+                "loss_scale",
+                dtype=tf.float32,
+                initializer=tf.constant(self._init_scale),
+                trainable=False,
+                collections=[tf.GraphKeys.LOCAL_VARIABLES],
+            )
+            good_steps = tf.get_variable(
+                "good_steps",
+                dtype=tf.int64,
+                initializer=tf.constant(0, dtype=tf.int64),
+                trainable=False,
+                collections=[tf.GraphKeys.LOCAL_VARIABLES],
             )
+        return scale, good_steps
+
+    def compute_gradients(self, loss, *args, **kwargs):
+        scale, _ = self._loss_scale_variables()
+        gradients = self._optimizer.compute_gradients(loss * scale, *args, **kwargs)
+        return [(None if g is None else g / scale, v) for g, v in gradients]
+
+    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+        scale, good_steps = self._loss_scale_variables()
+        grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+        finite = tf.reduce_all(
+            [tf.reduce_all(tf.is_finite(g)) for g, _ in grads_and_vars]
         )
-    else:
-        return tf.train.MomentumOptimizer(
-            learning_rate=params["learning_rate"], momentum=0.9
+        if self._is_distributed:
+            overflows = hvd.allreduce(1.0 - tf.to_float(finite), average=False)
+            finite = tf.equal(overflows, 0.0)
+        update = tf.cond(
+            finite,
+            lambda: tf.group(self._optimizer.apply_gradients(grads_and_vars)),
+            tf.no_op,
         )
+        with tf.control_dependencies([update]):
+            good = tf.where(finite, good_steps + 1, tf.zeros_like(good_steps))
+            grow = tf.equal(good, self._window)
+            new_scale = tf.where(
+                finite,
+                tf.where(grow, scale * self._factor, scale),
+                tf.maximum(scale / self._factor, 1.0),
+            )
+            update_scale = tf.group(
+                tf.assign(scale, new_scale),
+                tf.assign(good_steps, tf.where(grow, tf.zeros_like(good), good)),
+            )
+        if global_step is None:
+            return update_scale
+        with tf.control_dependencies([update_scale]):
+            return tf.assign_add(global_step, 1, name=name)
+
+    def get_slot(self, *args, **kwargs):
+        return self._optimizer.get_slot(*args, **kwargs)
+
+    def get_slot_names(self, *args, **kwargs):
+        return self._optimizer.get_slot_names(*args, **kwargs)
+
+    def variables(self, *args, **kwargs):
+        return self._optimizer.variables(*args, **kwargs)
+
+
+def _compute_dtype():
+    if _MIXED_PRECISION and tf.test.is_built_with_cuda():
+        return tf.float16
+    return tf.float32
+
+
+def _float32_variable_getter(getter, name, *args, **kwargs):
+    """ Keeps the trainable variables in float32 and casts them to the dtype the
+    layer computes in
+    """
+    dtype = kwargs.get("dtype", tf.float32)
+    trainable = kwargs.get("trainable", True)
+    if trainable and dtype != tf.float32:
+        kwargs["dtype"] = tf.float32
+        return tf.cast(getter(name, *args, **kwargs), dtype)
+    return getter(name, *args, **kwargs)
+
+
+def _get_optimizer(params, is_distributed=_DISTRIBUTED):
+    # Scale the learning rate with the number of images in each update
+    # (https://arxiv.org/abs/1706.02677)
+    num_ranks = hvd.size() if is_distributed else 1
+    optimizer = tf.train.MomentumOptimizer(
+        learning_rate=params["learning_rate"] * num_ranks * _ACCUMULATION_STEPS,
+        momentum=0.9,
+    )
+    if _ACCUMULATION_STEPS > 1:
+        allreduce = _get_allreduce() if is_distributed else None
+        optimizer = AccumulatingOptimizer(optimizer, allreduce=allreduce)
+    elif is_distributed:
+        compression = _get_compression()
+        if _COMPRESSION == "topk":
+            optimizer = TopKDistributedOptimizer(optimizer)
+        else:
+            # Horovod: add Horovod Distributed Optimizer.
+            optimizer = hvd.DistributedOptimizer(optimizer, compression=compression)
+    if _compute_dtype() == tf.float16:
+        optimizer = LossScalingOptimizer(optimizer)
+    return optimizer
 
 
 def build_network(features, mode, params):
     network = resnet_v1(
         resnet_depth=50, num_classes=params["classes"], data_format="channels_first"
     )
-    return network(inputs=features, is_training=(mode == tf.estimator.ModeKeys.TRAIN))
+    dtype = _compute_dtype()
+    if dtype == tf.float32:
+        return network(
+            inputs=features, is_training=(mode == tf.estimator.ModeKeys.TRAIN)
+        )
+    # The layers compute in dtype and keep their variables in float32
+    with tf.variable_scope(
+        tf.get_variable_scope(), custom_getter=_float32_variable_getter
+    ):
+        logits = network(
+            inputs=tf.cast(features, dtype),
+            is_training=(mode == tf.estimator.ModeKeys.TRAIN),
+        )
+    return tf.cast(logits, tf.float32)
+
+
+def _eval_metric_ops(logits, labels, cross_entropy, is_distributed=_DISTRIBUTED):
+    """ Top-1 and top-5 accuracy and loss over the validation data of every rank
+
+    Each rank sums the hits and the loss over its shard of the validation data in
+    local variables. When the metrics are read at the end of the evaluation the sums
+    are added up across the ranks with a single allreduce.
+    """
+    labels = tf.cast(labels, tf.int32)
+    values = [
+        cross_entropy,
+        tf.to_float(tf.nn.in_top_k(logits, labels, 1)),
+        tf.to_float(tf.nn.in_top_k(logits, labels, 5)),
+        tf.ones_like(cross_entropy),
+    ]
+    totals = tf.Variable(
+        tf.zeros([len(values)]),
+        trainable=False,
+        collections=[tf.GraphKeys.LOCAL_VARIABLES, tf.GraphKeys.METRIC_VARIABLES],
+        name="validation_totals",
+    )
+    update_op = tf.assign_add(
+        totals, tf.stack([tf.reduce_sum(value) for value in values])
+    )
+    summed = hvd.allreduce(totals, average=False) if is_distributed else totals
+    count = tf.maximum(summed[3], 1.0)
+    return {
+        "cross_entropy": (summed[0] / count, update_op),
+        "top_1": (summed[1] / count, update_op),
+        "top_5": (summed[2] / count, update_op),
+        "images": (summed[3], update_op),
+    }
 
 
 def model_fn(features, labels, mode, params):
@@ -200,17 +596,7 @@ def model_fn(features, labels, mode, params):
     loss = tf.reduce_mean(cross_entropy)
 
     if mode == tf.estimator.ModeKeys.EVAL:
-        # Softmax output of the neural network.
-        y_pred = tf.nn.softmax(logits=logits)
-
-        # Classification output of the neural network.
-        y_pred_cls = tf.argmax(y_pred, axis=1)
-
-        accuracy = tf.metrics.accuracy(
-            labels=tf.argmax(labels, axis=1), predictions=y_pred_cls, name="acc_op"
-        )
-        metrics = {"accuracy": accuracy}
-        tf.summary.scalar("accuracy", accuracy[1])
+        metrics = _eval_metric_ops(logits, labels, cross_entropy)
         return tf.estimator.EstimatorSpec(mode=mode, eval_metric_ops=metrics, loss=loss)
 
     optimizer = _get_optimizer(params)
@@ -220,38 +606,62 @@ def model_fn(features, labels, mode, params):
     return tf.estimator.EstimatorSpec(mode=mode, loss=loss, train_op=train_op)
 
 
-def _append_path_to(data_path, data_series):
-    return data_series.apply(lambda x: path.join(data_path, x))
+def _get_rank_and_size(is_distributed=_DISTRIBUTED):
+    if is_distributed:
+        return hvd.rank(), hvd.size()
+    else:
+        return 0, 1
+
+
+def _load_file_index(data_dir, name):
+    logger = _get_logger()
+    if FileIndex.exists(data_dir, name):
+        return FileIndex.load(data_dir, name)
+    logger.warning(
+        "No file index for {} in {}, listing the images instead. "
+        "Run file_index.py once to speed this up".format(name, data_dir)
+    )
+    return FileIndex.from_directory(data_dir)
 
 
 def _load_training(data_dir):
-    return list(glob.glob(Path(data_dir) / "**" / "*.jpg"))
+    return _load_file_index(data_dir, "train")
 
 
 def _load_validation(data_dir):
-    return list(glob.glob(Path(data_dir) / "**" / "*.jpg"))
+    return _load_file_index(data_dir, "validation")
+
+
+def _file_dataset(index, shuffle=False, shard=False):
+    """ Creates a dataset of filenames and labels from a FileIndex
+
+    If shard is True each rank only gets every size-th file, starting at its rank, so
+    the ranks read disjoint parts of the data.
+    """
+    rank, size = _get_rank_and_size() if shard else (0, 1)
+    root = tf.constant(os.path.join(index.root, ""))
+    dataset = tf.data.Dataset.from_tensor_slices((index.paths, index.labels))
+    dataset = dataset.shard(size, rank)
+    if shuffle:
+        dataset = dataset.shuffle(len(index) // size + 1, seed=_SEED)
+    return dataset.map(lambda filename, label: (root + filename, label))
 
 
 def _create_data_fn(train_path, test_path):
     logger = _get_logger()
     logger.info("Reading training data info")
-    train_df = _load_training(train_path)
+    train_index = _load_training(train_path)
 
     logger.info("Reading validation data info")
-    validation_df = _load_validation(test_path)
-
-    train_labels = train_df[["num_id"]].values.ravel() - 1
-    validation_labels = validation_df[["num_id"]].values.ravel() - 1
+    validation_index = _load_validation(test_path)
 
-    train_data = tf.data.Dataset.from_tensor_slices(
-        (train_df["filenames"].values, train_labels)
-    )
+    train_data = _file_dataset(train_index, shuffle=True, shard=True)
     train_data_transform = tf.contrib.data.map_and_batch(
-        _parse_function_train, _BATCHSIZE, num_parallel_batches=5
+        _parse_function_train, _BATCHSIZE, num_parallel_batches=_NUM_WORKERS
     )
     train_data = train_data.apply(
         tf.contrib.data.parallel_interleave(
-            _prep, cycle_length=5, buffer_output_elements=1024
+            _prep, cycle_length=_NUM_WORKERS, buffer_output_elements=1024
         )
     )
 
@@ -259,9 +669,7 @@ def _create_data_fn(train_path, test_path):
         train_data.shuffle(1024).repeat().apply(train_data_transform).prefetch(_BUFFER)
     )
 
-    validation_data = tf.data.Dataset.from_tensor_slices(
-        (validation_df["filenames"].values, validation_labels)
-    )
+    validation_data = _file_dataset(validation_index, shard=True)
     validation_data_transform = tf.contrib.data.map_and_batch(
         _parse_function_eval, _BATCHSIZE, num_parallel_batches=4
     )
@@ -273,10 +681,211 @@ def _create_data_fn(train_path, test_path):
     def _validation_input_fn():
         return validation_data.make_one_shot_iterator().get_next()
 
-    _train_input_fn.length = len(train_df)
-    _validation_input_fn.length = len(validation_df)
-    _train_input_fn.classes = 1000
-    _validation_input_fn.classes = 1000
+    _train_input_fn.length = len(train_index)
+    _validation_input_fn.length = len(validation_index)
+    _train_input_fn.classes = len(train_index.classes)
+    _validation_input_fn.classes = len(train_index.classes)
+
+    return _train_input_fn, _validation_input_fn
+
+
+def _num_parallel_calls(is_distributed=_DISTRIBUTED):
+    """ Number of cores for each rank on this machine unless NUM_PARALLEL_CALLS is set
+    """
+    if os.getenv("NUM_PARALLEL_CALLS"):
+        return int(os.getenv("NUM_PARALLEL_CALLS"))
+    local_size = hvd.local_size() if is_distributed else 1
+    return max(os.cpu_count() // local_size, 1)
+
+
+def _prefetch_to_device(dataset):
+    if _PREFETCH_TO_DEVICE:
+        # Each rank only sees its own GPU, see _get_runconfig
+        return dataset.apply(tf.contrib.data.prefetch_to_device("/gpu:0"))
+    else:
+        return dataset
+
+
+def _parallel_file_input_fn(index, parse_fn, train=False, shard=False):
+    """ Returns an input_fn which reads the files in index with one flat map
+
+    The file list is split between the ranks before anything is read and then
+    shuffled. A single map reads, decodes and augments each file on all the cores
+    this rank has, so there is no per sample dataset as with _prep. The input_fn
+    returns the dataset, so the Estimator builds it in its own graph.
+    """
+
+    def _input_fn():
+        dataset = _file_dataset(index, shuffle=train, shard=shard)
+        if train:
+            dataset = dataset.repeat()
+        dataset = dataset.map(parse_fn, num_parallel_calls=_num_parallel_calls())
+        dataset = dataset.batch(_BATCHSIZE).prefetch(_BUFFER)
+        return _prefetch_to_device(dataset)
+
+    return _input_fn
+
+
+def _create_parallel_data_fn(train_path, test_path):
+    logger = _get_logger()
+    logger.info("Reading training data info")
+    train_index = _load_training(train_path)
+
+    logger.info("Reading validation data info")
+    validation_index = _load_validation(test_path)
+
+    _train_input_fn = _parallel_file_input_fn(
+        train_index, _parse_file_train, train=True, shard=True
+    )
+    _validation_input_fn = _parallel_file_input_fn(
+        validation_index, _parse_function_eval, shard=True
+    )
+
+    _train_input_fn.length = len(train_index)
+    _validation_input_fn.length = len(validation_index)
+    _train_input_fn.classes = len(train_index.classes)
+    _validation_input_fn.classes = len(train_index.classes)
+
+    return _train_input_fn, _validation_input_fn
+
+
+def _shard_dataset(data_dir, name, shuffle=False, shard=False):
+    """ Creates a dataset of encoded images and labels from shards written by shards.py
+
+    The shards are read one after another with a single read each. If shuffle is
+    True the shards are visited in a different order every epoch. If shard is True
+    each rank reads every size-th shard file, starting at its rank.
+    """
+    logger = _get_logger()
+    reader = ShardReader(data_dir, name)
+    rank, size = _get_rank_and_size() if shard else (0, 1)
+    shards = list(range(reader.num_shards))
+    if reader.num_shards >= size:
+        shards = shards[rank::size]
+    elif size > 1:
+        logger.warning(
+            "{} shards for {} ranks, every rank reads all the shards".format(
+                reader.num_shards, size
+            )
+        )
+    epochs = itertools.count()
+
+    def _samples():
+        seed = _SEED + next(epochs) if shuffle else None
+        return reader.iter_shards(shards=shards, seed=seed)
+
+    dataset = tf.data.Dataset.from_generator(
+        _samples,
+        output_types=(tf.string, tf.int32),
+        output_shapes=(tf.TensorShape([]), tf.TensorShape([])),
+    )
+    if reader.num_shards < size:
+        dataset = dataset.shard(size, rank)
+    return dataset, len(reader), len(reader.classes)
+
+
+def _create_shard_data_fn(train_path, test_path):
+    logger = _get_logger()
+    logger.info("Reading training shards")
+    train_data, train_length, classes = _shard_dataset(
+        train_path, "train", shuffle=True, shard=True
+    )
+
+    logger.info("Reading validation shards")
+    validation_data, validation_length, _ = _shard_dataset(
+        test_path, "validation", shard=True
+    )
+
+    train_data_transform = tf.contrib.data.map_and_batch(
+        _parse_encoded_train,
+        _BATCHSIZE,
+        num_parallel_batches=_NUM_WORKERS,
+    )
+    train_data = (
+        train_data.shuffle(1024).repeat().apply(train_data_transform).prefetch(_BUFFER)
+    )
+
+    validation_data_transform = tf.contrib.data.map_and_batch(
+        _parse_encoded_eval, _BATCHSIZE, num_parallel_batches=4
+    )
+    validation_data = validation_data.apply(validation_data_transform).prefetch(_BUFFER)
+
+    def _train_input_fn():
+        return train_data.make_one_shot_iterator().get_next()
+
+    def _validation_input_fn():
+        return validation_data.make_one_shot_iterator().get_next()
+
+    _train_input_fn.length = train_length
+    _validation_input_fn.length = validation_length
+    _train_input_fn.classes = classes
+    _validation_input_fn.classes = classes
+
+    return _train_input_fn, _validation_input_fn
+
+
+def _cache_dataset(data_dir, name, shuffle=False, shard=False):
+    """ Creates a dataset of uint8 HWC images and labels from a cache written by
+    image_cache.py
+
+    The images are read out of the memory mapped cache by index in parallel. If
+    shard is True each rank only reads every size-th image, starting at its rank.
+    """
+    rank, size = _get_rank_and_size() if shard else (0, 1)
+    cache = ImageCache(data_dir, name)
+
+    def _read(idx):
+        return np.ascontiguousarray(cache.images[idx]), cache.labels[idx]
+
+    def _load(idx):
+        img, label = tf.py_func(_read, [idx], [tf.uint8, tf.int32], stateful=False)
+        img.set_shape(cache.images.shape[1:])
+        label.set_shape([])
+        if cache.layout == "NCHW":
+            img = tf.transpose(img, [1, 2, 0])
+        return img, label
+
+    dataset = tf.data.Dataset.range(len(cache)).shard(size, rank)
+    if shuffle:
+        dataset = dataset.shuffle(len(cache) // size + 1, seed=_SEED).repeat()
+    dataset = dataset.map(_load, num_parallel_calls=_NUM_WORKERS)
+    return dataset, len(cache), len(cache.classes)
+
+
+def _create_cache_data_fn(train_path, test_path):
+    logger = _get_logger()
+    logger.info("Reading training cache")
+    train_data, train_length, classes = _cache_dataset(
+        train_path, "train", shuffle=True, shard=True
+    )
+
+    logger.info("Reading validation cache")
+    validation_data, validation_length, _ = _cache_dataset(
+        test_path, "validation", shard=True
+    )
+
+    train_data_transform = tf.contrib.data.map_and_batch(
+        _parse_cached_train,
+        _BATCHSIZE,
+        num_parallel_batches=_NUM_WORKERS,
+    )
+    train_data = train_data.apply(train_data_transform).prefetch(_BUFFER)
+
+    validation_data_transform = tf.contrib.data.map_and_batch(
+        _parse_cached_eval, _BATCHSIZE, num_parallel_batches=4
+    )
+    validation_data = validation_data.apply(validation_data_transform).prefetch(_BUFFER)
+
+    def _train_input_fn():
+        return train_data.make_one_shot_iterator().get_next()
+
+    def _validation_input_fn():
+        return validation_data.make_one_shot_iterator().get_next()
+
+    _train_input_fn.length = train_length
+    _validation_input_fn.length = validation_length
+    _train_input_fn.classes = classes
+    _validation_input_fn.classes = classes
 
     return _train_input_fn, _validation_input_fn
 
@@ -345,20 +954,34 @@ def _create_fake_data_fn(train_length=_DATA_LENGTH, valid_length=50000, num_batc
     return _train_input_fn, _validation_input_fn
 
 
+def _create_input_fns(train_path, test_path):
+    if _FAKE:
+        return _create_fake_data_fn()
+    elif _DATA_FORMAT == "shards":
+        return _create_shard_data_fn(train_path, test_path)
+    elif _DATA_FORMAT == "cache":
+        return _create_cache_data_fn(train_path, test_path)
+    elif _PIPELINE == "map":
+        return _create_parallel_data_fn(train_path, test_path)
+    else:
+        return _create_data_fn(train_path, test_path)
+
+
 def _get_runconfig(is_distributed=_DISTRIBUTED):
+    # The Estimator's own CheckpointSaverHook is replaced by AsyncCheckpointHook
+    checkpoint_args = dict(
+        save_checkpoints_steps=None,
+        save_checkpoints_secs=None,
+        keep_checkpoint_max=_KEEP_CHECKPOINTS,
+    )
     if is_distributed:
         # Horovod: pin GPU to be used to process local rank (one GPU per process)
         config = tf.ConfigProto()
         config.gpu_options.allow_growth = True
         config.gpu_options.visible_device_list = str(hvd.local_rank())
-
-        return tf.estimator.RunConfig(
-            save_checkpoints_steps=None,
-            save_checkpoints_secs=None,
-            session_config=config,
-        )
+        return tf.estimator.RunConfig(session_config=config, **checkpoint_args)
     else:
-        return tf.estimator.RunConfig(save_checkpoints_steps=None)
+        return tf.estimator.RunConfig(**checkpoint_args)
 
 
 def _get_model_dir(is_distributed=_DISTRIBUTED):
@@ -384,6 +1007,162 @@ def _get_hooks(is_distributed=_DISTRIBUTED):
         return []
 
 
+class SaverCheckpointWriter(AsyncCheckpointWriter):
+    """ Writes snapshots of the variables as TensorFlow checkpoints in the background
+
+    The snapshot, the values of variables, is fed to copies of the variables in a
+    graph of its own and saved by a Saver on the writer thread. The Saver writes each
+    checkpoint to temporary files and renames them into place, keeps the newest
+    `keep` and updates the checkpoint state file, so the Estimator restores from
+    them as from its own checkpoints. The epoch of the writer is the global step.
+    """
+
+    def __init__(self, model_dir, variables, keep=_KEEP_CHECKPOINTS):
+        self._prefix = os.path.join(model_dir, "model.ckpt")
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._values = [
+                tf.placeholder(v.dtype.base_dtype, shape=v.shape) for v in variables
+            ]
+            copies = [
+                tf.Variable(value, name=v.op.name, trainable=False)
+                for v, value in zip(variables, self._values)
+            ]
+            self._assign = [copy.initializer for copy in copies]
+            self._saver = tf.train.Saver(copies, max_to_keep=keep, sharded=True)
+        state = tf.train.get_checkpoint_state(model_dir)
+        if state is not None:
+            # So that the checkpoints from before a resume count towards keep
+            self._saver.recover_last_checkpoints(state.all_model_checkpoint_paths)
+        self._session = tf.Session(graph=self._graph)
+        super(SaverCheckpointWriter, self).__init__(
+            self._prefix + "-{epoch}.index", None, keep=keep
+        )
+
+    def _write(self, step, snapshot):
+        self._session.run(self._assign, feed_dict=dict(zip(self._values, snapshot)))
+        filename = self._saver.save(
+            self._session, self._prefix, global_step=step, write_meta_graph=False
+        )
+        _get_logger().info("Saved checkpoint {}".format(filename))
+
+    def close(self):
+        super(SaverCheckpointWriter, self).close()
+        self._session.close()
+
+
+class AsyncCheckpointHook(tf.train.SessionRunHook):
+    """ Saves a checkpoint every checkpoint_steps steps and at the end of training
+
+    Unlike the Estimator's CheckpointSaverHook, which saves inside the session while
+    the other ranks wait at the next allreduce, only the copy of the variables to
+    host memory happens on the training thread and SaverCheckpointWriter writes them
+    in the background. end() waits for the last checkpoint, so evaluation finds it.
+    """
+
+    def __init__(
+        self, model_dir, checkpoint_steps=_CHECKPOINT_STEPS, keep=_KEEP_CHECKPOINTS
+    ):
+        self._model_dir = model_dir
+        self._checkpoint_steps = checkpoint_steps
+        self._keep = keep
+        self._writer = None
+        self._saved_step = None
+
+    def begin(self):
+        self._global_step = tf.train.get_global_step()
+        self._variables = tf.global_variables()
+        self._writer = SaverCheckpointWriter(
+            self._model_dir, self._variables, keep=self._keep
+        )
+
+    def after_create_session(self, session, coord):
+        self._saved_step = session.run(self._global_step)
+
+    def before_run(self, run_context):
+        return tf.train.SessionRunArgs(self._global_step)
+
+    def after_run(self, run_context, run_values):
+        # The global step may have been read before this step incremented it, so it
+        # is read again once a checkpoint could be due, as CheckpointSaverHook does
+        next_step = self._saved_step + self._checkpoint_steps
+        if run_values.results + 1 >= next_step:
+            if run_context.session.run(self._global_step) >= next_step:
+                self._save(run_context.session)
+
+    def _save(self, session):
+        step, snapshot = session.run((self._global_step, self._variables))
+        self._writer.write(step, snapshot)
+        self._saved_step = step
+
+    def end(self, session):
+        if session.run(self._global_step) != self._saved_step:
+            self._save(session)
+        self._writer.close()
+
+
+class StepMetricsHook(tf.train.SessionRunHook):
+    """ Records the time spent in each training session run and between runs
+
+    The input pipeline runs inside the session, so the run phase includes any time
+    spent waiting on it. The host phase is the Python overhead between runs.
+
+    With straggler_steps the ranks are compared every straggler_steps steps. The ranks
+    wait for each other inside the run phase, together with the input pipeline and
+    the compute, so only a rank whose host phase is slow can be found.
+    """
+
+    def __init__(
+        self,
+        batch_size,
+        log_every=100,
+        straggler_steps=_STRAGGLER_STEPS,
+        is_distributed=_DISTRIBUTED,
+    ):
+        self._batch_size = batch_size
+        self._log_every = log_every
+        self._straggler_steps = straggler_steps if is_distributed else 0
+        self._metrics = None
+        self._straggler_monitor = None
+
+    def begin(self):
+        if self._straggler_steps > 0:
+            # The graph is finalized after begin, so the allgather is created here
+            self._values = tf.placeholder(tf.float64, shape=(1, None))
+            self._gathered = hvd.allgather(self._values)
+
+    def after_create_session(self, session, coord):
+        self._metrics = StepMetrics(
+            self._batch_size, phases=("host", "run"), rank=_get_rank()
+        )
+        self._metrics.start()
+        if self._straggler_steps > 0:
+            self._straggler_monitor = StragglerMonitor(
+                lambda array: session.run(
+                    self._gathered, feed_dict={self._values: array[None]}
+                ),
+                every=self._straggler_steps,
+                input_phases=(),
+                wait_phases=("run",),
+                rank=hvd.rank(),
+                logger=_get_logger(),
+            )
+
+    def before_run(self, run_context):
+        self._metrics.mark("host")
+
+    def after_run(self, run_context, run_values):
+        self._metrics.mark("run")
+        self._metrics.end_step()
+        if self._straggler_monitor is not None:
+            self._straggler_monitor.update(self._metrics)
+        if self._metrics.steps % self._log_every == 1:
+            _get_logger().info(self._metrics.format())
+        # The straggler check waits for the other ranks, neither it nor the logging
+        # is part of a step
+        self._metrics.skip()
+
+
 def _is_master(is_distributed=_DISTRIBUTED):
     if is_distributed:
         if hvd.rank() == 0:
@@ -394,6 +1173,35 @@ def _is_master(is_distributed=_DISTRIBUTED):
         return True
 
 
+def _barrier(is_distributed=_DISTRIBUTED):
+    """ Waits until every rank gets here """
+    if is_distributed:
+        with tf.Graph().as_default():
+            barrier = hvd.allreduce(tf.constant(0.0))
+            with tf.Session(config=_get_runconfig().session_config) as sess:
+                sess.run(barrier)
+
+
+def _resume_step(is_distributed=_DISTRIBUTED):
+    """ Returns the global step of rank 0's latest checkpoint, 0 if there is none
+
+    Rank 0's Estimator restores the checkpoint itself and BroadcastGlobalVariablesHook
+    hands the variables, including the global step, to the other ranks. The step is
+    broadcast here as well so that every rank agrees on how many steps are left.
+    """
+    step = 0
+    if _is_master():
+        checkpoint = tf.train.latest_checkpoint(os.getenv("AZ_BATCHAI_OUTPUT_MODEL"))
+        if checkpoint is not None:
+            step = int(tf.train.load_variable(checkpoint, tf.GraphKeys.GLOBAL_STEP))
+    if is_distributed:
+        with tf.Graph().as_default():
+            broadcast = hvd.broadcast(tf.constant(step, dtype=tf.int64), 0)
+            with tf.Session(config=_get_runconfig().session_config) as sess:
+                step = int(sess.run(broadcast))
+    return step
+
+
 def _log_summary(data_length, duration):
     logger = _get_logger()
     images_per_second = data_length / duration
@@ -405,6 +1213,8 @@ def _log_summary(data_length, duration):
             _BATCHSIZE, hvd.size() * _BATCHSIZE if _DISTRIBUTED else _BATCHSIZE
         )
     )
+    logger.info("Accumulation:     {}".format(_ACCUMULATION_STEPS))
+    logger.info("Precision:        {}".format(_compute_dtype().name))
     logger.info("Distributed:      {}".format("True" if _DISTRIBUTED else "False"))
     logger.info("Num GPUs:         {:.3f}".format(hvd.size() if _DISTRIBUTED else 1))
     logger.info("Dataset:          {}".format("Synthetic" if _FAKE else "Imagenet"))
@@ -415,18 +1225,17 @@ def main():
     if _DISTRIBUTED:
         # Horovod: initialize Horovod.
         hvd.init()
+        set_rank(_get_rank(), log_dir=_LOG_DIR)
         logger = _get_logger()
         logger.info("Runnin Distributed")
     else:
+        set_rank(_get_rank(), log_dir=_LOG_DIR)
         logger = _get_logger()
 
     logger.info("Tensorflow version {}".format(tf.__version__))
-    if _FAKE:
-        train_input_fn, validation_input_fn = _create_fake_data_fn()
-    else:
-        train_input_fn, validation_input_fn = _create_data_fn(
-            os.getenv("AZ_BATCHAI_INPUT_TRAIN"), os.getenv("AZ_BATCHAI_INPUT_TEST")
-        )
+    train_input_fn, validation_input_fn = _create_input_fns(
+        os.getenv("AZ_BATCHAI_INPUT_TRAIN"), os.getenv("AZ_BATCHAI_INPUT_TEST")
+    )
 
     run_config = _get_runconfig()
     model_dir = _get_model_dir()
@@ -438,21 +1247,41 @@ def main():
     )
 
     hooks = _get_hooks()
+    hooks.append(StepMetricsHook(_BATCHSIZE))
+    if _is_master() and model_dir is not None:
+        # Horovod: only rank 0 checkpoints, the other ranks resume and evaluate from
+        # its checkpoints
+        hooks.append(AsyncCheckpointHook(model_dir))
     num_gpus = hvd.size() if _DISTRIBUTED else 1
+    max_steps = _EPOCHS * train_input_fn.length // (_BATCHSIZE * num_gpus)
+    resume_step = min(_resume_step(), max_steps)
+    if resume_step > 0:
+        logger.info("Resuming from step {} of {}".format(resume_step, max_steps))
     with Timer(output=logger.info, prefix="Training") as t:
         logger.info("Training...")
-        model.train(
-            input_fn=train_input_fn,
-            steps=_EPOCHS * train_input_fn.length // (_BATCHSIZE * num_gpus),
-            hooks=hooks,
-        )
+        if resume_step < max_steps:
+            model.train(input_fn=train_input_fn, max_steps=max_steps, hooks=hooks)
 
-    _log_summary(_EPOCHS * train_input_fn.length, t.elapsed)
+    _log_summary((max_steps - resume_step) * _BATCHSIZE * num_gpus, t.elapsed)
 
-    if _is_master() and _FAKE is False and _VALIDATION:
+    if _FAKE is False and _VALIDATION:
+        # Every rank evaluates its shard of the validation data from the checkpoint
+        # rank 0 saved at the end of training
+        _barrier()
+        checkpoint = tf.train.latest_checkpoint(os.getenv("AZ_BATCHAI_OUTPUT_MODEL"))
         with Timer(output=logger.info, prefix="Testing"):
             logger.info("Testing...")
-            model.evaluate(input_fn=validation_input_fn)
+            results = model.evaluate(
+                input_fn=validation_input_fn, checkpoint_path=checkpoint
+            )
+        logger.info(
+            "Validation loss: {:.4f} top-1: {:.4f} top-5: {:.4f} images: {}".format(
+                results["cross_entropy"],
+                results["top_1"],
+                results["top_5"],
+                int(results["images"]),
+            )
+        )
 
 
 if __name__ == "__main__":
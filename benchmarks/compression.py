@@ -0,0 +1,238 @@
+"""
+Checks the gradient compression of the three trainers on CPU.
+
+COMPRESSION=topk sends only the largest TOPK_RATIO of the elements of each gradient
+and keeps the rest in a residual that is added to the next gradient. Each trainer's
+own _topk_compress and _topk_decompress are run without Horovod on a sequence of
+random gradients and the check fails unless
+
+    the first step sends exactly the k largest elements by magnitude
+    no step sends more than k elements
+    the elements sent over all the steps plus the final residual add up to the sum
+    of the gradients, so error feedback loses nothing
+
+COMPRESSION=fp16 is checked through each trainer's own _get_compression, with
+horovod.torch, or local_horovod.py if it is not installed, for PyTorch and
+horovod.keras and horovod.tensorflow for the others. The compressed gradient has to
+be float16 and the round trip has to stay within the half precision rounding error.
+
+The two checks are reported separately. A framework that can not be imported fails
+both, a framework whose Horovod is not installed, as on most CPU machines for Keras
+and TensorFlow, still runs the top-k check and reports the fp16 check as
+unavailable.
+
+Usage:
+    python benchmarks/compression.py --frameworks pytorch tf keras --ratio 0.01
+"""
+import argparse
+import importlib
+import logging
+import sys
+from os import path
+
+import numpy as np
+
+_ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, path.join(_ROOT, "common"))
+
+# The Horovod modules that provide the trainers' hvd, the first one installed is used
+_HOROVOD = {
+    "pytorch": ("horovod.torch", "local_horovod"),
+    "keras": ("horovod.keras",),
+    "tf": ("horovod.tensorflow",),
+}
+_TRAINERS = {
+    "pytorch": ("HorovodPytorch", "imagenet_pytorch_horovod"),
+    "keras": ("HorovodKeras", "imagenet_keras_horovod"),
+    "tf": ("HorovodTF", "imagenet_estimator_tf_horovod"),
+}
+_SEED = 42
+# Half precision keeps 11 significant bits
+_FP16_RELATIVE_ERROR = 2.0 ** -11
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def _import_trainer(framework):
+    directory, module_name = _TRAINERS[framework]
+    sys.path.insert(0, path.join(_ROOT, directory, "src"))
+    return importlib.import_module(module_name)
+
+
+def _fp16_compression(trainer, framework):
+    """ Returns the trainer's compression for COMPRESSION=fp16
+
+    The trainers only import Horovod as hvd when DISTRIBUTED is set, so it is
+    imported here if the trainer has none.
+    """
+    if not hasattr(trainer, "hvd"):
+        error = None
+        for module_name in _HOROVOD[framework]:
+            try:
+                trainer.hvd = importlib.import_module(module_name)
+                break
+            except ImportError as e:
+                error = error or e
+        else:
+            raise error
+    return trainer._get_compression("fp16")
+
+
+def _pytorch_topk(trainer, gradients, ratio):
+    import torch
+
+    residual = torch.zeros(gradients[0].size)
+    sent = []
+    for gradient in gradients:
+        values, indices = trainer._topk_compress(
+            torch.from_numpy(gradient), residual, ratio=ratio
+        )
+        sent.append(
+            trainer._topk_decompress(values, indices, gradient.shape).numpy().copy()
+        )
+    return sent, residual.numpy().reshape(gradients[0].shape)
+
+
+def _pytorch_fp16(trainer, array):
+    """ Returns whether the compressed gradient is float16 and the round trip """
+    import torch
+
+    compression = _fp16_compression(trainer, "pytorch")
+    compressed, ctx = compression.compress(torch.from_numpy(array))
+    restored = compression.decompress(compressed, ctx)
+    return compressed.dtype == torch.float16, restored.float().numpy()
+
+
+def _tf_topk(trainer, gradients, ratio):
+    import tensorflow as tf
+
+    with tf.Graph().as_default():
+        gradient = tf.placeholder(tf.float32, shape=gradients[0].shape)
+        residual = tf.Variable(tf.zeros([gradients[0].size]), trainable=False)
+        values, indices = trainer._topk_compress(gradient, residual, ratio=ratio)
+        dense = trainer._topk_decompress(values, indices, gradient.shape)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sent = [sess.run(dense, feed_dict={gradient: g}) for g in gradients]
+            return sent, sess.run(residual).reshape(gradients[0].shape)
+
+
+def _tf_fp16(trainer, array, framework):
+    """ Returns whether the compressed gradient is float16 and the round trip """
+    import tensorflow as tf
+
+    compression = _fp16_compression(trainer, framework)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        compressed, ctx = compression.compress(tf.constant(array))
+        restored = compression.decompress(compressed, ctx)
+        return compressed.dtype == tf.float16, sess.run(tf.cast(restored, tf.float32))
+
+
+_TOPK = {"pytorch": _pytorch_topk, "keras": _tf_topk, "tf": _tf_topk}
+_FP16 = {
+    "pytorch": _pytorch_fp16,
+    "keras": lambda trainer, array: _tf_fp16(trainer, array, "keras"),
+    "tf": lambda trainer, array: _tf_fp16(trainer, array, "tf"),
+}
+
+
+def _check_topk(gradients, sent, residual, ratio):
+    """ Returns the list of the failed conditions """
+    failures = []
+    k = max(1, int(gradients[0].size * ratio))
+    expected = np.argsort(-np.abs(gradients[0]).ravel())[:k]
+    if set(np.flatnonzero(sent[0])) != set(expected):
+        failures.append("the first step did not send the {} largest elements".format(k))
+    most_sent = max(np.count_nonzero(s) for s in sent)
+    if most_sent > k:
+        failures.append("a step sent {} elements, more than {}".format(most_sent, k))
+    total = np.sum(gradients, axis=0)
+    error = np.max(np.abs(np.sum(sent, axis=0) + residual - total))
+    if error > 1e-4 * max(1.0, np.max(np.abs(total))):
+        failures.append("sent plus residual is off the sum by {:.3g}".format(error))
+    return failures
+
+
+def _check_fp16(array, is_half, restored):
+    failures = []
+    if not is_half:
+        failures.append("the fp16 compression does not send float16")
+    error = np.max(np.abs(restored - array) / np.abs(array))
+    if error > _FP16_RELATIVE_ERROR:
+        failures.append(
+            "the fp16 round trip has a relative error of {:.3g}".format(error)
+        )
+    return failures
+
+
+def check_topk(
+    trainer, framework, shape=(64, 3, 3, 3), steps=20, ratio=0.01, seed=_SEED
+):
+    """ Runs the top-k round trip of framework's trainer
+
+    Returns:
+        the list of the failed conditions, empty if all passed
+    """
+    random_state = np.random.RandomState(seed)
+    gradients = [random_state.randn(*shape).astype(np.float32) for _ in range(steps)]
+    sent, residual = _TOPK[framework](trainer, gradients, ratio)
+    return _check_topk(gradients, sent, residual, ratio)
+
+
+def check_fp16(trainer, framework, shape=(64, 3, 3, 3), seed=_SEED):
+    """ Runs the fp16 round trip of framework's trainer
+
+    Returns:
+        the list of the failed conditions, empty if all passed
+
+    Raises:
+        ImportError if the Horovod of framework is not installed
+    """
+    random_state = np.random.RandomState(seed)
+    # Values well inside the half precision range, where the rounding error is relative
+    array = (random_state.uniform(0.5, 2.0, size=shape) * 1e-2).astype(np.float32)
+    return _check_fp16(array, *_FP16[framework](trainer, array))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--frameworks", nargs="+", choices=sorted(_TRAINERS), default=sorted(_TRAINERS)
+    )
+    parser.add_argument("--ratio", type=float, default=0.01)
+    parser.add_argument("--steps", type=int, default=20)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    logger = _get_logger()
+    failed = False
+    for framework in args.frameworks:
+        try:
+            trainer = _import_trainer(framework)
+        except ImportError as e:
+            logger.error("{}: could not be imported, {}".format(framework, e))
+            failed = True
+            continue
+        checks = (
+            ("top-k", check_topk, {"steps": args.steps, "ratio": args.ratio}),
+            ("fp16", check_fp16, {}),
+        )
+        for name, run_check, kwargs in checks:
+            try:
+                failures = run_check(trainer, framework, **kwargs)
+            except ImportError as e:
+                logger.warning("{} {}: unavailable, {}".format(framework, name, e))
+                continue
+            for failure in failures:
+                logger.error("{} {}: {}".format(framework, name, failure))
+            if failures:
+                failed = True
+            else:
+                logger.info("{} {}: passed".format(framework, name))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,469 @@
+"""
+Benchmarks the input pipelines of the three trainers on CPU.
+
+A small tree of synthetic JPEGs is written locally and each trainer's own data
+loading code is run with the model step replaced by a no-op, so only the time to
+produce batches is measured. Every combination of framework, data format, worker
+count, batch size and prefetch depth is run in a fresh process and the images/sec
+and per batch latency percentiles, overall and for each trial, are written to a JSON
+report. benchmarks/regression.py compares two reports.
+
+    fake     the trainer's synthetic data (FakeBatches, FakeDataGenerator and
+             _create_fake_data_fn)
+    images   the JPEG tree through ImageFolder, flow_from_directory and
+             _create_data_fn
+    shards   the tree packed by shards.py
+    cache    the tree decoded by image_cache.py
+
+Workers are DataLoader workers for PyTorch, OrderedEnqueuer workers for Keras and
+the parallel map calls for TensorFlow, with PIPELINE=map selecting the flat
+parallel map over the file index. Prefetch is the DataLoader prefetch_factor
+(where the installed PyTorch supports it), the Keras max_queue_size and the
+TensorFlow prefetch buffer. Any other environment variable the trainers read, for
+example BATCH_AUGMENT or PIPELINE, is passed through and recorded in the report.
+
+Usage:
+    python benchmarks/input_pipeline.py --frameworks pytorch tf --formats fake images \\
+        --workers 0 4 --batch-sizes 32 64 --prefetch 2 8 --output input_pipeline.json
+"""
+import argparse
+import importlib
+import itertools
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+
+import numpy as np
+
+_ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, path.join(_ROOT, "common"))
+
+from step_metrics import percentile  # noqa: E402
+from timer import perf_counter_ns  # noqa: E402
+
+_TRAINERS = {
+    "pytorch": ("HorovodPytorch", "imagenet_pytorch_horovod"),
+    "keras": ("HorovodKeras", "imagenet_keras_horovod"),
+    "tf": ("HorovodTF", "imagenet_estimator_tf_horovod"),
+}
+_FORMATS = ("fake", "images", "shards", "cache")
+_PERCENTILES = (50, 90, 95, 99)
+_SEED = 42
+_PASSED_THROUGH = (
+    "BATCH_AUGMENT",
+    "FAKE_LOW_MEMORY",
+    "MULTIPROCESSING",
+    "PIPELINE",
+    "PREFETCH_TO_DEVICE",
+)
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def make_image_tree(
+    root, num_classes=10, images_per_class=64, size=(320, 240), seed=_SEED
+):
+    """ Writes num_classes x images_per_class synthetic JPEGs as <root>/<class>/<image>
+
+    The images are smooth random colour fields with some noise, which compress and
+    decode more like photographs than pure noise does.
+    """
+    from PIL import Image
+
+    random_state = np.random.RandomState(seed)
+    width, height = size
+    for class_id in range(num_classes):
+        class_dir = path.join(root, "n{:08d}".format(class_id))
+        os.makedirs(class_dir, exist_ok=True)
+        for image_id in range(images_per_class):
+            coarse = random_state.randint(0, 256, size=(6, 8, 3)).astype(np.uint8)
+            img = np.asarray(
+                Image.fromarray(coarse).resize((width, height), Image.BICUBIC),
+                dtype=np.int16,
+            )
+            img = img + random_state.randint(-12, 13, size=img.shape)
+            Image.fromarray(np.clip(img, 0, 255).astype(np.uint8)).save(
+                path.join(class_dir, "{:06d}.jpg".format(image_id)), quality=90
+            )
+
+
+def prepare_data(data_dir, formats, num_classes=10, images_per_class=64):
+    """ Writes the synthetic train and validation trees, packs and caches them if
+    those formats are asked for and returns the train and test directory to use
+    for each format
+    """
+    from shards import write_shards
+    from image_cache import build_cache
+
+    logger = _get_logger()
+    dirs = {"fake": (data_dir, data_dir)}
+    images = {
+        "train": path.join(data_dir, "images", "train"),
+        "validation": path.join(data_dir, "images", "validation"),
+    }
+    if not path.isdir(images["train"]):
+        logger.info("Writing synthetic images to {}".format(data_dir))
+        make_image_tree(images["train"], num_classes, images_per_class, seed=_SEED)
+        make_image_tree(
+            images["validation"],
+            num_classes,
+            max(images_per_class // 4, 1),
+            seed=_SEED + 1,
+        )
+    dirs["images"] = (images["train"], images["validation"])
+
+    if "shards" in formats:
+        shards_dir = path.join(data_dir, "shards")
+        for name, image_dir in images.items():
+            write_shards(image_dir, shards_dir, name, shard_size=16 * 1024**2)
+        dirs["shards"] = (shards_dir, shards_dir)
+    if "cache" in formats:
+        cache_dir = path.join(data_dir, "cache")
+        for name, image_dir in images.items():
+            build_cache(image_dir, cache_dir, name)
+        dirs["cache"] = (cache_dir, cache_dir)
+    return dirs
+
+
+def _import_trainer(framework):
+    directory, module_name = _TRAINERS[framework]
+    sys.path.insert(0, path.join(_ROOT, directory, "src"))
+    return importlib.import_module(module_name)
+
+
+def _pytorch_batches(trainer, config):
+    import torch
+
+    if config["data_format"] == "fake":
+        loader = trainer.FakeBatches(batch_size=config["batch_size"], length=2**31)
+    else:
+        kwargs = {
+            "num_workers": config["workers"],
+            "pin_memory": torch.cuda.is_available(),
+        }
+        if config["workers"] > 0 and config["prefetch"] is not None:
+            kwargs["prefetch_factor"] = config["prefetch"]
+        dataset = trainer._training_dataset(config["train_dir"])
+        loader = torch.utils.data.DataLoader(
+            dataset, batch_size=config["batch_size"], shuffle=True, **kwargs
+        )
+    while True:
+        for data, target in loader:
+            yield len(target)
+
+
+def _keras_batches(trainer, config):
+    import keras
+
+    if config["data_format"] == "fake":
+        iterator = trainer._fake_data_iterator_from(length=2**31)
+    else:
+        iterator = trainer._training_data_iterator_from()
+
+    if config["workers"] == 0:
+        for i in itertools.count():
+            yield len(iterator[i % len(iterator)][1])
+    else:
+        enqueuer = keras.utils.OrderedEnqueuer(
+            iterator, use_multiprocessing=trainer._MULTIPROCESSING, shuffle=True
+        )
+        enqueuer.start(
+            workers=config["workers"], max_queue_size=trainer._MAX_QUEUE_SIZE
+        )
+        try:
+            for data, target in enqueuer.get():
+                yield len(target)
+        finally:
+            enqueuer.stop()
+
+
+def _tf_batches(trainer, config):
+    tf = trainer.tf
+    with tf.Graph().as_default():
+        train_input_fn, _ = trainer._create_input_fns(
+            config["train_dir"], config["test_dir"]
+        )
+        result = train_input_fn()
+        if isinstance(result, tf.data.Dataset):
+            iterator = result.make_initializable_iterator()
+            features, labels = iterator.get_next()
+            initializer = iterator.initializer
+        else:
+            features, labels = result
+            initializer = tf.no_op()
+        with tf.Session() as sess:
+            sess.run(initializer)
+            while True:
+                yield len(sess.run(labels))
+
+
+_BATCHES = {"pytorch": _pytorch_batches, "keras": _keras_batches, "tf": _tf_batches}
+
+
+def _configure(trainer, framework, config):
+    """ Overrides the trainer constants that the environment does not control """
+    trainer._BATCHSIZE = config["batch_size"]
+    if framework == "tf" and config["prefetch"] is not None:
+        trainer._BUFFER = config["prefetch"]
+
+
+def _measure(batches, num_batches, warmup):
+    """ Times num_batches batches after warmup ones, the no-op model step is to do
+    nothing with the batch
+    """
+    for _ in range(warmup):
+        next(batches)
+    latencies = []
+    images = 0
+    for _ in range(num_batches):
+        start = perf_counter_ns()
+        images += next(batches)
+        latencies.append((perf_counter_ns() - start) * 1e-9)
+    return images, latencies
+
+
+def _latency_ms(latencies):
+    latency_ms = dict(
+        ("p{}".format(q), percentile(latencies, q) * 1000) for q in _PERCENTILES
+    )
+    latency_ms["mean"] = float(np.mean(latencies)) * 1000
+    return latency_ms
+
+
+def run_config(config):
+    """ Runs all the trials of one configuration in this process """
+    framework = config["framework"]
+    trainer = _import_trainer(framework)
+    _configure(trainer, framework, config)
+
+    trials = []
+    trial_latencies_ms = []
+    latencies = []
+    for _ in range(config["trials"]):
+        batches = _BATCHES[framework](trainer, config)
+        try:
+            images, trial_latencies = _measure(
+                batches, config["num_batches"], config["warmup"]
+            )
+        finally:
+            batches.close()
+        trials.append(images / sum(trial_latencies))
+        trial_latencies_ms.append(_latency_ms(trial_latencies))
+        latencies.extend(trial_latencies)
+
+    result = {
+        "images_per_second": float(np.mean(trials)),
+        "images_per_second_std": (
+            float(np.std(trials, ddof=1)) if len(trials) > 1 else 0.0
+        ),
+        "trials": trials,
+        "latency_ms": _latency_ms(latencies),
+        "trial_latency_ms": trial_latencies_ms,
+    }
+    return result
+
+
+def _environment(config):
+    env = dict(os.environ)
+    env.update(
+        {
+            "DISTRIBUTED": "False",
+            "FAKE": str(config["data_format"] == "fake"),
+            "DATA_FORMAT": (
+                "images" if config["data_format"] == "fake" else config["data_format"]
+            ),
+            "AZ_BATCHAI_INPUT_TRAIN": config["train_dir"],
+            "AZ_BATCHAI_INPUT_TEST": config["test_dir"],
+            "NUM_WORKERS": str(max(config["workers"], 1)),
+            "NUM_PARALLEL_CALLS": str(max(config["workers"], 1)),
+            "PYTHONPATH": os.pathsep.join(
+                [path.join(_ROOT, "common"), env.get("PYTHONPATH", "")]
+            ),
+        }
+    )
+    if config["prefetch"] is not None:
+        env["MAX_QUEUE_SIZE"] = str(config["prefetch"])
+    return env
+
+
+def _run_in_subprocess(config, timeout):
+    """ Runs one configuration in a fresh interpreter so that the environment the
+    trainers read at import time, and the frameworks themselves, do not leak
+    between runs
+    """
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(config, f)
+        config_file = f.name
+    result_file = config_file + ".result"
+    try:
+        process = subprocess.run(
+            [
+                sys.executable,
+                path.abspath(__file__),
+                "--run-config",
+                config_file,
+                "--result",
+                result_file,
+            ],
+            env=_environment(config),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            timeout=timeout,
+        )
+        if process.returncode == 0 and path.exists(result_file):
+            with open(result_file) as f:
+                return json.load(f)
+        output = process.stdout.decode("utf-8", "replace").strip().splitlines()
+        return {
+            "error": output[-1] if output else "exit code {}".format(process.returncode)
+        }
+    except subprocess.TimeoutExpired:
+        return {"error": "timed out after {}s".format(timeout)}
+    finally:
+        for filename in (config_file, result_file):
+            if path.exists(filename):
+                os.remove(filename)
+
+
+def _configs(args, dirs):
+    seen = set()
+    for framework, data_format, workers, batch_size, prefetch in itertools.product(
+        args.frameworks, args.formats, args.workers, args.batch_sizes, args.prefetch
+    ):
+        if framework == "pytorch" and data_format == "fake":
+            # FakeBatches hands out ready made batches, there are no workers
+            workers, prefetch = 0, None
+        key = (framework, data_format, workers, batch_size, prefetch)
+        if key in seen:
+            continue
+        seen.add(key)
+        train_dir, test_dir = dirs[data_format]
+        yield {
+            "framework": framework,
+            "data_format": data_format,
+            "workers": workers,
+            "batch_size": batch_size,
+            "prefetch": prefetch,
+            "num_batches": args.num_batches,
+            "warmup": args.warmup,
+            "trials": args.trials,
+            "train_dir": train_dir,
+            "test_dir": test_dir,
+        }
+
+
+def sweep(args):
+    logger = _get_logger()
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="input_pipeline-")
+    dirs = prepare_data(data_dir, args.formats, args.num_classes, args.images_per_class)
+
+    results = []
+    for config in _configs(args, dirs):
+        result = _run_in_subprocess(config, args.timeout)
+        for key in ("framework", "data_format", "workers", "batch_size", "prefetch"):
+            result[key] = config[key]
+        if "error" in result:
+            logger.warning(
+                "{framework} {data_format} workers {workers} batch size "
+                "{batch_size} prefetch {prefetch} failed: {error}".format(**result)
+            )
+        else:
+            logger.info(
+                "{framework} {data_format} workers {workers} batch size {batch_size} "
+                "prefetch {prefetch}: {images_per_second:.1f} images/sec "
+                "p50 {p50:.1f}ms p99 {p99:.1f}ms".format(
+                    p50=result["latency_ms"]["p50"],
+                    p99=result["latency_ms"]["p99"],
+                    **result
+                )
+            )
+        results.append(result)
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+        },
+        "settings": {
+            "num_batches": args.num_batches,
+            "warmup": args.warmup,
+            "trials": args.trials,
+            "num_classes": args.num_classes,
+            "images_per_class": args.images_per_class,
+            "environment": dict(
+                (key, os.environ[key]) for key in _PASSED_THROUGH if key in os.environ
+            ),
+        },
+        "results": results,
+    }
+
+
+def _prefetch(value):
+    return None if value.lower() == "none" else int(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--frameworks", nargs="+", default=list(_TRAINERS), choices=list(_TRAINERS)
+    )
+    parser.add_argument(
+        "--formats", nargs="+", default=["fake", "images"], choices=_FORMATS
+    )
+    parser.add_argument("--workers", nargs="+", type=int, default=[0, 2, 4])
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[32, 64])
+    parser.add_argument(
+        "--prefetch",
+        nargs="+",
+        type=_prefetch,
+        default=[2, 8],
+        help="prefetch depths, none for the trainer's default",
+    )
+    parser.add_argument("--num-batches", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--trials", type=int, default=3)
+    parser.add_argument("--num-classes", type=int, default=10)
+    parser.add_argument("--images-per-class", type=int, default=64)
+    parser.add_argument(
+        "--data-dir",
+        default=None,
+        help="where to write the synthetic data, reused if it exists",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=1800,
+        help="seconds allowed for each configuration",
+    )
+    parser.add_argument("--output", default="input_pipeline.json")
+    parser.add_argument("--run-config", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_config:
+        with open(args.run_config) as f:
+            config = json.load(f)
+        result = run_config(config)
+        with open(args.result, "w") as f:
+            json.dump(result, f)
+        return
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    report = sweep(args)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    _get_logger().info("Wrote {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Compares a benchmark report with a baseline and fails if it regressed.
+
+Both files are reports of benchmarks/training.py, which trains the PyTorch trainer
+with the tiny model on synthetic data, or of benchmarks/input_pipeline.py, and the
+configurations, framework, data format, workers, batch size, prefetch and for the
+training reports the model and number of ranks, are matched between them. For
+every configuration in both the images/sec and the latency percentiles, of the
+training steps or of the batches, are compared as
+
+    change      the relative change of the mean over the trials
+    95% CI      Welch's t confidence interval of the change, from the spread of
+                the trials, if both sides have at least two
+
+A metric regresses if it got worse by more than the threshold and, when there is a
+confidence interval, the whole interval is on the worse side of zero, so that a
+difference within the noise of the trials does not fail the check. A
+configuration that ran in the baseline but failed in the new report regresses too.
+The report gets more trials, and tighter intervals, with --trials.
+
+Reports written before the per trial latencies were recorded are compared on
+their overall percentiles, without an interval.
+
+Usage:
+    python benchmarks/training.py --trials 5 --output baseline.json
+    ... change the code ...
+    python benchmarks/training.py --trials 5 --output new.json
+    python benchmarks/regression.py baseline.json new.json --threshold 0.05
+"""
+import argparse
+import json
+import logging
+import sys
+
+import numpy as np
+
+_KEY = ("framework", "data_format", "workers", "batch_size", "prefetch")
+# Only in the reports of benchmarks/training.py
+_TRAINING_KEY = ("model", "ranks")
+# Two sided 95% quantiles of Student's t for 1 to 30 degrees of freedom
+_T_95 = (
+    12.706,
+    4.303,
+    3.182,
+    2.776,
+    2.571,
+    2.447,
+    2.365,
+    2.306,
+    2.262,
+    2.228,
+    2.201,
+    2.179,
+    2.160,
+    2.145,
+    2.131,
+    2.120,
+    2.110,
+    2.101,
+    2.093,
+    2.086,
+    2.080,
+    2.074,
+    2.069,
+    2.064,
+    2.060,
+    2.056,
+    2.052,
+    2.048,
+    2.045,
+    2.042,
+)
+_Z_95 = 1.960
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def _t_95(degrees_of_freedom):
+    index = int(degrees_of_freedom) - 1
+    if index < 0:
+        return _T_95[0]
+    return _T_95[index] if index < len(_T_95) else _Z_95
+
+
+def compare(baseline, new):
+    """ Returns the relative change of the mean of new from baseline and its 95%
+    confidence interval
+
+    Args:
+        baseline, new: the values of the trials
+
+    Returns:
+        (change, (low, high)), the interval is None unless both have two or more
+        trials
+    """
+    baseline = np.asarray(baseline, dtype=np.float64)
+    new = np.asarray(new, dtype=np.float64)
+    base_mean = baseline.mean()
+    difference = new.mean() - base_mean
+    change = difference / base_mean
+    if len(baseline) < 2 or len(new) < 2:
+        return change, None
+    base_error = baseline.var(ddof=1) / len(baseline)
+    new_error = new.var(ddof=1) / len(new)
+    standard_error = np.sqrt(base_error + new_error)
+    if standard_error == 0:
+        return change, (change, change)
+    # Welch-Satterthwaite degrees of freedom
+    degrees_of_freedom = (base_error + new_error) ** 2 / (
+        base_error ** 2 / (len(baseline) - 1) + new_error ** 2 / (len(new) - 1)
+    )
+    margin = _t_95(degrees_of_freedom) * standard_error
+    return (
+        change,
+        ((difference - margin) / base_mean, (difference + margin) / base_mean),
+    )
+
+
+def _regressed(change, interval, threshold, higher_is_better):
+    sign = 1 if higher_is_better else -1
+    if sign * change >= -threshold:
+        return False
+    return interval is None or max(sign * interval[0], sign * interval[1]) < 0
+
+
+def _improved(change, interval, threshold, higher_is_better):
+    return _regressed(change, interval, threshold, not higher_is_better)
+
+
+def _metrics(result, percentiles):
+    """ Yields (name, trial values, higher is better) for the compared metrics """
+    yield "images/sec", result.get("trials") or [result["images_per_second"]], True
+    trial_latencies = result.get("trial_latency_ms")
+    for name in percentiles:
+        if trial_latencies:
+            values = [latency[name] for latency in trial_latencies]
+        else:
+            values = [result["latency_ms"][name]]
+        yield "{} ms".format(name), values, False
+
+
+def _key(result):
+    return tuple(result[k] for k in _KEY) + tuple(result.get(k) for k in _TRAINING_KEY)
+
+
+def _describe(key):
+    description = "{} {} workers {} batch size {} prefetch {}".format(*key)
+    model, ranks = key[len(_KEY) :]
+    if model is not None:
+        description += " model {} ranks {}".format(model, ranks)
+    return description
+
+
+def _format_value(values):
+    if len(values) > 1:
+        return "{:.4g} +/- {:.2g}".format(np.mean(values), np.std(values, ddof=1))
+    return "{:.4g}".format(values[0])
+
+
+def check(baseline_report, new_report, threshold, latency_threshold, percentiles):
+    """ Compares the results of two reports
+
+    Returns:
+        (lines, regressions), the lines of the diff and the number of regressions
+    """
+    baseline_results = dict((_key(r), r) for r in baseline_report["results"])
+    new_results = dict((_key(r), r) for r in new_report["results"])
+    lines = [
+        "    {:<10} {:<12} {:>20}    {:<20} {:>7} {}".format(
+            "status", "metric", "baseline", "new", "change", "95% CI"
+        )
+    ]
+    regressions = 0
+    for key in sorted(baseline_results, key=lambda k: tuple(str(v) for v in k)):
+        baseline = baseline_results[key]
+        new = new_results.get(key)
+        if "error" in baseline:
+            continue
+        lines.append(_describe(key))
+        if new is None:
+            lines.append("    not in the new report")
+            continue
+        if "error" in new:
+            lines.append("    REGRESSION failed: {}".format(new["error"]))
+            regressions += 1
+            continue
+        new_metrics = dict((n, v) for n, v, _ in _metrics(new, percentiles))
+        for name, base_values, higher_is_better in _metrics(baseline, percentiles):
+            new_values = new_metrics[name]
+            limit = threshold if higher_is_better else latency_threshold
+            change, interval = compare(base_values, new_values)
+            if _regressed(change, interval, limit, higher_is_better):
+                status = "REGRESSION"
+                regressions += 1
+            elif _improved(change, interval, limit, higher_is_better):
+                status = "improved"
+            else:
+                status = "ok"
+            lines.append(
+                "    {:<10} {:<12} {:>20} -> {:<20} {:>+7.1%} {}".format(
+                    status,
+                    name,
+                    _format_value(base_values),
+                    _format_value(new_values),
+                    change,
+                    "[{:+.1%}, {:+.1%}]".format(*interval) if interval else "no CI",
+                )
+            )
+    for key in sorted(set(new_results) - set(baseline_results), key=str):
+        lines.append("{}\n    not in the baseline".format(_describe(key)))
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("baseline", help="report to compare against")
+    parser.add_argument("new", help="report to check")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.05,
+        help="largest relative drop of images/sec that is allowed",
+    )
+    parser.add_argument(
+        "--latency-threshold",
+        type=float,
+        default=0.10,
+        help="largest relative increase of a latency percentile that is allowed",
+    )
+    parser.add_argument(
+        "--percentiles",
+        nargs="+",
+        default=["p50", "p99"],
+        choices=["p50", "p90", "p95", "p99", "mean"],
+        help="latency percentiles to compare, p90 is only in the input pipeline "
+        "reports",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    logger = _get_logger()
+    with open(args.baseline) as f:
+        baseline_report = json.load(f)
+    with open(args.new) as f:
+        new_report = json.load(f)
+    lines, regressions = check(
+        baseline_report,
+        new_report,
+        args.threshold,
+        args.latency_threshold,
+        args.percentiles,
+    )
+    print("\n".join(lines))
+    if regressions:
+        logger.error("{} regressions against {}".format(regressions, args.baseline))
+        sys.exit(1)
+    logger.info("No regressions against {}".format(args.baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,436 @@
+"""
+Collects the results of training jobs into a SQLite database.
+
+Every epoch the trainers log a summary through _log_summary
+
+    INFO:__main__:0: [Epoch 2] Data length:      1281167
+    INFO:__main__:0: [Epoch 2] Total duration:   612.482
+    INFO:__main__:0: [Epoch 2] Total images/sec: 2091.764
+    INFO:__main__:0: [Epoch 2] Batch size:       (Per GPU 64: Total 512)
+    ...
+    INFO:__main__:0: [Epoch 2] Dataset:          Imagenet
+
+which is read back from the job's stdout.txt, or from the rank-0.jsonl written
+when LOG_DIR is set. Only the records of the lowest rank in the file are used, so
+the interleaved output of an mpirun job is read as one run. Each ingested file is
+a run with the framework, number of GPUs, batch size, accumulation steps,
+precision and dataset, and one row per epoch with its duration and images/sec. The
+throughput of a run is the median over its epochs, leaving out the first epoch
+when there are more, since it includes the warm up.
+
+Runs with the same framework, dataset, precision, batch size, accumulation and tag
+are compared across numbers of GPUs. The scaling efficiency is the images/sec per
+GPU relative to the run with the fewest GPUs, so 1.0 is linear scaling. The tag is
+free text, for example the commit the job ran, to compare the scaling before and
+after a change. The plots need bokeh, which is in the control environment.
+
+Usage:
+    python benchmarks/results.py ingest stdout.txt --tag baseline
+    python benchmarks/results.py ingest logs/rank-0.jsonl --framework keras
+    python benchmarks/results.py table --framework pytorch
+    python benchmarks/results.py plot --output scaling.html
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import time
+from collections import OrderedDict, defaultdict
+
+_DB = "results.db"
+_FRAMEWORKS = ("pytorch", "keras", "tf")
+_CONFIG = ("framework", "dataset", "precision", "batch_size", "accumulation", "tag")
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    source TEXT,
+    tag TEXT,
+    ingested REAL,
+    framework TEXT,
+    num_gpus INTEGER,
+    batch_size INTEGER,
+    total_batch_size INTEGER,
+    accumulation INTEGER,
+    precision TEXT,
+    dataset TEXT,
+    distributed INTEGER,
+    data_length INTEGER,
+    images_per_second REAL
+);
+CREATE TABLE IF NOT EXISTS epochs (
+    run_id INTEGER REFERENCES runs(id),
+    epoch INTEGER,
+    duration REAL,
+    images_per_second REAL
+);
+"""
+# Logging format of the trainers, %(levelname)s:%(name)s:%(gpurank)d: %(epoch)s
+# %(message)s. mpirun --tag-output may prefix the lines with the rank.
+_TEXT_RECORD = re.compile(
+    r"(?:DEBUG|INFO|WARNING|ERROR|CRITICAL):(?P<logger>[\w.]+):(?P<rank>\d+): "
+    r"(?:\[Epoch (?P<epoch>\d+)\])? (?P<message>.*)$"
+)
+_SUMMARY = OrderedDict(
+    [
+        ("data_length", (re.compile(r"Data length:\s+(\d+)"), int)),
+        ("duration", (re.compile(r"Total duration:\s+([\d.]+)"), float)),
+        ("images_per_second", (re.compile(r"Total images/sec:\s+([\d.]+)"), float)),
+        (
+            "batch_size",
+            (re.compile(r"Batch size:\s+\(Per GPU (\d+): Total \d+\)"), int),
+        ),
+        (
+            "total_batch_size",
+            (re.compile(r"Batch size:\s+\(Per GPU \d+: Total (\d+)\)"), int),
+        ),
+        ("accumulation", (re.compile(r"Accumulation:\s+(\d+)"), int)),
+        ("precision", (re.compile(r"Precision:\s+(\w+)"), str)),
+        (
+            "distributed",
+            (re.compile(r"Distributed:\s+(True|False)"), lambda x: x == "True"),
+        ),
+        ("num_gpus", (re.compile(r"Num GPUs:\s+([\d.]+)"), lambda x: int(float(x)))),
+        ("dataset", (re.compile(r"Dataset:\s+(\w+)"), str)),
+    ]
+)
+_VERSIONS = (
+    (re.compile(r"PyTorch version"), "pytorch"),
+    (re.compile(r"Keras version"), "keras"),
+    (re.compile(r"Tensorflow version"), "tf"),
+)
+_LOGGER_NAMES = {
+    "imagenet_pytorch_horovod": "pytorch",
+    "imagenet_keras_horovod": "keras",
+    "imagenet_estimator_tf_horovod": "tf",
+}
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def _records(lines):
+    """ Yields (logger, rank, epoch, message) for the log records in lines, which are
+    either text or JSON lines
+    """
+    for line in lines:
+        line = line.strip()
+        if line.startswith("{"):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            yield (
+                record.get("logger"),
+                record.get("rank", 0),
+                record.get("epoch"),
+                record.get("message", ""),
+            )
+            continue
+        match = _TEXT_RECORD.search(line)
+        if match:
+            epoch = match.group("epoch")
+            yield (
+                match.group("logger"),
+                int(match.group("rank")),
+                int(epoch) if epoch is not None else None,
+                match.group("message"),
+            )
+
+
+def _detect_framework(records):
+    names = set(logger for logger, _, _, _ in records)
+    for name, framework in _LOGGER_NAMES.items():
+        if name in names:
+            return framework
+    messages = [message for _, _, _, message in records]
+    # The Keras trainer logs the TensorFlow version too, so Keras is checked first
+    for regex, framework in _VERSIONS:
+        if any(regex.match(message) for message in messages):
+            return framework
+    return None
+
+
+def parse(lines, framework=None):
+    """ Reads a run from the lines of a trainer's output
+
+    Returns:
+        (run, epochs) where run is a dict of the summary of the last epoch and epochs
+        a list of dicts with the epoch, duration and images_per_second of every
+        summary, or (None, []) if there is no summary in lines
+    """
+    records = list(_records(lines))
+    if not records:
+        return None, []
+    first_rank = min(rank for _, rank, _, _ in records)
+    records = [record for record in records if record[1] == first_rank]
+    framework = framework or _detect_framework(records)
+
+    summaries = []
+    summary = {}
+    for _, _, epoch, message in records:
+        for key, (regex, convert) in _SUMMARY.items():
+            match = regex.match(message)
+            if match:
+                summary[key] = convert(match.group(1))
+                summary["epoch"] = epoch
+        # Dataset is the last line of the summary
+        if "dataset" in summary:
+            summaries.append(summary)
+            summary = {}
+    if not summaries:
+        return None, []
+
+    epochs = [
+        {
+            "epoch": s.get("epoch"),
+            "duration": s.get("duration"),
+            "images_per_second": s.get("images_per_second"),
+        }
+        for s in summaries
+    ]
+    run = dict(summaries[-1], framework=framework)
+    run.pop("epoch", None)
+    run.pop("duration", None)
+    run["images_per_second"] = _run_throughput(epochs)
+    return run, epochs
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _run_throughput(epochs):
+    """ Median images/sec of the epochs, without the first if there are more """
+    values = [e["images_per_second"] for e in epochs if e["images_per_second"]]
+    if len(values) > 1:
+        values = values[1:]
+    return _median(values) if values else None
+
+
+def connect(filename=_DB):
+    connection = sqlite3.connect(filename)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(_SCHEMA)
+    return connection
+
+
+def ingest(connection, filename, framework=None, tag=None):
+    """ Parses filename and stores it as a run
+
+    Returns:
+        the id of the run, or None if filename has no summary
+    """
+    with open(filename, errors="replace") as f:
+        run, epochs = parse(f, framework=framework)
+    if run is None:
+        return None
+    columns = [
+        "framework",
+        "num_gpus",
+        "batch_size",
+        "total_batch_size",
+        "accumulation",
+        "precision",
+        "dataset",
+        "distributed",
+        "data_length",
+        "images_per_second",
+    ]
+    values = [os.path.abspath(filename), tag, time.time()] + [
+        run.get(c) for c in columns
+    ]
+    with connection:
+        cursor = connection.execute(
+            "INSERT INTO runs (source, tag, ingested, {}) VALUES ({})".format(
+                ", ".join(columns), ", ".join("?" * len(values))
+            ),
+            values,
+        )
+        connection.executemany(
+            "INSERT INTO epochs VALUES (?, ?, ?, ?)",
+            [
+                (cursor.lastrowid, e["epoch"], e["duration"], e["images_per_second"])
+                for e in epochs
+            ],
+        )
+    return cursor.lastrowid
+
+
+def _select_runs(connection, framework=None, tag=None):
+    query = "SELECT * FROM runs"
+    conditions, parameters = [], []
+    if framework is not None:
+        conditions.append("framework = ?")
+        parameters.append(framework)
+    if tag is not None:
+        conditions.append("tag = ?")
+        parameters.append(tag)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    return connection.execute(query + " ORDER BY id", parameters).fetchall()
+
+
+def scaling(connection, framework=None, tag=None):
+    """ Returns the scaling of the runs grouped by configuration
+
+    Returns:
+        a dict from the configuration, a tuple of the _CONFIG fields, to a list of
+        dicts with num_gpus, runs, images_per_second, speedup and efficiency, one per
+        number of GPUs in increasing order. Repeated runs of a configuration on the
+        same number of GPUs are averaged.
+    """
+    throughputs = defaultdict(lambda: defaultdict(list))
+    for run in _select_runs(connection, framework=framework, tag=tag):
+        if run["images_per_second"] is None or not run["num_gpus"]:
+            continue
+        config = tuple(run[key] for key in _CONFIG)
+        throughputs[config][run["num_gpus"]].append(run["images_per_second"])
+
+    table = OrderedDict()
+    for config in sorted(throughputs, key=lambda c: tuple(str(v) for v in c)):
+        by_gpus = throughputs[config]
+        base_gpus = min(by_gpus)
+        base = sum(by_gpus[base_gpus]) / len(by_gpus[base_gpus])
+        rows = []
+        for num_gpus in sorted(by_gpus):
+            images_per_second = sum(by_gpus[num_gpus]) / len(by_gpus[num_gpus])
+            rows.append(
+                {
+                    "num_gpus": num_gpus,
+                    "runs": len(by_gpus[num_gpus]),
+                    "images_per_second": images_per_second,
+                    "speedup": images_per_second / base,
+                    "efficiency": (images_per_second / num_gpus) / (base / base_gpus),
+                }
+            )
+        table[config] = rows
+    return table
+
+
+def format_scaling(table):
+    lines = []
+    header = "{:>5} {:>5} {:>12} {:>10} {:>8} {:>11}".format(
+        "GPUs", "Runs", "Images/sec", "Per GPU", "Speedup", "Efficiency"
+    )
+    for config, rows in table.items():
+        lines.append(
+            ", ".join("{}={}".format(key, value) for key, value in zip(_CONFIG, config))
+        )
+        lines.append(header)
+        for row in rows:
+            lines.append(
+                "{:>5} {:>5} {:>12.1f} {:>10.1f} {:>8.2f} {:>10.1%}".format(
+                    row["num_gpus"],
+                    row["runs"],
+                    row["images_per_second"],
+                    row["images_per_second"] / row["num_gpus"],
+                    row["speedup"],
+                    row["efficiency"],
+                )
+            )
+        lines.append("")
+    return "\n".join(lines)
+
+
+def plot_scaling(table, filename):
+    """ Writes the images/sec and the scaling efficiency against the number of GPUs
+    of every configuration to the HTML file filename
+    """
+    from bokeh.layouts import row
+    from bokeh.palettes import Category10
+    from bokeh.plotting import figure, save
+
+    throughput = figure(
+        title="Throughput",
+        x_axis_label="GPUs",
+        y_axis_label="Images/sec",
+        x_axis_type="log",
+        y_axis_type="log",
+    )
+    efficiency = figure(
+        title="Scaling efficiency", x_axis_label="GPUs", y_axis_label="Efficiency"
+    )
+    colors = Category10[10]
+    for i, (config, rows) in enumerate(table.items()):
+        label = " ".join(str(value) for value in config if value is not None)
+        color = colors[i % len(colors)]
+        gpus = [r["num_gpus"] for r in rows]
+        throughput.line(
+            gpus, [r["images_per_second"] for r in rows], legend=label, color=color
+        )
+        throughput.circle(gpus, [r["images_per_second"] for r in rows], color=color)
+        # Linear scaling from the run with the fewest GPUs
+        base = rows[0]["images_per_second"] / rows[0]["num_gpus"]
+        throughput.line(
+            gpus, [base * g for g in gpus], color=color, line_dash="dashed", alpha=0.5
+        )
+        efficiency.line(
+            gpus, [r["efficiency"] for r in rows], legend=label, color=color
+        )
+        efficiency.circle(gpus, [r["efficiency"] for r in rows], color=color)
+    throughput.legend.location = "top_left"
+    efficiency.legend.location = "bottom_left"
+    save(row(throughput, efficiency), filename=filename, title="Scaling")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--db", default=_DB, help="SQLite database file")
+    commands = parser.add_subparsers(dest="command")
+    ingest_parser = commands.add_parser("ingest", help="add job outputs as runs")
+    ingest_parser.add_argument("files", nargs="+")
+    ingest_parser.add_argument(
+        "--framework", choices=_FRAMEWORKS, help="if it can not be told from the log"
+    )
+    ingest_parser.add_argument("--tag", help="label of the runs, e.g. the commit")
+    for name, help_text in (
+        ("table", "print the scaling efficiency"),
+        ("plot", "plot the scaling efficiency"),
+    ):
+        subparser = commands.add_parser(name, help=help_text)
+        subparser.add_argument("--framework", choices=_FRAMEWORKS)
+        subparser.add_argument("--tag")
+    commands.choices["plot"].add_argument("--output", default="scaling.html")
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error("a command is required")
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    logger = _get_logger()
+    connection = connect(args.db)
+    if args.command == "ingest":
+        for filename in args.files:
+            run_id = ingest(
+                connection, filename, framework=args.framework, tag=args.tag
+            )
+            if run_id is None:
+                logger.warning("{}: no training summary found".format(filename))
+            else:
+                logger.info("{}: stored as run {}".format(filename, run_id))
+        return
+
+    table = scaling(connection, framework=args.framework, tag=args.tag)
+    if not table:
+        logger.warning("No runs in {}".format(args.db))
+        return
+    if args.command == "table":
+        print(format_scaling(table))
+        return
+    try:
+        plot_scaling(table, args.output)
+    except ImportError as e:
+        logger.error("Plotting needs bokeh, {}".format(e))
+        sys.exit(1)
+    logger.info("Wrote {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
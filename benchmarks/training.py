@@ -0,0 +1,238 @@
+"""
+Benchmarks the PyTorch trainer end to end on CPU.
+
+Every trial runs HorovodPytorch/src/imagenet_pytorch_horovod.py in a fresh process
+with FAKE=True and MODEL=tiny, so the whole training step, the synthetic batches,
+the forward and backward pass, the optimizer and, with more than one rank, the
+allreduce of common/local_horovod.py, is timed rather than the input pipeline
+alone. The trainer writes its records to LOG_DIR and from rank-0.jsonl are read
+
+    images/sec  the "Total images/sec" of _log_summary, the median over the epochs
+                leaving out the first, see benchmarks/results.py
+    step ms     the step latency percentiles of the StepMetrics the trainer logs
+                at the end of the last epoch
+
+The report has the same layout as the one of benchmarks/input_pipeline.py, one
+result for each number of ranks with the values of every trial, so that
+benchmarks/regression.py can compare two of them.
+
+Usage:
+    python benchmarks/training.py --trials 5 --output training-baseline.json
+    ... change the code ...
+    python benchmarks/training.py --trials 5 --output training-new.json
+    python benchmarks/regression.py training-baseline.json training-new.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+
+import numpy as np
+
+from results import parse
+
+_ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+_TRAINER = path.join(_ROOT, "HorovodPytorch", "src", "imagenet_pytorch_horovod.py")
+_LAUNCHER = path.join(_ROOT, "common", "local_horovod.py")
+_MODEL = "tiny"
+_PERCENTILES = ("p50", "p95", "p99", "mean")
+_PASSED_THROUGH = (
+    "ACCUMULATION_STEPS",
+    "COMPRESSION",
+    "MIXED_PRECISION",
+    "STEP_METRICS_SYNC",
+    "TOPK_RATIO",
+)
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def _environment(log_dir, data_length, epochs, ranks):
+    env = dict(os.environ)
+    env.update(
+        {
+            "FAKE": "True",
+            "MODEL": _MODEL,
+            "FAKE_DATA_LENGTH": str(data_length),
+            "EPOCHS": str(epochs),
+            "LOG_DIR": log_dir,
+            "PYTHONPATH": os.pathsep.join(
+                [path.join(_ROOT, "common"), env.get("PYTHONPATH", "")]
+            ),
+        }
+    )
+    # Checkpoints would add storage time to the epochs
+    env.pop("AZ_BATCHAI_OUTPUT_MODEL", None)
+    if ranks == 1:
+        env["DISTRIBUTED"] = "False"
+    else:
+        env["DISTRIBUTED"] = "True"
+        env["LOCAL_HOROVOD"] = "True"
+    return env
+
+
+def _command(ranks):
+    command = [sys.executable, _TRAINER]
+    if ranks == 1:
+        return command
+    return [sys.executable, _LAUNCHER, "-np", str(ranks)] + command
+
+
+def read_log(filename):
+    """ Reads the throughput and the step latencies of a run from its JSON log
+
+    Returns:
+        (run, step) where run is the summary of benchmarks/results.py and step the
+        StepMetrics summary of the step phase of the last epoch in seconds
+    """
+    with open(filename) as f:
+        lines = f.readlines()
+    run, _ = parse(lines, framework="pytorch")
+    if run is None:
+        raise ValueError("{} has no epoch summary".format(filename))
+    step = None
+    for line in lines:
+        record = json.loads(line)
+        if "step_metrics" in record:
+            step = record["step_metrics"]["step"]
+    if step is None:
+        raise ValueError("{} has no step metrics".format(filename))
+    return run, step
+
+
+def run_trial(ranks, data_length, epochs, timeout):
+    """ Trains once and returns (images/sec, step latency percentiles in ms, run) """
+    log_dir = tempfile.mkdtemp(prefix="training-")
+    try:
+        process = subprocess.run(
+            _command(ranks),
+            env=_environment(log_dir, data_length, epochs, ranks),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            timeout=timeout,
+        )
+        if process.returncode != 0:
+            output = process.stdout.decode("utf-8", "replace").strip().splitlines()
+            raise RuntimeError(
+                output[-1] if output else "exit code {}".format(process.returncode)
+            )
+        run, step = read_log(path.join(log_dir, "rank-0.jsonl"))
+    finally:
+        shutil.rmtree(log_dir, ignore_errors=True)
+    latency_ms = dict((name, step[name] * 1000) for name in _PERCENTILES)
+    return run["images_per_second"], latency_ms, run
+
+
+def benchmark(ranks, args):
+    """ Runs the trials for a number of ranks and returns their result """
+    logger = _get_logger()
+    result = {
+        "framework": "pytorch",
+        "data_format": "fake",
+        # FakeBatches hands out ready made batches, there are no workers
+        "workers": 0,
+        "batch_size": None,
+        "prefetch": None,
+        "model": _MODEL,
+        "ranks": ranks,
+    }
+    trials, trial_latency_ms = [], []
+    try:
+        for trial in range(args.trials):
+            images_per_second, latency_ms, run = run_trial(
+                ranks, args.data_length, args.epochs, args.timeout
+            )
+            result["batch_size"] = run["batch_size"]
+            trials.append(images_per_second)
+            trial_latency_ms.append(latency_ms)
+            logger.info(
+                "{} ranks trial {}: {:.1f} images/sec step p50 {:.1f}ms "
+                "p99 {:.1f}ms".format(
+                    ranks,
+                    trial,
+                    images_per_second,
+                    latency_ms["p50"],
+                    latency_ms["p99"],
+                )
+            )
+    except subprocess.TimeoutExpired:
+        result["error"] = "timed out after {}s".format(args.timeout)
+    except (RuntimeError, ValueError) as e:
+        result["error"] = str(e)
+    if "error" in result:
+        logger.warning("{} ranks failed: {}".format(ranks, result["error"]))
+        return result
+    result["trials"] = trials
+    result["images_per_second"] = float(np.mean(trials))
+    result["trial_latency_ms"] = trial_latency_ms
+    result["latency_ms"] = dict(
+        (name, float(np.mean([latency[name] for latency in trial_latency_ms])))
+        for name in _PERCENTILES
+    )
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--ranks",
+        nargs="+",
+        type=int,
+        default=[1],
+        help="numbers of processes, more than one runs through local_horovod.py",
+    )
+    parser.add_argument(
+        "--data-length",
+        type=int,
+        default=4096,
+        help="synthetic images per epoch, FAKE_DATA_LENGTH",
+    )
+    parser.add_argument(
+        "--epochs",
+        type=int,
+        default=2,
+        help="epochs per trial, the first is the warm up",
+    )
+    parser.add_argument("--trials", type=int, default=3)
+    parser.add_argument(
+        "--timeout", type=int, default=1800, help="seconds allowed for each trial"
+    )
+    parser.add_argument("--output", default="training.json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    results = [benchmark(ranks, args) for ranks in args.ranks]
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+        },
+        "settings": {
+            "model": _MODEL,
+            "data_length": args.data_length,
+            "epochs": args.epochs,
+            "trials": args.trials,
+            "environment": dict(
+                (key, os.environ[key]) for key in _PASSED_THROUGH if key in os.environ
+            ),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    _get_logger().info("Wrote {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
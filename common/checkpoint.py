@@ -0,0 +1,140 @@
+"""
+Checkpoints for the trainers.
+
+Checkpoints are named from a format with an {epoch} field, for example
+checkpoint-{epoch}.npz, where epoch is the number of epochs completed.
+
+AsyncCheckpointWriter takes a snapshot of the state that has already been copied
+into host memory and writes it on a background thread, so training carries on
+while the checkpoint goes to storage. Each checkpoint is written to a temporary
+file and renamed into place, so a checkpoint that exists is always complete, and
+only the newest `keep` checkpoints are kept.
+
+    writer = AsyncCheckpointWriter("/output/checkpoint-{epoch}.pth.tar", torch.save)
+    for epoch in range(epochs):
+        train(...)
+        writer.write(epoch + 1, snapshot)
+    writer.close()
+"""
+import logging
+import os
+import re
+import threading
+from queue import Queue
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def list_checkpoints(checkpoint_format):
+    """ Returns the (epoch, path) of every checkpoint, oldest first """
+    directory, pattern = os.path.split(checkpoint_format)
+    before, after = pattern.split("{epoch}")
+    regex = re.compile(re.escape(before) + r"(\d+)" + re.escape(after) + "$")
+    if not os.path.isdir(directory or "."):
+        return []
+    epochs = [
+        int(match.group(1))
+        for match in map(regex.match, os.listdir(directory or "."))
+        if match
+    ]
+    return [(epoch, checkpoint_format.format(epoch=epoch)) for epoch in sorted(epochs)]
+
+
+def latest_checkpoint(checkpoint_format):
+    """ Returns the highest epoch that has a checkpoint and its path
+
+    Returns:
+        (epoch, path), or (0, None) if there are no checkpoints yet
+    """
+    checkpoints = list_checkpoints(checkpoint_format)
+    return checkpoints[-1] if checkpoints else (0, None)
+
+
+class AsyncCheckpointWriter(object):
+    """ Writes checkpoints on a background thread
+
+    Args:
+        checkpoint_format: path with an {epoch} field
+        save_fn:           save_fn(snapshot, f) writes a snapshot to the open file f
+        keep:              number of checkpoints to keep, at least 1, None keeps them
+                           all
+
+    At most one snapshot waits while another is being written, write() blocks after
+    that so snapshots can not pile up in memory. An error on the writer thread is
+    raised by the next call to write() or close().
+    """
+
+    def __init__(self, checkpoint_format, save_fn, keep=5):
+        if keep is not None and keep < 1:
+            raise ValueError(
+                "keep must be at least 1 or None to keep every checkpoint, "
+                "got {}".format(keep)
+            )
+        self.checkpoint_format = checkpoint_format
+        self._save_fn = save_fn
+        self._keep = keep
+        self._queue = Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="checkpoint-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, epoch, snapshot):
+        logger = _get_logger()
+        filename = self.checkpoint_format.format(epoch=epoch)
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "wb") as f:
+            self._save_fn(snapshot, f)
+            # Otherwise the rename can reach the disk before the data after a crash
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, filename)
+        logger.info("Saved checkpoint {}".format(filename))
+        if self._keep is not None:
+            for _, old_filename in list_checkpoints(self.checkpoint_format)[
+                : -self._keep
+            ]:
+                os.remove(old_filename)
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(self, epoch, snapshot):
+        """ Queues snapshot to be written as the checkpoint for epoch
+
+        The snapshot must not be changed afterwards, so it should be a copy of the
+        training state in host memory.
+        """
+        self._raise_error()
+        self._queue.put((epoch, snapshot))
+
+    def flush(self):
+        """ Waits for the queued checkpoints to be written """
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """ Writes the queued checkpoints and stops the thread """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
@@ -0,0 +1,182 @@
+"""
+Extracts the per-class ImageNet training tars in parallel.
+
+The ILSVRC2012 training archive contains one tar per class. Each class tar is
+extracted by a worker process into a temporary directory which is renamed into
+place once it is complete, and the class is then recorded in a manifest. If a
+run is interrupted it can simply be started again and it will pick up from the
+classes that are not yet in the manifest.
+
+Usage:
+    python extract.py /data/train --processes 16
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tarfile
+from multiprocessing import Pool, cpu_count
+from timer import Timer
+
+_MANIFEST = ".extracted.jsonl"
+_PARTIAL_SUFFIX = ".partial"
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def _class_name(class_tar):
+    return os.path.splitext(os.path.basename(class_tar))[0]
+
+
+def _list_class_tars(train_dir):
+    return sorted(
+        os.path.join(train_dir, filename)
+        for filename in os.listdir(train_dir)
+        if filename.endswith(".tar")
+    )
+
+
+def read_manifest(manifest_path):
+    """ Returns a dict of class name to the stats recorded when it was extracted
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    completed = {}
+    with open(manifest_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A partially written final line from an interrupted run
+                continue
+            completed[record["class"]] = record
+    return completed
+
+
+def _append_to_manifest(manifest_path, record):
+    with open(manifest_path, "a") as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _extract_class(args):
+    class_tar, remove_tar = args
+    class_dir = os.path.splitext(class_tar)[0]
+    partial_dir = class_dir + _PARTIAL_SUFFIX
+    if os.path.exists(partial_dir):
+        shutil.rmtree(partial_dir)
+    os.mkdir(partial_dir)
+
+    with Timer() as t:
+        with tarfile.open(class_tar) as f:
+            members = [member for member in f.getmembers() if member.isfile()]
+            f.extractall(partial_dir, members=members)
+
+    if os.path.exists(class_dir):
+        shutil.rmtree(class_dir)
+    os.rename(partial_dir, class_dir)
+    if remove_tar:
+        os.remove(class_tar)
+
+    num_bytes = sum(member.size for member in members)
+    return {
+        "class": _class_name(class_tar),
+        "files": len(members),
+        "bytes": num_bytes,
+        "seconds": t.elapsed,
+        "files_per_second": len(members) / max(t.elapsed, 1e-9),
+    }
+
+
+def extract_class_tars(
+    train_dir, processes=None, remove_tars=True, manifest_path=None, callback=None
+):
+    """ Extracts every class tar in train_dir into a directory of the same name
+
+    Args:
+        train_dir:     directory holding the per-class tars
+        processes:     number of worker processes, defaults to the number of cores
+        remove_tars:   if True, delete each class tar once it has been extracted
+        manifest_path: where to record completed classes, defaults to a file in train_dir
+        callback:      if callable, called with the stats of each class as it completes
+
+    Returns:
+        list of the stats for the classes extracted in this run
+    """
+    logger = _get_logger()
+    processes = processes or cpu_count()
+    manifest_path = manifest_path or os.path.join(train_dir, _MANIFEST)
+    completed = read_manifest(manifest_path)
+
+    pending = [
+        class_tar
+        for class_tar in _list_class_tars(train_dir)
+        if _class_name(class_tar) not in completed
+    ]
+    logger.info(
+        "{} classes already extracted, {} to go using {} processes".format(
+            len(completed), len(pending), processes
+        )
+    )
+
+    results = []
+    with Timer() as t:
+        pool = Pool(processes)
+        try:
+            for record in pool.imap_unordered(
+                _extract_class, [(class_tar, remove_tars) for class_tar in pending]
+            ):
+                _append_to_manifest(manifest_path, record)
+                results.append(record)
+                logger.info(
+                    "Extracted {class} {files} files in {seconds:.2f}s "
+                    "({files_per_second:.0f} files/sec)".format(**record)
+                )
+                if callable(callback):
+                    callback(record)
+        except BaseException:
+            # On an interrupt the running tasks never return, stop the workers
+            # rather than let the pool extract classes the manifest will not record
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+
+    total_files = sum(record["files"] for record in results)
+    logger.info(
+        "Extracted {} classes {} files in {:.1f}s ({:.0f} files/sec)".format(
+            len(results), total_files, t.elapsed, total_files / max(t.elapsed, 1e-9)
+        )
+    )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("train_dir", help="directory holding the per-class tars")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument(
+        "--keep-tars", action="store_true", help="do not delete the class tars"
+    )
+    parser.add_argument("--manifest", default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    extract_class_tars(
+        args.train_dir,
+        processes=args.processes,
+        remove_tars=not args.keep_tars,
+        manifest_path=args.manifest,
+    )
+
+
+if __name__ == "__main__":
+    main()
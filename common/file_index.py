@@ -0,0 +1,135 @@
+"""
+Builds an index of the images in an image folder.
+
+Listing 1.28M files on a network mount takes minutes, and every rank has to do it
+before training starts. Instead the listing is done once and saved next to the
+images as
+
+    <image_dir>/<name>.files.npy    path relative to image_dir and label of every image
+    <image_dir>/<name>.files.json   class names, the position is the label
+
+The index is a numpy structured array with a fixed width bytes path, so loading it
+is a single memory map. Labels follow the same convention as torchvision's
+ImageFolder.
+
+Usage:
+    python file_index.py /data/train --name train
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+from shards import list_images
+from timer import Timer
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def files_path(output_dir, name):
+    return os.path.join(output_dir, "{}.files.npy".format(name))
+
+
+def metadata_path(output_dir, name):
+    return os.path.join(output_dir, "{}.files.json".format(name))
+
+
+def _build(image_dir):
+    classes, samples = list_images(image_dir)
+    paths = [
+        os.fsencode(os.path.relpath(filename, image_dir)) for filename, _ in samples
+    ]
+    width = max((len(p) for p in paths), default=1)
+    index = np.zeros(
+        len(samples), dtype=[("path", "S{}".format(width)), ("label", np.int32)]
+    )
+    index["path"] = paths
+    index["label"] = [label for _, label in samples]
+    return classes, index
+
+
+def write_index(image_dir, output_dir=None, name="train"):
+    """ Lists the images in image_dir and saves the index, by default in image_dir
+
+    Returns:
+        the number of images in the index
+    """
+    logger = _get_logger()
+    output_dir = image_dir if output_dir is None else output_dir
+    with Timer() as t:
+        classes, index = _build(image_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    np.save(files_path(output_dir, name), index)
+    with open(metadata_path(output_dir, name), "w") as f:
+        json.dump({"classes": classes}, f)
+    logger.info(
+        "Indexed {} images from {} classes in {:.1f}s".format(
+            len(index), len(classes), t.elapsed
+        )
+    )
+    return len(index)
+
+
+class FileIndex(object):
+    """ Memory mapped index written by write_index
+
+    paths are relative to root, the image folder, as bytes.
+    """
+
+    def __init__(self, classes, index, root):
+        self.classes = classes
+        self.index = index
+        self.root = root
+
+    @classmethod
+    def load(cls, data_dir, name, root=None):
+        """ Loads the index saved in data_dir, root defaults to data_dir """
+        with open(metadata_path(data_dir, name)) as f:
+            metadata = json.load(f)
+        index = np.load(files_path(data_dir, name), mmap_mode="r")
+        return cls(metadata["classes"], index, data_dir if root is None else root)
+
+    @classmethod
+    def from_directory(cls, image_dir):
+        """ Lists image_dir in memory without saving an index """
+        classes, index = _build(image_dir)
+        return cls(classes, index, image_dir)
+
+    @classmethod
+    def exists(cls, data_dir, name):
+        return os.path.exists(files_path(data_dir, name))
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def paths(self):
+        return np.asarray(self.index["path"])
+
+    @property
+    def labels(self):
+        return np.asarray(self.index["label"])
+
+    def filenames(self):
+        """ Returns the full path of every image as a list of str """
+        root = os.fsencode(self.root)
+        return [os.fsdecode(os.path.join(root, p)) for p in self.paths]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("image_dir", help="image folder laid out as <class>/<image>")
+    parser.add_argument("--output-dir", default=None, help="defaults to image_dir")
+    parser.add_argument("--name", default="train")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    write_index(args.image_dir, output_dir=args.output_dir, name=args.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+Builds a cache of decoded and resized images for an image folder.
+
+Decoding a full size JPEG and resizing it is the same work every epoch. This
+decodes every image once, resizes the shorter side to 256 pixels, takes the
+central 256x256 crop and stores the result as uint8 in a single memory mappable
+numpy file, so that at training time only the random crop and flip are left to do.
+
+    <output_dir>/<name>.images.npy   uint8 images, NHWC or NCHW
+    <output_dir>/<name>.labels.npy   int32 labels
+    <output_dir>/<name>.cache.json   class names, layout and image size
+
+Labels follow the same convention as torchvision's ImageFolder. Note that at
+256x256 the ImageNet training set takes roughly 250GB.
+
+Usage:
+    python image_cache.py /data/train /data/cache --name train --processes 16
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+from PIL import Image
+from shards import list_images
+from timer import Timer
+
+_SIZE = 256
+_CHUNK = 256
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def images_path(output_dir, name):
+    return os.path.join(output_dir, "{}.images.npy".format(name))
+
+
+def labels_path(output_dir, name):
+    return os.path.join(output_dir, "{}.labels.npy".format(name))
+
+
+def metadata_path(output_dir, name):
+    return os.path.join(output_dir, "{}.cache.json".format(name))
+
+
+def resize_and_centre_crop(img, size=_SIZE):
+    """ Resizes the shorter side of a PIL image to size and takes the central square
+    """
+    width, height = img.size
+    scale = size / min(width, height)
+    new_width = max(size, int(round(width * scale)))
+    new_height = max(size, int(round(height * scale)))
+    img = img.resize((new_width, new_height), Image.BILINEAR)
+    left = (new_width - size) // 2
+    top = (new_height - size) // 2
+    return img.crop((left, top, left + size, top + size))
+
+
+def _decode(filename, size):
+    with open(filename, "rb") as f:
+        img = Image.open(f).convert("RGB")
+    return np.asarray(resize_and_centre_crop(img, size), dtype=np.uint8)
+
+
+def _write_chunk(args):
+    filename, layout, size, start, filenames = args
+    images = np.load(filename, mmap_mode="r+")
+    for i, image_filename in enumerate(filenames):
+        img = _decode(image_filename, size)
+        images[start + i] = img if layout == "NHWC" else img.transpose(2, 0, 1)
+    images.flush()
+    return len(filenames)
+
+
+def build_cache(
+    image_dir, output_dir, name, size=_SIZE, layout="NHWC", processes=None
+):
+    """ Decodes every image in image_dir into a memory mappable uint8 array
+
+    Returns:
+        the number of images in the cache
+    """
+    logger = _get_logger()
+    if layout not in ("NHWC", "NCHW"):
+        raise ValueError("layout must be NHWC or NCHW not {}".format(layout))
+    classes, samples = list_images(image_dir)
+    filenames = [filename for filename, _ in samples]
+    labels = np.array([label for _, label in samples], dtype=np.int32)
+    shape = (size, size, 3) if layout == "NHWC" else (3, size, size)
+    logger.info(
+        "Caching {} images from {} classes at {} as {}".format(
+            len(samples), len(classes), size, layout
+        )
+    )
+
+    os.makedirs(output_dir, exist_ok=True)
+    cache_filename = images_path(output_dir, name)
+    images = np.lib.format.open_memmap(
+        cache_filename, mode="w+", dtype=np.uint8, shape=(len(samples),) + shape
+    )
+    del images
+
+    chunks = [
+        (cache_filename, layout, size, start, filenames[start : start + _CHUNK])
+        for start in range(0, len(filenames), _CHUNK)
+    ]
+    with Timer() as t:
+        pool = Pool(processes or cpu_count())
+        try:
+            done = 0
+            for count in pool.imap_unordered(_write_chunk, chunks):
+                done += count
+                logger.debug("Cached {}/{} images".format(done, len(filenames)))
+        finally:
+            pool.close()
+            pool.join()
+
+    np.save(labels_path(output_dir, name), labels)
+    with open(metadata_path(output_dir, name), "w") as f:
+        json.dump({"classes": classes, "layout": layout, "size": size}, f)
+    logger.info(
+        "Cached {} images in {:.1f}s ({:.0f} images/sec)".format(
+            len(samples), t.elapsed, len(samples) / max(t.elapsed, 1e-9)
+        )
+    )
+    return len(samples)
+
+
+class ImageCache(object):
+    """ Memory mapped view of a cache written by build_cache
+    """
+
+    def __init__(self, data_dir, name):
+        with open(metadata_path(data_dir, name)) as f:
+            metadata = json.load(f)
+        self.classes = metadata["classes"]
+        self.layout = metadata["layout"]
+        self.size = metadata["size"]
+        self.images = np.load(images_path(data_dir, name), mmap_mode="r")
+        self.labels = np.load(labels_path(data_dir, name))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def crop(self, idx, top, left, size, flip=False, layout="HWC"):
+        """ Returns a size x size crop of image idx in the given layout, HWC or CHW
+
+        The crop is a view onto the cache where possible, so it may not be contiguous.
+        """
+        img = self.images[idx]
+        if self.layout == "NHWC":
+            img = img[top : top + size, left : left + size]
+            if flip:
+                img = img[:, ::-1]
+            return img if layout == "HWC" else img.transpose(2, 0, 1)
+        else:
+            img = img[:, top : top + size, left : left + size]
+            if flip:
+                img = img[:, :, ::-1]
+            return img if layout == "CHW" else img.transpose(1, 2, 0)
+
+    def random_crop(self, idx, size, random_state=np.random, flip=True, layout="HWC"):
+        top, left = random_state.randint(0, self.size - size + 1, size=2)
+        flip = flip and random_state.rand() < 0.5
+        return self.crop(idx, top, left, size, flip=flip, layout=layout)
+
+    def centre_crop(self, idx, size, layout="HWC"):
+        offset = (self.size - size) // 2
+        return self.crop(idx, offset, offset, size, layout=layout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("image_dir", help="image folder laid out as <class>/<image>")
+    parser.add_argument("output_dir")
+    parser.add_argument("--name", default="train")
+    parser.add_argument("--size", type=int, default=_SIZE)
+    parser.add_argument("--layout", default="NHWC", choices=("NHWC", "NCHW"))
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    build_cache(
+        args.image_dir,
+        args.output_dir,
+        args.name,
+        size=args.size,
+        layout=args.layout,
+        processes=args.processes,
+    )
+
+
+if __name__ == "__main__":
+    main()
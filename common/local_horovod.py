@@ -0,0 +1,514 @@
+"""
+Stand-in for horovod.torch that runs several CPU processes on one machine.
+
+The PyTorch trainer imports it instead of horovod.torch when LOCAL_HOROVOD is set,
+so that its distributed code, hvd.init, the broadcasts, DistributedOptimizer and
+DistributedSampler, can be run without GPUs, MPI or Gloo. Rank 0 listens on a local
+socket and the other ranks connect to it. Every collective is sent to rank 0, which
+combines the tensors of all the ranks and sends back the result, so all the ranks
+have to call the collectives in the same order, as with Horovod.
+
+DistributedOptimizer allreduces all the gradients as one fused tensor in step()
+rather than in backward hooks, so gradients accumulated over several backward
+passes are allreduced once, which is what backward_passes_per_step is for.
+
+The time spent in the collectives, including waiting for the slower ranks, is
+counted per rank. Run as a script it is the launcher, it starts -np copies of a
+command with the environment set, passes through their output and reports the
+images/sec, from the trainer's "Total images/sec" line, and the collective time of
+each rank.
+
+Usage:
+    FAKE=True MODEL=tiny FAKE_DATA_LENGTH=8192 python common/local_horovod.py -np 4 \\
+        python HorovodPytorch/src/imagenet_pytorch_horovod.py
+"""
+import argparse
+import atexit
+import json
+import logging
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+from timer import FastTimer
+
+_CONNECT_TIMEOUT = 60
+_OPS = ("allreduce", "allgather", "broadcast")
+
+_rank = None
+_size = None
+_connections = None
+_timers = dict((op, FastTimer()) for op in _OPS)
+_bytes = dict((op, 0) for op in _OPS)
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+class _NoneCompressor(object):
+    @staticmethod
+    def compress(tensor):
+        return tensor, None
+
+    @staticmethod
+    def decompress(tensor, ctx):
+        return tensor
+
+
+class _FP16Compressor(object):
+    @staticmethod
+    def compress(tensor):
+        if tensor.dtype.is_floating_point:
+            return tensor.half(), tensor.dtype
+        return tensor, None
+
+    @staticmethod
+    def decompress(tensor, ctx):
+        return tensor.to(ctx) if ctx is not None else tensor
+
+
+class Compression(object):
+    """ Compressors of torch tensors, as in horovod.torch """
+
+    none = _NoneCompressor
+    fp16 = _FP16Compressor
+
+
+def _check_initialized():
+    if _rank is None:
+        raise ValueError("local_horovod has not been initialized, call init() first")
+
+
+def init():
+    """ Connects this rank to the others, with the rank, size and address of rank 0
+    set by the launcher in LOCAL_HOROVOD_RANK, LOCAL_HOROVOD_SIZE and
+    LOCAL_HOROVOD_ADDRESS
+    """
+    global _rank, _size, _connections
+    if _rank is not None:
+        return
+    rank = int(os.getenv("LOCAL_HOROVOD_RANK", 0))
+    size = int(os.getenv("LOCAL_HOROVOD_SIZE", 1))
+    host, port = os.getenv("LOCAL_HOROVOD_ADDRESS", "127.0.0.1:0").rsplit(":", 1)
+    authkey = os.getenv("LOCAL_HOROVOD_AUTHKEY", "local_horovod").encode()
+    connections = {}
+    if size > 1 and rank == 0:
+        listener = Listener((host, int(port)), authkey=authkey)
+        while len(connections) < size - 1:
+            connection = listener.accept()
+            connections[connection.recv()] = connection
+        listener.close()
+    elif size > 1:
+        deadline = time.time() + _CONNECT_TIMEOUT
+        while True:
+            try:
+                connection = Client((host, int(port)), authkey=authkey)
+                break
+            except ConnectionRefusedError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+        connection.send(rank)
+        connections[0] = connection
+    _rank, _size, _connections = rank, size, connections
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """ Closes the connections and writes the collective times of this rank to
+    LOCAL_HOROVOD_STATS, if it is set
+    """
+    global _rank, _connections
+    if _rank is None:
+        return
+    stats_dir = os.getenv("LOCAL_HOROVOD_STATS")
+    if stats_dir is not None:
+        with open(os.path.join(stats_dir, "rank-{}.json".format(_rank)), "w") as f:
+            json.dump(stats(), f)
+    for connection in _connections.values():
+        connection.close()
+    _rank, _connections = None, None
+
+
+def stats():
+    """ Returns the calls, seconds and bytes sent of each collective of this rank """
+    return dict(
+        (
+            op,
+            {
+                "calls": _timers[op].count,
+                "seconds": _timers[op].total,
+                "bytes": _bytes[op],
+            },
+        )
+        for op in _OPS
+    )
+
+
+def rank():
+    _check_initialized()
+    return _rank
+
+
+def local_rank():
+    return rank()
+
+
+def size():
+    _check_initialized()
+    return _size
+
+
+def local_size():
+    return size()
+
+
+def _combine(op, arrays, root_rank):
+    if op == "allreduce":
+        return np.sum(arrays, axis=0).astype(arrays[0].dtype)
+    if op == "allgather":
+        return np.concatenate(arrays)
+    return arrays[root_rank]
+
+
+def _collective(op, array, name, root_rank=0):
+    """ Sends array to rank 0 and returns the result of op over all the ranks """
+    _check_initialized()
+    with _timers[op]:
+        _bytes[op] += array.nbytes
+        if _size == 1:
+            return array
+        if _rank != 0:
+            connection = _connections[0]
+            connection.send((op, name, array, root_rank))
+            error, result = connection.recv()
+            if error is not None:
+                raise RuntimeError(error)
+            return result
+
+        requests = [(op, name, array, root_rank)] + [
+            _connections[r].recv() for r in range(1, _size)
+        ]
+        error, result = None, None
+        mismatched = [
+            r for r, request in enumerate(requests) if request[:2] != (op, name)
+        ]
+        if mismatched:
+            error = "Rank 0 called {} {} but ranks {} called {}".format(
+                op, name, mismatched, [requests[r][:2] for r in mismatched]
+            )
+        else:
+            result = _combine(op, [request[2] for request in requests], root_rank)
+        for r in range(1, _size):
+            _connections[r].send((error, result))
+        if error is not None:
+            raise RuntimeError(error)
+        return result
+
+
+def _to_numpy(tensor):
+    return tensor.detach().cpu().numpy()
+
+
+def _to_tensor(array, like):
+    import torch
+
+    # ascontiguousarray turns 0-d arrays into 1-d ones
+    array = np.ascontiguousarray(array).reshape(np.shape(array))
+    return torch.from_numpy(array).to(like.device)
+
+
+def allreduce(tensor, average=True, name=None, compression=Compression.none):
+    compressed, ctx = compression.compress(tensor)
+    array = _to_numpy(compressed)
+    result = _collective("allreduce", array, name)
+    if average:
+        result = result / _size
+    return compression.decompress(_to_tensor(result.astype(array.dtype), tensor), ctx)
+
+
+def allgather(tensor, name=None):
+    return _to_tensor(_collective("allgather", _to_numpy(tensor), name), tensor)
+
+
+def broadcast(tensor, root_rank, name=None):
+    return _to_tensor(
+        _collective("broadcast", _to_numpy(tensor), name, root_rank=root_rank), tensor
+    )
+
+
+def broadcast_(tensor, root_rank, name=None):
+    tensor.data.copy_(broadcast(tensor, root_rank, name=name))
+    return tensor
+
+
+# The collectives run when they are called, the handles are their results
+def allreduce_async(tensor, average=True, name=None):
+    return allreduce(tensor, average=average, name=name)
+
+
+def allgather_async(tensor, name=None):
+    return allgather(tensor, name=name)
+
+
+def broadcast_async(tensor, root_rank, name=None):
+    return broadcast(tensor, root_rank, name=name)
+
+
+def poll(handle):
+    return True
+
+
+def synchronize(handle):
+    return handle
+
+
+def _broadcast_object(obj, root_rank, name):
+    """ Broadcasts any picklable object as a byte array """
+    import pickle
+
+    data = np.frombuffer(pickle.dumps(obj), dtype=np.uint8)
+    length = _collective(
+        "broadcast", np.array([len(data)]), name + ".length", root_rank
+    )
+    buffer = np.zeros(int(length[0]), dtype=np.uint8)
+    if _rank == root_rank:
+        buffer = data
+    return pickle.loads(_collective("broadcast", buffer, name, root_rank).tobytes())
+
+
+def broadcast_parameters(params, root_rank):
+    """ Copies the parameters of root_rank to the other ranks
+
+    params is a state_dict or a list of (name, tensor), as for horovod.torch.
+    """
+    items = sorted(params.items()) if isinstance(params, dict) else params
+    for name, p in items:
+        broadcast_(p, root_rank, name=name)
+
+
+def broadcast_optimizer_state(optimizer, root_rank):
+    state = _broadcast_object(optimizer.state_dict(), root_rank, name="optimizer_state")
+    optimizer.load_state_dict(state)
+
+
+class _DistributedOptimizer(object):
+    def __init__(
+        self, params, named_parameters, compression, backward_passes_per_step=1
+    ):
+        super(self.__class__, self).__init__(params)
+        self._compression = compression
+
+    def synchronize(self):
+        """ Averages the gradients of all the ranks as one fused allreduce """
+        grads = [
+            p.grad.data
+            for group in self.param_groups
+            for p in group["params"]
+            if p.grad is not None
+        ]
+        if not grads:
+            return
+        import torch
+
+        compressed, ctx = self._compression.compress(
+            torch.cat([g.contiguous().view(-1) for g in grads])
+        )
+        array = _to_numpy(compressed)
+        result = _collective("allreduce", array, "DistributedOptimizer.gradients")
+        result = np.asarray(result / _size, dtype=array.dtype)
+        flat = self._compression.decompress(_to_tensor(result, grads[0]), ctx)
+        offset = 0
+        for g in grads:
+            g.copy_(flat[offset : offset + g.numel()].view_as(g))
+            offset += g.numel()
+
+    def step(self, closure=None):
+        self.synchronize()
+        return super(self.__class__, self).step(closure)
+
+
+def DistributedOptimizer(
+    optimizer,
+    named_parameters=None,
+    compression=Compression.none,
+    backward_passes_per_step=1,
+):
+    """ Wraps optimizer so that step() first averages the gradients of all the ranks
+    """
+    methods = dict(
+        (key, value)
+        for key, value in vars(_DistributedOptimizer).items()
+        if key not in ("__dict__", "__weakref__")
+    )
+    cls = type(optimizer.__class__.__name__, (optimizer.__class__,), methods)
+    return cls(
+        optimizer.param_groups, named_parameters, compression, backward_passes_per_step
+    )
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _environment(rank, num_processes, address, authkey, stats_dir):
+    env = dict(os.environ)
+    common = os.path.dirname(os.path.abspath(__file__))
+    env.update(
+        {
+            "DISTRIBUTED": "True",
+            "LOCAL_HOROVOD": "True",
+            "LOCAL_HOROVOD_RANK": str(rank),
+            "LOCAL_HOROVOD_SIZE": str(num_processes),
+            "LOCAL_HOROVOD_ADDRESS": address,
+            "LOCAL_HOROVOD_AUTHKEY": authkey,
+            "LOCAL_HOROVOD_STATS": stats_dir,
+            "PYTHONPATH": os.pathsep.join([common, env.get("PYTHONPATH", "")]),
+        }
+    )
+    # Share the cores between the ranks rather than have every rank use all of them
+    env.setdefault(
+        "OMP_NUM_THREADS", str(max(1, (os.cpu_count() or 1) // num_processes))
+    )
+    return env
+
+
+_METRICS = (
+    ("images_per_second", re.compile(r"Total images/sec:\s+([\d.]+)")),
+    ("duration", re.compile(r"Total duration:\s+([\d.]+)")),
+)
+
+
+def _forward(process, results, lock):
+    """ Passes the output of process through and keeps its last images/sec and the
+    sum of the durations of its epochs
+    """
+    for line in iter(process.stdout.readline, b""):
+        line = line.decode("utf-8", "replace")
+        with lock:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        for key, regex in _METRICS:
+            match = regex.search(line)
+            if match and key == "duration":
+                results[key] = results.get(key, 0.0) + float(match.group(1))
+            elif match:
+                results[key] = float(match.group(1))
+
+
+def launch(command, num_processes):
+    """ Runs num_processes copies of command as the ranks of a job
+
+    Returns:
+        (exit code of the first rank that failed or 0, list of dicts with the
+        images_per_second and duration logged by each rank and its collective stats)
+    """
+    address = "127.0.0.1:{}".format(_free_port())
+    stats_dir = tempfile.mkdtemp(prefix="local_horovod-")
+    authkey = os.urandom(16).hex()
+    processes, threads = [], []
+    results = [{} for _ in range(num_processes)]
+    lock = threading.Lock()
+    for rank in range(num_processes):
+        env = _environment(rank, num_processes, address, authkey, stats_dir)
+        process = subprocess.Popen(
+            command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        thread = threading.Thread(target=_forward, args=(process, results[rank], lock))
+        thread.daemon = True
+        thread.start()
+        processes.append(process)
+        threads.append(thread)
+
+    exit_code = 0
+    try:
+        # If a rank fails the others would wait for it forever
+        while not exit_code and any(p.poll() is None for p in processes):
+            time.sleep(0.2)
+            for rank, process in enumerate(processes):
+                if process.poll():
+                    _get_logger().error(
+                        "Rank {} exited with code {}".format(rank, process.returncode)
+                    )
+                    exit_code = process.returncode
+                    break
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+            process.wait()
+        for thread in threads:
+            thread.join()
+
+    for rank, result in enumerate(results):
+        filename = os.path.join(stats_dir, "rank-{}.json".format(rank))
+        if os.path.exists(filename):
+            with open(filename) as f:
+                result["collectives"] = json.load(f)
+            os.remove(filename)
+    os.rmdir(stats_dir)
+    return exit_code, results
+
+
+def format_report(results):
+    """ Formats the images/sec and collective time of every rank
+
+    The trainers log the images/sec of the whole job as seen from each rank, each
+    rank processes 1/size of the images so its own images/sec is that over size. The
+    duration is the training time of all the epochs and the collectives columns add
+    up the allreduces, allgathers and broadcasts of the rank.
+    """
+    num_processes = len(results)
+    lines = [
+        "{:>4} {:>12} {:>10} {:>12} {:>8} {:>8} {:>10}".format(
+            "Rank", "Images/sec", "Duration", "Collectives", "Share", "Calls", "MB"
+        )
+    ]
+    total = 0.0
+    for rank, result in enumerate(results):
+        collectives = list(result.get("collectives", {}).values())
+        images_per_second = result.get("images_per_second", float("nan"))
+        total += images_per_second / num_processes
+        duration = result.get("duration", float("nan"))
+        seconds = sum(c["seconds"] for c in collectives)
+        lines.append(
+            "{:>4} {:>12.1f} {:>10.3f} {:>12.3f} {:>8.1%} {:>8} {:>10.1f}".format(
+                rank,
+                images_per_second / num_processes,
+                duration,
+                seconds,
+                seconds / duration if duration else float("nan"),
+                sum(c["calls"] for c in collectives),
+                sum(c["bytes"] for c in collectives) / 2 ** 20,
+            )
+        )
+    lines.append("Total images/sec: {:.1f}".format(total))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-np", "--num-processes", type=int, default=2)
+    parser.add_argument("command", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    if not args.command:
+        parser.error("a command to run is required")
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    exit_code, results = launch(args.command, args.num_processes)
+    print(format_report(results))
+    sys.exit(1 if exit_code else 0)
+
+
+if __name__ == "__main__":
+    main()
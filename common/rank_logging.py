@@ -0,0 +1,163 @@
+"""
+Non-blocking, per-rank logging for the trainers.
+
+The loggers returned by get_logger put their records on a queue, and a background
+thread writes them out, so the training threads never wait for stdout or the file
+share. The rank is set once with set_rank after hvd.init rather than looked up on
+every call. Records are written
+
+    to stdout as text, by every rank, or when there is a log directory by rank 0
+    only, the other ranks still print their warnings and errors
+    to <log_dir>/rank-<rank>.jsonl as one JSON object per line with the time, level,
+    logger, rank, epoch and message and any fields passed in extra
+
+    logger = get_logger(__name__)
+    hvd.init()
+    set_rank(hvd.rank(), log_dir=os.getenv("LOG_DIR"))
+    logger.set_epoch(1)
+    logger.info("Total images/sec: {}".format(ips), extra={"images_per_second": ips})
+"""
+import atexit
+import json
+import logging
+import os
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
+
+_TEXT_FORMAT = "%(levelname)s:%(name)s:%(gpurank)d: %(epoch)s %(message)s"
+# Attributes every record has, the others were passed in extra
+_RECORD_ATTRIBUTES = frozenset(
+    list(vars(logging.LogRecord("", logging.INFO, "", 0, "", (), None)))
+    + ["message", "asctime", "gpurank", "epoch", "epoch_index"]
+)
+
+_queue = Queue()
+_listener = None
+_stdout_handler = None
+_rank = 0
+
+
+class _RankFilter(logging.Filter):
+    """ Adds the rank, unless the record already has it, and an empty epoch if there
+    is none, to every record
+    """
+
+    def filter(self, record):
+        if not hasattr(record, "gpurank"):
+            record.gpurank = _rank
+        if not hasattr(record, "epoch"):
+            record.epoch = ""
+            record.epoch_index = None
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "rank": record.gpurank,
+            "epoch": record.epoch_index,
+            "message": record.getMessage(),
+        }
+        entry.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in _RECORD_ATTRIBUTES
+        )
+        return json.dumps(entry, default=str)
+
+
+def _text_handler():
+    handler = logging.StreamHandler(stream=sys.stdout)
+    handler.setFormatter(logging.Formatter(_TEXT_FORMAT))
+    handler.addFilter(_RankFilter())
+    return handler
+
+
+class _QueueHandler(QueueHandler):
+    """ Queues the records of the process that created it
+
+    Forked worker processes, for example DataLoader workers, have no listener thread
+    so they write their records directly. They use a handler of their own because
+    the listener's handlers may have been locked by the listener thread at the fork.
+    """
+
+    def __init__(self, queue):
+        super(_QueueHandler, self).__init__(queue)
+        self._pid = os.getpid()
+        self._direct_handler = None
+
+    def emit(self, record):
+        # The rank when the record is logged rather than when the listener writes it,
+        # which can be after set_rank
+        record.gpurank = _rank
+        if os.getpid() == self._pid:
+            super(_QueueHandler, self).emit(record)
+            return
+        if self._direct_handler is None:
+            self._direct_handler = _text_handler()
+        self._direct_handler.handle(record)
+
+
+class EpochAdapter(logging.LoggerAdapter):
+    """ Adds the epoch set with set_epoch to the records of logger """
+
+    def __init__(self, logger):
+        super(EpochAdapter, self).__init__(logger, {"epoch": "", "epoch_index": None})
+
+    def set_epoch(self, epoch):
+        self.extra = {"epoch": "[Epoch {}]".format(epoch), "epoch_index": epoch}
+
+    def process(self, msg, kwargs):
+        if "extra" in kwargs:
+            kwargs["extra"] = dict(self.extra, **kwargs["extra"])
+        else:
+            kwargs["extra"] = self.extra
+        return msg, kwargs
+
+
+def _start():
+    global _listener, _stdout_handler
+    if _listener is not None:
+        return
+    _stdout_handler = _text_handler()
+    _listener = QueueListener(_queue, _stdout_handler, respect_handler_level=True)
+    _listener.start()
+    # Write out the records that are still queued when the process exits
+    atexit.register(_listener.stop)
+
+
+def route(logger):
+    """ Sends the records of logger through the queue """
+    _start()
+    if not any(isinstance(h, _QueueHandler) for h in logger.handlers):
+        logger.addHandler(_QueueHandler(_queue))
+
+
+def get_logger(name, level=logging.INFO):
+    """ Returns an EpochAdapter for the logger name that logs through the queue """
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    route(logger)
+    return EpochAdapter(logger)
+
+
+def set_rank(rank, log_dir=None):
+    """ Sets the rank of this process and, if log_dir is given, writes the records
+    of this rank to <log_dir>/rank-<rank>.jsonl
+    """
+    global _rank
+    _rank = rank
+    _start()
+    if log_dir is None:
+        return
+    os.makedirs(log_dir, exist_ok=True)
+    handler = logging.FileHandler(os.path.join(log_dir, "rank-{}.jsonl".format(rank)))
+    handler.setFormatter(JSONFormatter())
+    handler.addFilter(_RankFilter())
+    if rank != 0:
+        _stdout_handler.setLevel(logging.WARNING)
+    _listener.handlers = _listener.handlers + (handler,)
@@ -0,0 +1,310 @@
+"""
+Packs an image folder into a small number of large shard files.
+
+An image folder laid out as <root>/<class>/<image> is written as
+
+    <output_dir>/<name>-00000.shard     concatenated encoded images
+    <output_dir>/<name>-00001.shard
+    ...
+    <output_dir>/<name>.index.npy      shard, offset, length and label of every image
+    <output_dir>/<name>.classes.json   class names, the position is the label
+
+Labels follow the same convention as torchvision's ImageFolder, the sorted class
+directory names are numbered from 0. The images are shuffled before they are
+packed so that reading a shard from start to finish gives a mix of classes.
+
+Usage:
+    python shards.py /data/train /data/shards --name train
+"""
+import argparse
+import io
+import json
+import logging
+import mmap
+import os
+import sys
+
+import numpy as np
+from timer import Timer
+
+INDEX_DTYPE = np.dtype(
+    [("shard", np.int32), ("offset", np.int64), ("length", np.int64), ("label", np.int32)]
+)
+_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".ppm", ".bmp")
+_SHARD_SIZE = 1024 ** 3  # 1GB
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def shard_path(output_dir, name, shard):
+    return os.path.join(output_dir, "{}-{:05d}.shard".format(name, shard))
+
+
+def index_path(output_dir, name):
+    return os.path.join(output_dir, "{}.index.npy".format(name))
+
+
+def classes_path(output_dir, name):
+    return os.path.join(output_dir, "{}.classes.json".format(name))
+
+
+def list_images(image_dir):
+    """ Returns the sorted class names and a list of (filename, label) tuples
+    """
+    classes = sorted(
+        d for d in os.listdir(image_dir) if os.path.isdir(os.path.join(image_dir, d))
+    )
+    samples = []
+    for label, class_name in enumerate(classes):
+        class_dir = os.path.join(image_dir, class_name)
+        for filename in sorted(os.listdir(class_dir)):
+            if filename.lower().endswith(_IMAGE_EXTENSIONS):
+                samples.append((os.path.join(class_dir, filename), label))
+    return classes, samples
+
+
+def write_shards(image_dir, output_dir, name, shard_size=_SHARD_SIZE, seed=42):
+    """ Packs the images in image_dir into shards of roughly shard_size bytes
+
+    Returns:
+        the index as a numpy structured array with the fields of INDEX_DTYPE
+    """
+    logger = _get_logger()
+    classes, samples = list_images(image_dir)
+    logger.info(
+        "Packing {} images from {} classes in {}".format(
+            len(samples), len(classes), image_dir
+        )
+    )
+    order = np.random.RandomState(seed).permutation(len(samples))
+    os.makedirs(output_dir, exist_ok=True)
+
+    index = np.zeros(len(samples), dtype=INDEX_DTYPE)
+    shard, offset = 0, 0
+    out = open(shard_path(output_dir, name, shard), "wb")
+    with Timer() as t:
+        try:
+            for i, sample_id in enumerate(order):
+                filename, label = samples[sample_id]
+                if offset >= shard_size:
+                    out.close()
+                    shard, offset = shard + 1, 0
+                    out = open(shard_path(output_dir, name, shard), "wb")
+                with open(filename, "rb") as f:
+                    data = f.read()
+                out.write(data)
+                index[i] = (shard, offset, len(data), label)
+                offset += len(data)
+        finally:
+            out.close()
+
+    np.save(index_path(output_dir, name), index)
+    with open(classes_path(output_dir, name), "w") as f:
+        json.dump(classes, f)
+    logger.info(
+        "Wrote {} shards in {:.1f}s ({:.0f} images/sec)".format(
+            shard + 1, t.elapsed, len(samples) / max(t.elapsed, 1e-9)
+        )
+    )
+    return index
+
+
+class ShardReader(object):
+    """ Reads images back out of a set of shards
+
+    Random access through read() keeps one file descriptor open per shard, so there
+    is no open() per sample, and uses positional reads so that it can be called
+    from several threads at once. Sequential access through iter_shard() reads a
+    whole shard with a single call. File descriptors are opened lazily and reopened
+    after a fork so that the reader can be handed to data loading worker processes.
+    """
+
+    def __init__(self, data_dir, name):
+        self.data_dir = data_dir
+        self.name = name
+        self.index = np.load(index_path(data_dir, name), mmap_mode="r")
+        with open(classes_path(data_dir, name)) as f:
+            self.classes = json.load(f)
+        self.num_shards = int(self.index["shard"].max()) + 1 if len(self.index) else 0
+        self._fds = {}
+        self._pid = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_fds"] = {}
+        state["_pid"] = None
+        return state
+
+    @property
+    def labels(self):
+        return np.asarray(self.index["label"])
+
+    def _fd(self, shard):
+        if self._pid != os.getpid():
+            self._fds = {}
+            self._pid = os.getpid()
+        if shard not in self._fds:
+            self._fds[shard] = os.open(
+                shard_path(self.data_dir, self.name, shard), os.O_RDONLY
+            )
+        return self._fds[shard]
+
+    def read(self, idx):
+        """ Returns the encoded bytes and label of image idx
+        """
+        shard, offset, length, label = self.index[idx]
+        return os.pread(self._fd(int(shard)), int(length), int(offset)), int(label)
+
+    def shard_indices(self, shard):
+        # The index is written shard by shard so each shard is a contiguous range
+        shards = self.index["shard"]
+        return np.arange(
+            np.searchsorted(shards, shard, side="left"),
+            np.searchsorted(shards, shard, side="right"),
+        )
+
+    def iter_shard(self, shard):
+        """ Yields the encoded bytes and label of every image in a shard, in order
+        """
+        with open(shard_path(self.data_dir, self.name, shard), "rb") as f:
+            buffer = memoryview(f.read())
+        for idx in self.shard_indices(shard):
+            _, offset, length, label = self.index[idx]
+            yield bytes(buffer[offset : offset + length]), int(label)
+
+    def iter_shards(self, shards=None, seed=None):
+        """ Yields every image in the given shards, visiting the shards in a random
+        order if a seed is given
+        """
+        shards = list(range(self.num_shards)) if shards is None else list(shards)
+        if seed is not None:
+            np.random.RandomState(seed).shuffle(shards)
+        for shard in shards:
+            for sample in self.iter_shard(shard):
+                yield sample
+
+    def close(self):
+        if self._pid == os.getpid():
+            for fd in self._fds.values():
+                os.close(fd)
+        self._fds = {}
+
+
+class ViewFile(io.RawIOBase):
+    """ Read only file object over a memoryview
+
+    Decoders such as PIL's Image.open take a file object, wrapping the view in a
+    BytesIO would first copy the whole image, this hands the decoder the chunks it
+    reads straight from the view.
+    """
+
+    def __init__(self, view):
+        super(ViewFile, self).__init__()
+        self._view = view
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else self._position + size
+        data = self._view[self._position : end].tobytes()
+        self._position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+class MappedShardReader(ShardReader):
+    """ Reads images out of memory mapped shards
+
+    view() returns a memoryview onto the mapped shard, so looking up an image does
+    not copy it. Every process that maps the same shard shares the pages in the OS
+    page cache, which keeps the memory of data loading workers flat.
+    """
+
+    def __init__(self, data_dir, name):
+        super(MappedShardReader, self).__init__(data_dir, name)
+        self._maps = {}
+
+    def __getstate__(self):
+        state = super(MappedShardReader, self).__getstate__()
+        state["_maps"] = {}
+        return state
+
+    def _map(self, shard):
+        if self._pid != os.getpid():
+            self._fds = {}
+            self._maps = {}
+            self._pid = os.getpid()
+        if shard not in self._maps:
+            fd = self._fd(shard)
+            self._maps[shard] = memoryview(mmap.mmap(fd, 0, access=mmap.ACCESS_READ))
+        return self._maps[shard]
+
+    def view(self, idx):
+        """ Returns a memoryview of the encoded bytes and the label of image idx
+        """
+        shard, offset, length, label = self.index[idx]
+        offset = int(offset)
+        return self._map(int(shard))[offset : offset + int(length)], int(label)
+
+    def open(self, idx):
+        """ Returns a file object over the encoded bytes and the label of image idx
+        """
+        data, label = self.view(idx)
+        return ViewFile(data), label
+
+    def read(self, idx):
+        data, label = self.view(idx)
+        return data.tobytes(), label
+
+    def close(self):
+        # The maps are unmapped once the views handed out have been released
+        self._maps = {}
+        super(MappedShardReader, self).close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("image_dir", help="image folder laid out as <class>/<image>")
+    parser.add_argument("output_dir")
+    parser.add_argument("--name", default="train")
+    parser.add_argument("--shard-size", type=int, default=_SHARD_SIZE)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    write_shards(
+        args.image_dir,
+        args.output_dir,
+        args.name,
+        shard_size=args.shard_size,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
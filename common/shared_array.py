@@ -0,0 +1,74 @@
+"""
+Numpy arrays in named shared memory.
+
+The array is stored as a .npy file in /dev/shm and memory mapped, so any process
+on the machine can attach to it by name and read it without a copy of its own. The
+process that creates the array owns it and removes it when it exits.
+"""
+import atexit
+import os
+import tempfile
+import uuid
+
+import numpy as np
+
+_SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+class SharedArray(object):
+    """ A numpy array in a named shared memory segment
+
+    The array property gives the creating process the writable array. Any other
+    process, whether it was forked or had the SharedArray pickled to it, attaches
+    to the segment read-only the first time it asks for the array.
+    """
+
+    def __init__(self, name, owner=False):
+        self.name = name
+        self._owner_pid = os.getpid() if owner else None
+        self._array = None
+        self._pid = None
+
+    @property
+    def path(self):
+        return os.path.join(_SHM_DIR, self.name + ".npy")
+
+    @classmethod
+    def create(cls, shape, dtype, prefix="shared"):
+        name = "{}-{}-{}".format(prefix, os.getpid(), uuid.uuid4().hex[:8])
+        shared = cls(name, owner=True)
+        shared._array = np.lib.format.open_memmap(
+            shared.path, mode="w+", dtype=dtype, shape=shape
+        )
+        shared._pid = os.getpid()
+        atexit.register(shared.unlink)
+        return shared
+
+    @classmethod
+    def from_array(cls, array, prefix="shared"):
+        shared = cls.create(array.shape, array.dtype, prefix=prefix)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, name):
+        return cls(name)
+
+    @property
+    def array(self):
+        if self._pid != os.getpid():
+            self._array = np.load(self.path, mmap_mode="r")
+            self._pid = os.getpid()
+        return self._array
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_array"] = None
+        state["_pid"] = None
+        return state
+
+    def unlink(self):
+        """ Removes the segment, only the creating process can do this
+        """
+        if self._owner_pid == os.getpid() and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,190 @@
+"""
+Per step timing for training loops.
+
+StepMetrics splits every training step into phases, for example the time spent
+waiting for data, in the forward pass, in the backward pass and in the optimizer.
+The last `window` durations of each phase are kept in ring buffers so that running
+percentiles can be reported, which makes it easy to tell input bound steps from
+compute bound ones.
+
+    metrics = StepMetrics(batch_size, phases=("data", "forward", "backward", "optimizer"))
+    metrics.start()
+    for data, target in loader:
+        metrics.mark("data")
+        output = model(data)
+        ...
+        metrics.mark("optimizer")
+        metrics.end_step()
+
+Work between the steps, such as logging, is charged to the first phase of the next
+step unless skip() is called after it.
+"""
+import math
+from array import array
+from timer import Timer
+
+PERCENTILES = (50, 95, 99)
+
+
+class RingBuffer(object):
+    """ Fixed size buffer of floats which overwrites the oldest value when full
+    """
+
+    def __init__(self, size):
+        self._values = array("d", [0.0] * size)
+        self._size = size
+        self._count = 0
+
+    def append(self, value):
+        self._values[self._count % self._size] = value
+        self._count += 1
+
+    def __len__(self):
+        return min(self._count, self._size)
+
+    def values(self):
+        return self._values[: len(self)]
+
+    def clear(self):
+        self._count = 0
+
+
+def percentile(values, q):
+    """ Returns the q-th percentile of values using linear interpolation
+    """
+    if not len(values):
+        return float("nan")
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100.0
+    lower = int(math.floor(position))
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class StepMetrics(object):
+    """ Records the duration of each phase of every training step
+
+    Args:
+        batch_size: images per step on this rank
+        phases:     names of the phases in the order they are marked
+        window:     number of steps to keep for the percentiles
+        rank:       rank reported with the metrics
+        sync:       optional callable to run before every mark, for example
+                    torch.cuda.synchronize, so asynchronous work is attributed to
+                    the phase that launched it
+    """
+
+    def __init__(
+        self,
+        batch_size,
+        phases=("data", "compute"),
+        window=1000,
+        rank=0,
+        sync=None,
+    ):
+        self.batch_size = batch_size
+        self.phases = tuple(phases)
+        self.rank = rank
+        self._sync = sync
+        self._clock = Timer()
+        self._buffers = dict((phase, RingBuffer(window)) for phase in self.phases)
+        self._buffers["step"] = RingBuffer(window)
+        self._current = dict((phase, 0.0) for phase in self.phases)
+        # Seconds in each phase and in whole steps since the start, for the means
+        # over any number of steps
+        self.totals = dict((phase, 0.0) for phase in self.phases + ("step",))
+        self._last = None
+        self._step_start = None
+        self.steps = 0
+        self.images = 0
+
+    def start(self):
+        """ Starts timing, the first phase is measured from here """
+        self._clock.start()
+        self._last = self._step_start = self._clock()
+
+    def mark(self, phase):
+        """ Ends phase, attributing to it the time since the previous mark """
+        if self._sync is not None:
+            self._sync()
+        now = self._clock()
+        self._current[phase] += now - self._last
+        self._last = now
+
+    def skip(self):
+        """ Restarts the clock after end_step without attributing the time since the
+        last mark to any phase or step, for work between the steps such as logging
+        """
+        if self._sync is not None:
+            self._sync()
+        self._last = self._step_start = self._clock()
+
+    def end_step(self, batch_size=None):
+        """ Records the phases of the step and starts the next one """
+        now = self._last
+        for phase in self.phases:
+            self._buffers[phase].append(self._current[phase])
+            self.totals[phase] += self._current[phase]
+            self._current[phase] = 0.0
+        self._buffers["step"].append(now - self._step_start)
+        self.totals["step"] += now - self._step_start
+        self._step_start = now
+        self.steps += 1
+        self.images += self.batch_size if batch_size is None else batch_size
+
+    def reset(self):
+        for buffer in self._buffers.values():
+            buffer.clear()
+        for phase in self.totals:
+            self.totals[phase] = 0.0
+        self.steps = 0
+        self.images = 0
+        self.start()
+
+    @property
+    def images_per_second(self):
+        elapsed = self._clock.elapsed
+        return self.images / elapsed if elapsed > 0 else float("nan")
+
+    def mean(self, phase):
+        values = self._buffers[phase].values()
+        return sum(values) / len(values) if len(values) else float("nan")
+
+    def percentiles(self, phase, qs=PERCENTILES):
+        values = self._buffers[phase].values()
+        return dict((q, percentile(values, q)) for q in qs)
+
+    def summary(self):
+        """ Returns a dict of the throughput and the mean and percentiles of each phase
+        in seconds
+        """
+        result = {
+            "rank": self.rank,
+            "steps": self.steps,
+            "images": self.images,
+            "images_per_second": self.images_per_second,
+        }
+        for phase in self.phases + ("step",):
+            result[phase] = dict(
+                ("p{}".format(q), value) for q, value in self.percentiles(phase).items()
+            )
+            result[phase]["mean"] = self.mean(phase)
+        step_mean = result["step"]["mean"]
+        if "data" in self.phases and step_mean > 0:
+            result["data_fraction"] = result["data"]["mean"] / step_mean
+        return result
+
+    def format(self):
+        summary = self.summary()
+        phases = " ".join(
+            "{}(p50:{:.1f} p95:{:.1f} p99:{:.1f})ms".format(
+                phase,
+                summary[phase]["p50"] * 1000,
+                summary[phase]["p95"] * 1000,
+                summary[phase]["p99"] * 1000,
+            )
+            for phase in self.phases + ("step",)
+        )
+        return "Step metrics: rank {} images/sec {:.1f} {}".format(
+            self.rank, summary["images_per_second"], phases
+        )
@@ -0,0 +1,189 @@
+"""
+Detects ranks that hold back a synchronous Horovod job.
+
+Every rank waits for the slowest one at each allreduce, so a straggler does not
+make its own steps longer, it makes the other ranks wait longer. StragglerMonitor
+therefore compares the time each rank spends working, its step time without the
+phases in which the ranks wait for each other. Every `every` steps each rank
+allgathers the mean of its step, input and wait phases over the steps since the
+last check, which is a few floats per rank, and every rank then flags a rank as a
+straggler if
+
+    its working time is more than `threshold` scaled median absolute deviations
+    above the median of the ranks, with fewer than three ranks there is no spread
+    to measure and this is skipped
+    and it is more than `min_slowdown` slower than the median
+
+A straggler is input bound if most of the extra time is spent waiting for data and
+compute bound otherwise. Rank 0 logs a warning for every straggler.
+
+    monitor = StragglerMonitor(allgather, input_phases=("data",),
+                               wait_phases=("optimizer",))
+    for data, target in loader:
+        ...
+        metrics.end_step()
+        monitor.update(metrics)
+        metrics.skip()
+
+The fast ranks wait for the slow one in the allgather, metrics.skip() after the
+update keeps that wait out of their next step, where it would count as work.
+
+allgather takes a 1-d numpy array and returns the arrays of all the ranks stacked
+as rows, for example through hvd.allgather. Since the ranks take their steps
+together they all reach the allgather at the same step.
+"""
+import logging
+
+import numpy as np
+
+# Scales the median absolute deviation to the standard deviation of a normal
+_MAD_SCALE = 1.4826
+
+
+def _get_logger():
+    return logging.getLogger(__name__)
+
+
+def robust_scores(values):
+    """ Returns how many scaled median absolute deviations each value is above the
+    median, 0 for every value if they do not vary
+    """
+    values = np.asarray(values, dtype=np.float64)
+    median = np.median(values)
+    deviation = _MAD_SCALE * np.median(np.abs(values - median))
+    if deviation == 0:
+        return np.zeros_like(values)
+    return (values - median) / deviation
+
+
+def find_stragglers(step, input_wait, wait, threshold=3.5, min_slowdown=0.1):
+    """ Returns a dict for each straggler with its rank, slowdown, the extra input
+    and compute time over the median rank in seconds and whether it is input or
+    compute bound
+
+    Args:
+        step, input_wait, wait: mean step time, time waiting for input and time
+                                waiting for the other ranks of every rank
+    """
+    step = np.asarray(step, dtype=np.float64)
+    input_wait = np.asarray(input_wait, dtype=np.float64)
+    work = step - np.asarray(wait, dtype=np.float64)
+    compute = work - input_wait
+    median_work = np.median(work)
+    if len(work) < 2 or median_work <= 0:
+        return []
+    slower = work > median_work * (1 + min_slowdown)
+    if len(work) >= 3:
+        slower &= robust_scores(work) > threshold
+    stragglers = []
+    for rank in np.flatnonzero(slower):
+        extra_input = input_wait[rank] - np.median(input_wait)
+        extra_compute = compute[rank] - np.median(compute)
+        stragglers.append(
+            {
+                "rank": int(rank),
+                "slowdown": float(work[rank] / median_work),
+                "extra_input": float(extra_input),
+                "extra_compute": float(extra_compute),
+                "bound": "input" if extra_input >= extra_compute else "compute",
+            }
+        )
+    return stragglers
+
+
+class StragglerMonitor(object):
+    """ Allgathers the phase times of a StepMetrics every `every` steps and logs the
+    stragglers
+
+    Args:
+        allgather:     allgather(array) returns the 1-d arrays of all the ranks as rows
+        every:         steps between the checks
+        input_phases:  phases of the StepMetrics spent waiting for data
+        wait_phases:   phases in which the ranks wait for each other, the allreduce
+        threshold:     scaled median absolute deviations above the median of the
+                       ranks for a rank to be a straggler
+        min_slowdown:  how much slower than the median a straggler has to be
+        rank:          the rank of this process, only rank 0 logs
+        logger:        where the stragglers are logged, this module's logger if None
+    """
+
+    def __init__(
+        self,
+        allgather,
+        every=100,
+        input_phases=("data",),
+        wait_phases=(),
+        threshold=3.5,
+        min_slowdown=0.1,
+        rank=0,
+        logger=None,
+    ):
+        self._allgather = allgather
+        self._every = every
+        self._input_phases = tuple(input_phases)
+        self._wait_phases = tuple(wait_phases)
+        self._threshold = threshold
+        self._min_slowdown = min_slowdown
+        self._rank = rank
+        self._logger = logger or _get_logger()
+        self._metrics = None
+        self._steps = 0
+        self._totals = None
+        self.stragglers = []
+
+    def update(self, metrics):
+        """ Checks for stragglers if it is `every` steps since the last check
+
+        Returns:
+            the stragglers found, or None if there was no check
+        """
+        if metrics is not self._metrics or metrics.steps < self._steps:
+            # A new StepMetrics, for example for a new epoch
+            self._metrics = metrics
+            self._steps = 0
+            self._totals = dict((phase, 0.0) for phase in metrics.totals)
+        steps = metrics.steps - self._steps
+        if steps < self._every:
+            return None
+        means = dict(
+            (phase, (metrics.totals[phase] - self._totals[phase]) / steps)
+            for phase in metrics.totals
+        )
+        self._steps = metrics.steps
+        self._totals = dict(metrics.totals)
+        return self.check(
+            means["step"],
+            sum(means[phase] for phase in self._input_phases),
+            sum(means[phase] for phase in self._wait_phases),
+        )
+
+    def check(self, step, input_wait, wait):
+        """ Allgathers the mean times of this rank and returns the stragglers """
+        times = np.asarray(
+            self._allgather(np.array([step, input_wait, wait], dtype=np.float64))
+        )
+        stragglers = find_stragglers(
+            times[:, 0],
+            times[:, 1],
+            times[:, 2],
+            threshold=self._threshold,
+            min_slowdown=self._min_slowdown,
+        )
+        self.stragglers.extend(stragglers)
+        if self._rank == 0:
+            for straggler in stragglers:
+                _log_straggler(self._logger, straggler)
+        return stragglers
+
+
+def _log_straggler(logger, straggler):
+    logger.warning(
+        "Straggler: rank {rank} works {slowdown:.2f}x as long as the median rank, "
+        "{extra_input_ms:+.1f}ms input and {extra_compute_ms:+.1f}ms compute per "
+        "step, {bound} bound".format(
+            extra_input_ms=straggler["extra_input"] * 1000,
+            extra_compute_ms=straggler["extra_compute"] * 1000,
+            **straggler
+        ),
+        extra=dict(("straggler_" + key, value) for key, value in straggler.items()),
+    )
@@ -3,6 +3,14 @@ import functools
 import logging
 from timeit import default_timer
 
+try:
+    from time import perf_counter_ns
+except ImportError:  # Python < 3.7
+    from time import perf_counter
+
+    def perf_counter_ns():
+        return int(perf_counter() * 1e9)
+
 
 class Timer(object):
 
@@ -22,9 +30,11 @@ class Timer(object):
                  output=None,
                  fmt="took {:.3f} seconds",
                  prefix=""):
+        if output is True or (output is None and prefix):
+            output = print
         self._timer = timer
         self._factor = factor
-        self._output = output
+        self._output = output if callable(output) else None
         self._fmt = fmt
         self._prefix = prefix
         self._end = None
@@ -49,10 +59,7 @@ class Timer(object):
         """ Set the end time """
         self.stop()
 
-        if self._output is True or (self._output is None and self._prefix):
-            self._output = print
-
-        if callable(self._output):
+        if self._output is not None:
             output = " ".join([self._prefix, self._fmt.format(self.elapsed)])
             self._output(output)
 
@@ -99,7 +106,111 @@ def timer(logger=None,
         return wrapped
 
     if (len(func_or_func_args) == 1
-            and isinstance(func_or_func_args[0], collections.Callable)):
+            and callable(func_or_func_args[0])):
         return wrapped_f(func_or_func_args[0])
     else:
         return wrapped_f
+
+
+class FastTimer(object):
+
+    """ Timer for hot loops
+
+    Adds up integer nanoseconds from perf_counter_ns and counts how many times it
+    has been stopped. Nothing is formatted or output; read total, count and mean when
+    needed.
+    """
+
+    __slots__ = ("_start", "total_ns", "count")
+
+    def __init__(self):
+        self._start = 0
+        self.total_ns = 0
+        self.count = 0
+
+    def start(self):
+        self._start = perf_counter_ns()
+
+    def stop(self):
+        """ Adds the time since start to the total and returns it in nanoseconds """
+        elapsed = perf_counter_ns() - self._start
+        self.total_ns += elapsed
+        self.count += 1
+        return elapsed
+
+    def __enter__(self):
+        self._start = perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.total_ns += perf_counter_ns() - self._start
+        self.count += 1
+
+    @property
+    def total(self):
+        """ Total time in seconds """
+        return self.total_ns * 1e-9
+
+    @property
+    def mean(self):
+        """ Mean time per call in seconds """
+        return self.total / self.count if self.count else 0.0
+
+    def reset(self):
+        self.total_ns = 0
+        self.count = 0
+
+
+_ACCUMULATORS = collections.OrderedDict()
+
+
+def accumulate(f=None, name=None):
+    """ Function decorator adding the function execution time to a FastTimer
+
+    Unlike timer this does no formatting or logging per call, so it can wrap per
+    batch functions. The FastTimer is available as the timer attribute of the
+    wrapped function and the totals are output by flush().
+    """
+    def wrapped_f(f):
+        counter = FastTimer()
+        _ACCUMULATORS[name or f.__qualname__] = counter
+
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                counter.total_ns += perf_counter_ns() - start
+                counter.count += 1
+
+        wrapped.timer = counter
+        return wrapped
+
+    if f is not None:
+        return wrapped_f(f)
+    else:
+        return wrapped_f
+
+
+def flush(logger=None,
+          level=logging.INFO,
+          fmt="function %(function_name)s calls: %(calls)d total: %(total).3f mean: %(mean).6f",
+          reset=True):
+    """ Outputs the totals of every function decorated with accumulate
+    """
+    for function_name, counter in _ACCUMULATORS.items():
+        if not counter.count:
+            continue
+        context = {
+            'function_name': function_name,
+            'calls': counter.count,
+            'total': counter.total,
+            'mean': counter.mean,
+        }
+        if logger:
+            logger.log(level, fmt % context, extra=context)
+        else:
+            print(fmt % context)
+        if reset:
+            counter.reset()